@@ -0,0 +1,22 @@
+"""
+This file contains the JWT authentication class of the REST API.
+It is simplejwt's JWTAuthentication plus the revocation check of the
+WebSocket middleware and the async views (see middleware.revoke_user_tokens),
+so an access token issued before logout or a password change stops
+working on every endpoint.
+"""
+from django.core.cache import cache
+from rest_framework import exceptions
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from .middleware import is_revoked, revoked_key
+
+
+class RevocableJWTAuthentication(JWTAuthentication):
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        revoked_at = cache.get(revoked_key(token[api_settings.USER_ID_CLAIM]))
+        if is_revoked(token.get("iat", 0), revoked_at):
+            raise exceptions.AuthenticationFailed("Token has been revoked", code="token_revoked")
+        return token
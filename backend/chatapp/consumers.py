@@ -5,12 +5,36 @@ connections, message receipt, broadcasting, and user presence.
 """
 import json
 import logging
+import time
+import uuid
 logger = logging.getLogger(__name__)
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Conversation, Message, ConversationParticipant, MessageDeletion
+from django.db import transaction
+from .models import Conversation, Message
 from .serializers import MessageSerializer
+from . import metrics
+from .messaging import (
+    create_message,
+    group_event,
+    group_send,
+    increment_unread,
+    message_event,
+    touch_conversation,
+)
+from .presence import PresenceProvider, presence_tracker
+from .listcache import bump_list_versions, bump_lists_for_new_messages
+from .dbexecutor import db_task
+from .membership import aget_conversation, ais_member
+from .throttling import (
+    connection_bucket,
+    typing_coalescer,
+    user_control_limiter,
+    user_rate_limiter,
+    write_gate,
+)
+from .writebehind import areserve_seq, uses_write_behind, write_behind
 from django.core.exceptions import PermissionDenied
 
 User = get_user_model()
@@ -20,16 +44,34 @@ class ChatConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for real-time chat messaging.
 
+    URL: ws://localhost:8000/ws/chat/
+        One multiplexed socket per client. Conversation streams are opened
+        and closed in-band with "subscribe"/"unsubscribe" frames; membership
+        is checked for every subscription.
+
     URL: ws://localhost:8000/ws/chat/<conversation_id>/
+        Legacy single-room socket ("list" is the same as ws/chat/).
     """
 
+    # Default maximum number of conversations one socket may subscribe to
+    DEFAULT_MAX_SUBSCRIPTIONS = 100
+
+    # Frame types counted by name in metrics (anything else is "unknown")
+    FRAME_TYPES = frozenset(
+        {"subscribe", "unsubscribe", "chat_message", "delete_message", "typing", "ping"}
+    )
+
+    # Frame types limited by user_control_limiter
+    CONTROL_FRAMES = frozenset({"subscribe", "delete_message", "typing"})
+
     async def connect(self):
         """Handle websocket connection"""
-        self.conversation_id = self.scope["url_route"]["kwargs"].get("conversation_id")
-        if not self.conversation_id:
-            print("DEBUG: Connection rejected - No conversation_id")
-            await self.close(code=4000)
-            return
+        # no conversation in the URL: multiplexed socket
+        self.conversation_id = self.scope["url_route"]["kwargs"].get("conversation_id") or "list"
+        # conversation id -> Conversation for every room this socket receives
+        self.subscriptions = {}
+        # chat_message budget of this socket (the user's budget is shared)
+        self.message_bucket = connection_bucket()
 
         # Determine if conversation_id is an int (ID) or string (slug)
         self.is_id = False
@@ -47,22 +89,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
             print(
                 f"DEBUG: Connection rejected - Anonymous user. Scope user: {self.user}"
             )
+            metrics.ws_connects.inc("anonymous")
             await self.close(code=4001)
             return
 
-        # Handle special case for 'list' (user-level socket)
+        # Handle special case for 'list' (user-level, multiplexed socket)
         if self.conversation_id == "list":
-            # user level socket (chat list updates)
+            # user level socket (chat list updates); rooms are added with "subscribe"
             self.group_name = f"user_{self.user.id}"
             await self.channel_layer.group_add(self.group_name, self.channel_name)
             await self.accept()
+            self.count_connection()
             
         #======================= added online indicator
-            try:
-                await self.presence_active(self.user.id)
-            except Exception as e:
-               print("PRESENCE ERROR:", e)
-
+            await self.presence_connect()
         #================================
             return
         # Verify user is participant in this conversation
@@ -73,16 +113,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
             )
         except PermissionDenied as e:
             print(f"DEBUG: Connection rejected - PermissionDenied: {e}")
+            metrics.ws_connects.inc("forbidden")
             await self.close(code=4003)
             return
         except Exception as e:
             print(f"DEBUG: Connection rejected - Unexpected error: {e}")
+            metrics.ws_connects.inc("error")
             await self.close(code=4000)
             return
 
-        # Join room group
-        self.group_name = f"chat_{self.conversation_id}"
+        # Join room group (always by id, so slug and id sockets share one group)
+        self.group_name = f"chat_{self.conversation.id}"
         await self.channel_layer.group_add(self.group_name, self.channel_name)
+        self.subscriptions[self.conversation.id] = self.conversation
 
         # ADD: per-user group for chat list updates
         self.user_group = f"user_{self.user.id}"
@@ -90,6 +133,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
 
         await self.accept()
+        self.count_connection()
         print(
             f"DEBUG: Connection ACCEPTED for user {self.user} in conversation {self.conversation_id}"
         )
@@ -103,16 +147,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
          #======================= added online indicator
-        try:
-            await self.presence_active(self.user.id)
-        except Exception as e:
-               print("PRESENCE ERROR:", e)
-
+        await self.presence_connect()
         #================================
 
 
+    # Count an accepted socket in metrics (uncounted in disconnect)
+    def count_connection(self):
+        metrics.ws_connects.inc("accepted")
+        metrics.ws_connections.inc()
+        self.connection_counted = True
+
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection"""
+        if getattr(self, "connection_counted", False):
+            self.connection_counted = False
+            metrics.ws_connections.dec()
+
         # leave room group
         if hasattr(self, "group_name"):
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
@@ -120,13 +170,23 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # leave user group
         if hasattr(self, "user_group"):
             await self.channel_layer.group_discard(self.user_group, self.channel_name)
+
+        # leave every subscribed room
+        for conversation_id in list(getattr(self, "subscriptions", {})):
+            await self.unsubscribe(conversation_id)
         
           #======================= added online indicator
-        try:
-           if hasattr(self, "user") and self.user.is_authenticated:
-               await self.presence_deactive(self.user.id)         
-        except Exception:
-            pass 
+        # only sockets counted in presence_connect are uncounted here
+        if getattr(self, "presence_counted", False):
+            self.presence_counted = False
+            try:
+                if await presence_tracker.disconnect(self.user.id):
+                    # last socket closed: tell contacts after the debounce delay
+                    presence_tracker.announce_offline_later(
+                        self.channel_layer, self.user.id
+                    )
+            except Exception:
+                logger.exception("Presence disconnect failed")
         #================================
 
     async def receive(self, text_data):
@@ -134,11 +194,28 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Receive message from WebSocket client
 
         Expected format:
+        {
+            "type": "subscribe",
+            "conversation_id": 12
+        }
+
+        OR
+
+        {
+            "type": "unsubscribe",
+            "conversation_id": 12
+        }
+
+        OR
+
         {
             "type": "chat_message",
+            "conversation_id": 12,
             "content": "Hello world"
         }
 
+        "conversation_id" may be left out on a legacy single-room socket.
+
         OR
 
         {
@@ -153,15 +230,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
             "is_typing": true
         }
         """
+        metrics.publisher.maybe_publish()
         try:
             data = json.loads(text_data)
             message_type = data.get("type")
-
-            # ✅ refresh presence on ANY incoming message
-            if self.user.is_authenticated:
-                await self.presence_active(self.user.id)
-
-            if message_type == "chat_message":
+            metrics.ws_frames.inc(message_type if message_type in self.FRAME_TYPES else "unknown")
+
+            # refresh presence on ANY incoming message (coalesced per TTL window)
+            if getattr(self, "presence_counted", False):
+                await presence_tracker.heartbeat(self.user.id)
+
+            # frames that reach the cache or the database count against a
+            # per-user limit (chat_message has its own in allow_message)
+            if message_type in self.CONTROL_FRAMES and not await self.allow_control():
+                return
+
+            if message_type == "subscribe":
+                await self.handle_subscribe(data)
+            elif message_type == "unsubscribe":
+                await self.handle_unsubscribe(data)
+            elif message_type == "chat_message":
                 await self.handle_chat_message(data)
             elif message_type == "delete_message":
                 await self.handle_delete_message(data)
@@ -172,6 +260,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             else:
                 await self.send_error("unknown message type")
         except json.JSONDecodeError:
+            metrics.ws_frames.inc("invalid")
             await self.send_error("Invalid json")
         except Exception:
             logger.exception("Unexpected error in receive")
@@ -180,6 +269,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def handle_chat_message(self, data):
         """Handle incoming chat message"""
         print(f"DEBUG: consumers.py received message: {data}")
+        conversation = await self.target_conversation(data)
+        if conversation is None:
+            return
         content = data.get("content", "").strip()
 
         if not content:
@@ -189,36 +281,174 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_error("Message content exceeds maximum length")
             return
 
+        if not await self.allow_message():
+            return
+
+        if uses_write_behind(conversation):
+            await self.handle_queued_message(conversation, content, data)
+            return
+
+        # backpressure: refuse instead of queueing behind other sockets' writes
+        if not write_gate.acquire():
+            await self.send_error("Server busy, try again", code="overloaded")
+            return
+
         # Save message to database
-        message = await self.save_message(content)
+        start = time.perf_counter()
+        try:
+            message = await self.save_message(conversation, content)
+        finally:
+            write_gate.release()
+            metrics.message_save_seconds.observe(time.perf_counter() - start, "ws")
 
         if message:
-            print(f"DEBUG: Message saved. Broadcasting to group {self.group_name}")
             # Broadcast serialized message to group
-            await self.channel_layer.group_send(
-                self.group_name,
+            await group_send(
+                self.channel_layer, f"chat_{conversation.id}", message_event(message)
+            )
+
+    async def handle_queued_message(self, conversation, content, data):
+        """
+        Write-behind path: number the message, acknowledge and broadcast it
+        at once; the row is written by the next flush.
+        """
+        if write_behind.full():
+            await self.send_error("Server busy, try again", code="overloaded")
+            return
+        seq = await areserve_seq(conversation.id)
+        # the id comes with the flush; until then clients key the message on uuid
+        message = Message(
+            conversation=conversation,
+            sender=self.user,
+            content=content,
+            seq=seq,
+            uuid=uuid.uuid4(),
+        )
+        write_behind.put(message)
+
+        await self.send(
+            text_data=json.dumps(
                 {
-                    "type": "conversation_updated",
-                    "conversation_id": self.conversation.id,
-                },
+                    "type": "message_ack",
+                    "conversation_id": conversation.id,
+                    "seq": seq,
+                    "uuid": str(message.uuid),
+                    "client_id": data.get("client_id"),
+                }
             )
+        )
+        # the sender is online; no presence lookup needed to serialize
+        presence = PresenceProvider()
+        presence.set(self.user.id, True)
+        payload = MessageSerializer(message, context={"presence": presence}).data
+        await group_send(
+            self.channel_layer, f"chat_{conversation.id}", message_event(payload)
+        )
+
+    async def allow_message(self):
+        """
+        Spend one token from the connection and user buckets.
+        Throttled clients get an error frame with the seconds to wait.
+        """
+        wait = self.message_bucket.take()
+        if not wait:
+            wait = await user_rate_limiter.take(self.user.id)
+        if wait:
+            await self.send_error(
+                "Too many messages", code="rate_limited", retry_after=round(wait, 3)
+            )
+            return False
+        return True
+
+    async def allow_control(self):
+        """Spend one token from the user's control frame bucket."""
+        wait = await user_control_limiter.take(self.user.id)
+        if wait:
+            await self.send_error(
+                "Too many requests", code="rate_limited", retry_after=round(wait, 3)
+            )
+            return False
+        return True
+
+    async def handle_subscribe(self, data):
+        """Start receiving a conversation on this socket after a membership check"""
+        conversation_id = data.get("conversation_id")
+        if conversation_id is None:
+            await self.send_error("conversation_id is required")
+            return
+        if isinstance(conversation_id, str) and conversation_id.isdigit():
+            conversation_id = int(conversation_id)
+
+        try:
+            conversation = await self.get_conversation_for_user(conversation_id, self.user)
+        except PermissionDenied:
+            await self.send_error("Cannot subscribe to this conversation", conversation_id)
+            return
+
+        if conversation.id not in self.subscriptions:
+            max_subscriptions = getattr(
+                settings, "CHAT_MAX_SUBSCRIPTIONS", self.DEFAULT_MAX_SUBSCRIPTIONS
+            )
+            if len(self.subscriptions) >= max_subscriptions:
+                await self.send_error("Too many subscriptions", conversation.id)
+                return
+            await self.channel_layer.group_add(f"chat_{conversation.id}", self.channel_name)
+            self.subscriptions[conversation.id] = conversation
+
+        await self.send(
+            text_data=json.dumps({"type": "subscribed", "conversation_id": conversation.id})
+        )
+
+    async def handle_unsubscribe(self, data):
+        """Stop receiving a conversation on this socket"""
+        conversation_id = data.get("conversation_id")
+        if isinstance(conversation_id, str) and conversation_id.isdigit():
+            conversation_id = int(conversation_id)
+        await self.unsubscribe(conversation_id)
+        await self.send(
+            text_data=json.dumps({"type": "unsubscribed", "conversation_id": conversation_id})
+        )
+
+    # Leave the room group of a subscribed conversation
+    async def unsubscribe(self, conversation_id):
+        if self.subscriptions.pop(conversation_id, None) is not None:
+            await self.channel_layer.group_discard(f"chat_{conversation_id}", self.channel_name)
+
+    async def target_conversation(self, data):
+        """
+        Conversation a frame is meant for: its "conversation_id" among the
+        subscriptions, or the room of a legacy single-room socket.
+        Sends an error and returns None when the socket is not subscribed.
+        """
+        conversation_id = data.get("conversation_id")
+        if conversation_id is None:
+            conversation = getattr(self, "conversation", None)
+        else:
+            if isinstance(conversation_id, str) and conversation_id.isdigit():
+                conversation_id = int(conversation_id)
+            conversation = self.subscriptions.get(conversation_id)
+        if conversation is None:
+            await self.send_error("Not subscribed to this conversation", conversation_id)
+        return conversation
+
+    # Group handlers below forward the frame pre-encoded by the sender
+    # (see messaging.group_event), so a broadcast is JSON-encoded only once
 
     # Light weight handler for message update broadcast
     async def conversation_updated(self, event):
         """Handle conversation update broadcast"""
-        await self.send(text_data=json.dumps({
-            "type": "conversation_updated",
-            "conversation_id": event["conversation_id"],
-            }))
+        await self.send(text_data=event["text"])
 
     # handle chat list update for this user
     async def chat_list_update(self, event):
         """Handle chat list update for this user"""
-        await self.send(text_data=json.dumps({
-            "type": "chat_list_update",
-            "conversation_id": event["conversation_id"],
-            "unread_count": event["unread_count"],
-        }))
+        await self.send(text_data=event["text"])
+
+
+    # handle online/offline change of one of this user's contacts
+    async def presence_changed(self, event):
+        """Handle presence change of a contact"""
+        await self.send(text_data=event["text"])
 
 
 # Light weight handler for message deletion
@@ -228,14 +458,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if not message_id:
             await self.send_error("message_id is required for deletion")
             return
+        conversation = await self.target_conversation(data)
+        if conversation is None:
+            return
 
-        success = await self.delete_message(message_id)
+        success = await self.delete_message(conversation, message_id)
         if success:
             # Notify only this user (not broadcast)
             await self.send(
                 text_data=json.dumps(
                     {
                         "type": "message_deleted",
+                        "conversation_id": conversation.id,
                         "message_id": message_id,
                     }
                 )
@@ -245,81 +479,78 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def handle_typing(self, data):
         """Handle typing indicator"""
-        is_typing = data.get("is_typing", False)
+        conversation = await self.target_conversation(data)
+        if conversation is None:
+            return
+        is_typing = bool(data.get("is_typing", False))
+
         # Broadcast typing status to room group
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                "type": "typing_indicator",
-                "user_id": self.user.id,
-                "username": self.user.username,
-                "is_typing": is_typing,
-            },
-        )
+        async def send(is_typing):
+            await group_send(
+                self.channel_layer,
+                f"chat_{conversation.id}",
+                group_event(
+                    "typing_indicator",
+                    {
+                        "type": "typing_indicator",
+                        "conversation_id": conversation.id,
+                        "user_id": self.user.id,
+                        "username": self.user.username,
+                        "is_typing": is_typing,
+                    },
+                    user_id=self.user.id,
+                ),
+            )
+
+        # at most one event per interval per user per room; the latest state wins
+        await typing_coalescer.submit((self.user.id, conversation.id), is_typing, send)
 
     async def chat_message_broadcast(self, event):
         """Send message to WebSocket (called by group_send)"""
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "new_message",
-                    "message": event["message"],
-                }
-            )
-        )
+        await self.send(text_data=event["text"])
+
+    # ids of write-behind messages, sent by the flusher after it wrote them
+    async def messages_saved(self, event):
+        """Send saved message ids to WebSocket (called by group_send)"""
+        await self.send(text_data=event["text"])
 
     async def typing_indicator(self, event):
         """Send typing indicator to WebSocket (called by group_send)"""
         # Avoid typing indicator who typing
         if event["user_id"] != self.user.id:
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "typing_indicator",
-                        "user_id": event["user_id"],
-                        "username": event["username"],
-                        "is_typing": event["is_typing"],
-                    }
-                )
-            )
-
-    async def send_error(self, error_message):
-        """Send error message to WebSocket/client"""
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "error",
-                    "message": error_message,
-                }
-            )
-        )
+            await self.send(text_data=event["text"])
+
+    async def send_error(self, error_message, conversation_id=None, **extra):
+        """Send error message to WebSocket/client (extra keys e.g. code, retry_after)"""
+        frame = {
+            "type": "error",
+            "message": error_message,
+            **extra,
+        }
+        if conversation_id is not None:
+            frame["conversation_id"] = conversation_id
+        await self.send(text_data=json.dumps(frame))
 
-    # Database operations wrapped with database_sync_to_async
-    @database_sync_to_async
-    def get_conversation_for_user(self, conversation_id, user):
+    async def get_conversation_for_user(self, conversation_id, user):
         """
         Map room_name (slug) -> Conversation object.
         Accepts:
         - 'global' -> returns (or creates) the global Conversation
         - any slug for private conversations -> returns Conversation after permission check
         Raises PermissionDenied if user should not join.
+        Conversation and membership come from the cache when possible
+        (see membership.aget_conversation), so resubscribing is database free.
         """
         # Try to find conversation by ID or slug
-        try:
-            if isinstance(conversation_id, int):
-                convo = Conversation.objects.get(id=conversation_id)
-            else:
-                convo = Conversation.objects.get(slug=conversation_id)
-        except Conversation.DoesNotExist:
+        convo = await aget_conversation(conversation_id)
+        if convo is None:
             # If not found by slug, maybe it's a private chat slug pattern that needs creation or specific handling?
             # For now, assuming it must exist.
             raise PermissionDenied("Conversation does not exist")
 
-        # must be private -> verify membership
-        if convo.type == Conversation.TYPE_PRIVATE:
-            if not ConversationParticipant.objects.filter(
-                conversation=convo, user=user
-            ).exists():
+        # must be private or group -> verify membership (cached)
+        if convo.type in (Conversation.TYPE_PRIVATE, Conversation.TYPE_GROUP):
+            if not await ais_member(convo.id, user.id):
                 raise PermissionDenied("Not a participant")
             return convo
 
@@ -330,67 +561,60 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # fallback deny
         raise PermissionDenied("Cannot join room")
 
-    @database_sync_to_async
-    def save_message(self, content):
+    # Database operations run through the shared executor (see dbexecutor)
+    @db_task
+    def save_message(self, conversation, content):
         """
-        Save message for self.conversation (set during connect) and return serialized data.
+        Save message for a subscribed conversation and return serialized data.
         """
         try:
-            conversation = self.conversation
-            message = Message.objects.create(
-                conversation=conversation,
-                sender=self.user,
-                content=content,
-            )
-            # Update unread for private conversations only
-            try:
-                if conversation.type == Conversation.TYPE_PRIVATE:
-                    from django.db import models
-
-                    ConversationParticipant.objects.filter(
-                        conversation=conversation
-                    ).exclude(user=self.user).update(
-                        unread_count=models.F("unread_count") + 1
-                    )
-            except Exception:
-                # don't crash on unread_count errors
-                pass
-
-            serializer = MessageSerializer(message)
-            return serializer.data
-        except Exception as e:
+            # message, seq and unread counts commit together (as in the HTTP view)
+            with transaction.atomic():
+                message = create_message(conversation, self.user, content)
+                # Update unread for other participants (one UPDATE, new counts returned)
+                unread = increment_unread(conversation.id, self.user.id)
+                # new last message and unread counts in every member's list
+                bump_lists_for_new_messages(
+                    [conversation.id], [self.user.id, *(uid for uid, _ in unread)]
+                )
+        except Exception:
             logger.exception("Error saving message")
             return None
+
+        serializer = MessageSerializer(message)
+        return serializer.data
         
-    # Database operations wrapped with database_sync_to_async
-    @database_sync_to_async
-    def delete_message(self, message_id):
+    @db_task
+    def delete_message(self, conversation, message_id):
         """
         Delete a message for the current user (sender-only delete).
         """
         try:
             message = Message.objects.get(
-                id=message_id, sender=self.user, conversation=self.conversation
+                id=message_id, sender=self.user, conversation=conversation
+            )
+            with transaction.atomic():
+                message.delete()
+                touch_conversation(conversation.id)
+            # the last message shown in members' lists may be gone
+            bump_list_versions(
+                conversation.participants.values_list("user_id", flat=True)
             )
-            message.delete()
             return True
         except Message.DoesNotExist:
             return 
         
 # from here added online offline status        
-    # Database operation for showing online status
-    @database_sync_to_async
-    def presence_active(self, user_id):
-        from django.core.cache import cache
-        cache.set(f"online:{user_id}", True, timeout=10)  # set online with 10 sec timeout
-
-    @database_sync_to_async
-    def presence_deactive(self, user_id):
-        from django.core.cache import cache
+    # Count this socket for the user's online status (cache only, no database)
+    async def presence_connect(self):
         try:
-            cache.delete(f"online:{user_id}")
-        except ValueError:
-            pass
+            first = await presence_tracker.connect(self.user.id)
+            self.presence_counted = True
+            # first socket of this user: tell contacts they are online
+            if first:
+                await presence_tracker.announce(self.channel_layer, self.user.id, True)
+        except Exception:
+            logger.exception("Presence connect failed")
 
 
   
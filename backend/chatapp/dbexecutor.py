@@ -0,0 +1,140 @@
+"""
+This file contains the executor async code (ChatConsumer, presence,
+write-behind, WebSocket auth) uses for database work.
+
+Django's async ORM methods (aget, acreate, ...) still run each query
+through sync_to_async on the one thread a worker shares for all sync work,
+and they cannot be used inside transaction.atomic(). So the consumer
+answers what it can without the database (acache, cached conversation and
+membership lookups) and sends the rest through db_executor:
+
+- CHAT_DB_THREADS = 0 (default): database_sync_to_async, the single
+  thread per worker used before; tests need it, as they share one
+  connection with the test case
+- CHAT_DB_THREADS = N: a dedicated pool of N threads, each with its own
+  database connection (the database must allow workers * N connections)
+
+Every call is timed (queue wait before it starts, run time after) and
+counted, as an error when it raised a DatabaseError; stats() returns the
+totals for benchmarks, and the chat_db_* histograms in metrics get every
+call.
+"""
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+
+from . import metrics
+
+# Default number of dedicated database threads (0: shared sync thread)
+DEFAULT_DB_THREADS = 0
+
+
+class DatabaseExecutor:
+    """Runs sync database functions for async code and records timings."""
+
+    def __init__(self):
+        self._pool = None
+        self._pool_size = 0
+        self.reset_stats()
+
+    @property
+    def threads(self):
+        return getattr(settings, "CHAT_DB_THREADS", DEFAULT_DB_THREADS)
+
+    def reset_stats(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def stats(self):
+        calls = self.calls or 1
+        return {
+            "threads": self.threads,
+            "calls": self.calls,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "wait_avg_ms": self.wait_total / calls * 1e3,
+            "wait_max_ms": self.wait_max * 1e3,
+            "run_avg_ms": self.run_total / calls * 1e3,
+            "run_max_ms": self.run_max * 1e3,
+        }
+
+    # The dedicated pool, rebuilt when CHAT_DB_THREADS changes
+    def _get_pool(self, threads):
+        if self._pool is None or self._pool_size != threads:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._pool = ThreadPoolExecutor(threads, thread_name_prefix="chat-db")
+            self._pool_size = threads
+        return self._pool
+
+    async def run(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) off the event loop and return its result."""
+        submitted = time.perf_counter()
+        started = None
+
+        def call():
+            nonlocal started
+            started = time.perf_counter()
+            return func(*args, **kwargs)
+
+        # same connection handling as database_sync_to_async
+        def call_with_connections():
+            close_old_connections()
+            try:
+                return call()
+            finally:
+                close_old_connections()
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            threads = self.threads
+            if threads:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._get_pool(threads), call_with_connections
+                )
+            return await database_sync_to_async(call)()
+        except DatabaseError:
+            # Http404 and other exceptions raised by the callable are not database errors
+            self.errors += 1
+            metrics.db_errors.inc()
+            raise
+        finally:
+            finished = time.perf_counter()
+            self.in_flight -= 1
+            self.calls += 1
+            if started is not None:
+                wait, run = started - submitted, finished - started
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.run_total += run
+                self.run_max = max(self.run_max, run)
+                metrics.db_wait_seconds.observe(wait)
+                metrics.db_run_seconds.observe(run)
+
+
+# Shared executor for all async code in this worker
+db_executor = DatabaseExecutor()
+
+
+def db_task(func):
+    """Decorator: like database_sync_to_async, but through db_executor."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await db_executor.run(func, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,145 @@
+"""
+This file contains the per-user cache of the serialized conversation list.
+
+Each user has a version token in the cache ("conv_list_ver:<user_id>");
+the list is stored together with the version it was built for and is only
+served while the two match. Anything that changes a user's list (new
+message, read marker, hidden or new conversation, members) replaces the
+token after commit with bump_list_versions(), one set_many for any number
+of users, so a list built from data read before the change is never
+served again. Every path that creates messages (HTTP post, ChatConsumer,
+the write-behind flush) goes through bump_lists_for_new_messages(), for
+every conversation type.
+
+Online status is not part of the cached state: it is re-read with one
+get_many on every request, and the ETag covers the version plus the set
+of online users, so a 304 means nothing the client shows has changed.
+A conversation is listed for its participants only; global rooms
+usually have none.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import ConversationParticipant
+from .presence import acache, online_key
+
+# Default seconds a cached list (and its version) is kept
+DEFAULT_LIST_CACHE_TIMEOUT = 60 * 60
+
+
+def list_timeout():
+    return getattr(settings, "CHAT_LIST_CACHE_TIMEOUT", DEFAULT_LIST_CACHE_TIMEOUT)
+
+
+# Cache key holding the current list version of a user
+def list_version_key(user_id):
+    return f"conv_list_ver:{user_id}"
+
+
+# Cache key holding {"version", "data"} for a user's serialized list
+def list_key(user_id):
+    return f"conv_list:{user_id}"
+
+
+def new_version():
+    return uuid.uuid4().hex[:16]
+
+
+def bump_list_versions(user_ids):
+    """Mark the cached lists of these users stale (one cache round trip)."""
+    user_ids = set(user_ids)
+    if user_ids:
+        cache.set_many(
+            {list_version_key(uid): new_version() for uid in user_ids},
+            timeout=list_timeout(),
+        )
+
+
+# bump_list_versions once the current transaction commits (right away outside one)
+def bump_list_versions_on_commit(user_ids):
+    user_ids = list(user_ids)
+    transaction.on_commit(lambda: bump_list_versions(user_ids))
+
+
+def bump_lists_for_new_messages(conversation_ids, member_ids=None):
+    """
+    New messages changed the last message (and unread counts) of these
+    conversations in every member's list: bump their versions on commit.
+    member_ids, when the caller already has every member (the sender plus
+    the ids increment_unread returns), saves the participant query.
+    """
+    if member_ids is None:
+        member_ids = ConversationParticipant.objects.filter(
+            conversation_id__in=conversation_ids
+        ).values_list("user_id", flat=True)
+    bump_list_versions_on_commit(member_ids)
+
+
+# bump_list_versions for async code (outside any transaction)
+async def abump_list_versions(user_ids):
+    user_ids = set(user_ids)
+    if user_ids:
+        await acache(
+            "set_many",
+            {list_version_key(uid): new_version() for uid in user_ids},
+            timeout=list_timeout(),
+        )
+
+
+async def aget_cached_list(user_id):
+    """
+    Returns (version, data); data is None when the list must be rebuilt
+    and then stored with astore_list(user_id, version, data).
+    """
+    version_key, key = list_version_key(user_id), list_key(user_id)
+    found = await acache("get_many", [version_key, key])
+    version = found.get(version_key)
+    if version is None:
+        version = new_version()
+        if not await acache("add", version_key, version, timeout=list_timeout()):
+            # another request started a version first
+            version = await acache("get", version_key) or version
+        return version, None
+    entry = found.get(key)
+    if entry is not None and entry["version"] == version:
+        return version, entry["data"]
+    return version, None
+
+
+async def astore_list(user_id, version, data):
+    await acache(
+        "set", list_key(user_id), {"version": version, "data": data}, timeout=list_timeout()
+    )
+
+
+# Every serialized user dict (those carrying is_online) inside the list
+def _user_dicts(value):
+    if isinstance(value, dict):
+        if "is_online" in value and "id" in value:
+            yield value
+        for item in value.values():
+            yield from _user_dicts(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _user_dicts(item)
+
+
+async def arefresh_presence(data):
+    """Overwrite is_online in cached list data with current status (one get_many)."""
+    users = list(_user_dicts(data))
+    if not users:
+        return
+    found = await acache("get_many", list({online_key(u["id"]) for u in users}))
+    for u in users:
+        u["is_online"] = online_key(u["id"]) in found
+
+
+# ETag of a list: its version plus who is shown online
+def list_etag(version, data):
+    online = sorted({u["id"] for u in _user_dicts(data) if u["is_online"]})
+    digest = hashlib.md5(",".join(map(str, online)).encode()).hexdigest()[:12]
+    return f'"{version}-{digest}"'
@@ -0,0 +1,160 @@
+"""
+Benchmark: chat messages per second one worker's ChatConsumer can save
+and broadcast.
+
+Opens --clients sockets (WebsocketCommunicator, in-process), each in its
+own private conversation, and has every client send --messages messages
+as fast as the consumer accepts them; a message counts once its broadcast
+comes back. The run is repeated for each --threads value: 0 is the shared
+database_sync_to_async thread, N a dedicated pool of N database threads
+(CHAT_DB_THREADS). Rate limits are lifted for the run.
+
+The channel layer and cache are in-memory unless --real-backends is given.
+The database is the configured one: with SQLite, writes serialize on the
+database lock whatever the thread count, so compare on PostgreSQL.
+Rows created by the run are deleted afterwards.
+
+Usage:
+    python manage.py bench_consumer
+    python manage.py bench_consumer --clients 200 --messages 20 --threads 0 4 8 --json
+"""
+import asyncio
+import json
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from chatapp.consumers import ChatConsumer
+from chatapp.dbexecutor import db_executor
+from chatapp.models import Conversation, ConversationParticipant
+from chatapp.throttling import typing_coalescer, user_control_limiter, user_rate_limiter
+
+User = get_user_model()
+
+PREFIX = "bench_consumer"
+
+# Settings for every run: no rate limits or write gate in the way
+UNLIMITED = {
+    "CHAT_CONNECTION_MESSAGE_RATE": 1e9,
+    "CHAT_CONNECTION_MESSAGE_BURST": 1e9,
+    "CHAT_USER_MESSAGE_RATE": 1e9,
+    "CHAT_USER_MESSAGE_BURST": 1e9,
+    "CHAT_USER_CONTROL_RATE": 1e9,
+    "CHAT_USER_CONTROL_BURST": 1e9,
+    "CHAT_RATE_LIMIT_GLOBAL": False,
+    "CHAT_MAX_PENDING_WRITES": 1e9,
+    "CHAT_WRITE_BEHIND": False,
+}
+
+IN_MEMORY = {
+    "CACHES": {"default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "OPTIONS": {"MAX_ENTRIES": 1000000},
+    }},
+    "CHANNEL_LAYERS": {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+}
+
+
+class Command(BaseCommand):
+    help = "Measure ChatConsumer messages/sec per worker for database thread settings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=100)
+        parser.add_argument("--messages", type=int, default=20, help="messages per client")
+        parser.add_argument("--threads", type=int, nargs="+", default=[0, 4])
+        parser.add_argument("--real-backends", action="store_true",
+                            help="use the configured cache and channel layer")
+        parser.add_argument("--json", action="store_true", help="print results as JSON")
+
+    def handle(self, *args, **options):
+        overrides = dict(UNLIMITED)
+        if not options["real_backends"]:
+            overrides.update(IN_MEMORY)
+        users, rooms = self.populate(options["clients"])
+        try:
+            results = []
+            for threads in options["threads"]:
+                with override_settings(CHAT_DB_THREADS=threads, **overrides):
+                    user_rate_limiter.clear()
+                    user_control_limiter.clear()
+                    typing_coalescer.clear()
+                    db_executor.reset_stats()
+                    run = asyncio.run(self.run(users, rooms, options["messages"]))
+                    results.append({"threads": threads, **run, "executor": db_executor.stats()})
+        finally:
+            self.cleanup()
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"benchmark": "consumer", "runs": results}))
+            return
+        for row in results:
+            ex = row["executor"]
+            self.stdout.write(
+                f"threads {row['threads']:>3}: {row['messages']} messages in "
+                f"{row['seconds']:.2f} s = {row['messages_per_sec']:8.1f} msg/s   "
+                f"db wait avg {ex['wait_avg_ms']:.2f} ms, run avg {ex['run_avg_ms']:.2f} ms"
+            )
+
+    def populate(self, clients):
+        self.cleanup()
+        User.objects.bulk_create([
+            User(username=f"{PREFIX}_{i}", email=f"{PREFIX}_{i}@example.com")
+            for i in range(clients + 1)
+        ])
+        users = list(User.objects.filter(username__startswith=f"{PREFIX}_").order_by("id"))
+        partner, senders = users[0], users[1:]
+        Conversation.objects.bulk_create([
+            Conversation(slug=f"{PREFIX}_{i}", type=Conversation.TYPE_PRIVATE)
+            for i in range(clients)
+        ])
+        rooms = list(Conversation.objects.filter(slug__startswith=f"{PREFIX}_").order_by("id"))
+        ConversationParticipant.objects.bulk_create([
+            ConversationParticipant(conversation=room, user=u)
+            for room, sender in zip(rooms, senders)
+            for u in (sender, partner)
+        ])
+        return senders, rooms
+
+    def cleanup(self):
+        # messages and participants go with their conversation
+        Conversation.objects.filter(slug__startswith=f"{PREFIX}_").delete()
+        User.objects.filter(username__startswith=f"{PREFIX}_").delete()
+
+    async def run(self, users, rooms, messages):
+        sockets = []
+        for user, room in zip(users, rooms):
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{room.id}/")
+            communicator.scope["user"] = user
+            communicator.scope["url_route"] = {"kwargs": {"conversation_id": str(room.id)}}
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError("socket rejected")
+            await communicator.receive_json_from()  # connection_established
+            sockets.append(communicator)
+
+        async def client(communicator):
+            for i in range(messages):
+                await communicator.send_json_to({"type": "chat_message", "content": f"m{i}"})
+            received = 0
+            while received < messages:
+                frame = await communicator.receive_json_from(timeout=60)
+                if frame["type"] == "new_message":
+                    received += 1
+                elif frame["type"] == "error":
+                    raise RuntimeError(frame["message"])
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(c) for c in sockets))
+        seconds = time.perf_counter() - start
+        for communicator in sockets:
+            await communicator.disconnect()
+
+        total = len(sockets) * messages
+        return {
+            "messages": total,
+            "seconds": seconds,
+            "messages_per_sec": total / seconds if seconds else 0.0,
+        }
@@ -0,0 +1,149 @@
+"""
+Benchmark: loading a page of messages for a user with many "delete for
+me" records.
+
+Builds a user with --deletions hidden messages spread over --rooms rooms,
+plus one room without deletions (inside a transaction that is rolled
+back), then times:
+- a message page of the clean room with the old NOT IN filter
+  (exclude(deletions__user=...)) against the per-row NOT EXISTS used by
+  views.visible_messages; the cost should not follow deletions elsewhere
+- the deletions of one room after a seq (sync API) through a join on
+  Message against the denormalized MessageDeletion.conversation column
+
+Usage:
+    python manage.py bench_deletions
+    python manage.py bench_deletions --deletions 100000 --rooms 20 --repeat 20 --json
+"""
+import json
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chatapp.models import Conversation, ConversationParticipant, Message, MessageDeletion
+from chatapp.views import visible_messages
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Measure message page cost against the number of deleted-for-me messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--deletions", type=int, default=100000)
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--visible", type=int, default=100, help="visible messages per room")
+        parser.add_argument("--page-size", type=int, default=50)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--json", action="store_true", help="print results as JSON")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user, room, clean_room = self.populate(options)
+            results = self.measure(user, room, clean_room, options)
+            # leave the database as it was
+            transaction.set_rollback(True)
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"benchmark": "deletions", **results}))
+            return
+        self.stdout.write(f"deletions: {results['deletions']} over {results['rooms']} rooms")
+        for name, row in results["queries"].items():
+            self.stdout.write(
+                f"{name:>10}: legacy {row['legacy_ms']:8.2f} ms   "
+                f"current {row['current_ms']:8.2f} ms   {row['speedup']:6.1f}x"
+            )
+
+    def populate(self, options):
+        user = User.objects.create(username="bench_deleter", email="bench_deleter@example.com")
+        other = User.objects.create(username="bench_sender", email="bench_sender@example.com")
+        per_room = options["deletions"] // options["rooms"]
+        rooms = []
+        # the last room is the clean one
+        for r in range(options["rooms"] + 1):
+            hidden_count = per_room if r < options["rooms"] else 0
+            room = Conversation.objects.create(slug=f"bench_del_{r}", type=Conversation.TYPE_PRIVATE)
+            ConversationParticipant.objects.bulk_create([
+                ConversationParticipant(conversation=room, user=user),
+                ConversationParticipant(conversation=room, user=other),
+            ])
+            total = hidden_count + options["visible"]
+            Message.objects.bulk_create(
+                [
+                    Message(conversation=room, sender=other, content="x", seq=i + 1)
+                    for i in range(total)
+                ],
+                batch_size=5000,
+            )
+            room.last_seq = total
+            room.save(update_fields=["last_seq"])
+            # hide the newest messages, so the page has to skip past them
+            hidden = (
+                Message.objects.filter(conversation=room)
+                .order_by("-seq")
+                .values_list("id", "seq")[:hidden_count]
+            )
+            MessageDeletion.objects.bulk_create(
+                [
+                    MessageDeletion(message_id=mid, user=user, conversation=room, seq=seq)
+                    for mid, seq in hidden
+                ],
+                batch_size=5000,
+            )
+            rooms.append(room)
+        return user, rooms[0], rooms[-1]
+
+    def measure(self, user, room, clean_room, options):
+        size = options["page_size"]
+        since = room.last_seq // 2
+
+        def legacy_page():
+            qs = clean_room.messages.select_related("sender").exclude(deletions__user=user)
+            return list(qs.order_by("-timestamp", "-id")[:size])
+
+        def current_page():
+            qs = visible_messages(clean_room, user.id)
+            return list(qs.order_by("-timestamp", "-id")[:size])
+
+        def legacy_sync():
+            return list(
+                MessageDeletion.objects.filter(
+                    user=user, message__conversation=room, seq__gt=since
+                ).values_list("message_id", flat=True)
+            )
+
+        def current_sync():
+            return list(
+                MessageDeletion.objects.filter(
+                    user=user, conversation=room, seq__gt=since
+                ).values_list("message_id", flat=True)
+            )
+
+        assert [m.id for m in legacy_page()] == [m.id for m in current_page()]
+        queries = {}
+        for name, legacy, current in (
+            ("page", legacy_page, current_page),
+            ("sync", legacy_sync, current_sync),
+        ):
+            legacy_s = self.time_per_call(legacy, options["repeat"])
+            current_s = self.time_per_call(current, options["repeat"])
+            queries[name] = {
+                "legacy_ms": legacy_s * 1e3,
+                "current_ms": current_s * 1e3,
+                "speedup": legacy_s / current_s if current_s else 0.0,
+            }
+        return {
+            "deletions": MessageDeletion.objects.filter(user=user).count(),
+            "rooms": options["rooms"],
+            "queries": queries,
+        }
+
+    # Average wall time of one call
+    def time_per_call(self, func, repeat):
+        func()  # warm up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat
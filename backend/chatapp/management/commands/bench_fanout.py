@@ -0,0 +1,125 @@
+"""
+Benchmark: CPU time per group broadcast against room size.
+
+Compares the old receiver side (every socket builds and JSON-encodes its
+own frame) with the encode-once path (the sender encodes the frame in
+messaging.group_event and every socket forwards the text unchanged).
+
+Usage:
+    python manage.py bench_fanout
+    python manage.py bench_fanout --sizes 10 100 1000 --repeat 50 --json
+"""
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatapp.consumers import ChatConsumer
+from chatapp.messaging import message_event
+
+
+# Message payload shaped like MessageSerializer output
+def sample_message(content_length):
+    return {
+        "id": 123456,
+        "conversation": 1,
+        "sender": {
+            "id": 42,
+            "username": "someone",
+            "first_name": "Some",
+            "last_name": "One",
+            "is_online": True,
+        },
+        "content": "x" * content_length,
+        "timestamp": "2026-01-01T12:00:00.000000Z",
+        "seq": 1000,
+    }
+
+
+# Receiver handler before encode-once: build and encode the frame per socket
+async def legacy_chat_message_broadcast(consumer, event):
+    await consumer.send(
+        text_data=json.dumps(
+            {
+                "type": "new_message",
+                "conversation_id": event["conversation_id"],
+                "seq": event["seq"],
+                "message": event["message"],
+            }
+        )
+    )
+
+
+class Command(BaseCommand):
+    help = "Measure CPU time per broadcast against room size"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000, 5000])
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--content-length", type=int, default=200)
+        parser.add_argument("--json", action="store_true", help="print results as JSON")
+
+    def handle(self, *args, **options):
+        message = sample_message(options["content_length"])
+        results = [
+            asyncio.run(self.measure(size, options["repeat"], message))
+            for size in options["sizes"]
+        ]
+        if options["json"]:
+            self.stdout.write(json.dumps({"benchmark": "fanout", "results": results}))
+            return
+        self.stdout.write(f"{'room size':>10} {'legacy us':>12} {'encode-once us':>15} {'speedup':>8}")
+        for row in results:
+            self.stdout.write(
+                f"{row['room_size']:>10} {row['legacy_cpu_us']:>12.1f} "
+                f"{row['encode_once_cpu_us']:>15.1f} {row['speedup']:>7.1f}x"
+            )
+
+    async def measure(self, size, repeat, message):
+        sent = []
+
+        # socket output is collected instead of written to a transport
+        async def sink(text_data=None, bytes_data=None, close=False):
+            sent.append(text_data)
+
+        consumers = []
+        for _ in range(size):
+            consumer = ChatConsumer()
+            consumer.send = sink
+            consumers.append(consumer)
+
+        legacy_event = {
+            "type": "chat_message_broadcast",
+            "conversation_id": message["conversation"],
+            "seq": message["seq"],
+            "message": message,
+        }
+
+        async def legacy():
+            for consumer in consumers:
+                await legacy_chat_message_broadcast(consumer, legacy_event)
+
+        async def encode_once():
+            # sender cost is included: one encode per broadcast
+            event = message_event(message)
+            for consumer in consumers:
+                await consumer.chat_message_broadcast(event)
+
+        legacy_cpu = await self.cpu_per_call(legacy, repeat)
+        sent.clear()
+        encode_once_cpu = await self.cpu_per_call(encode_once, repeat)
+        return {
+            "room_size": size,
+            "legacy_cpu_us": legacy_cpu * 1e6,
+            "encode_once_cpu_us": encode_once_cpu * 1e6,
+            "speedup": legacy_cpu / encode_once_cpu if encode_once_cpu else 0.0,
+        }
+
+    # Average process CPU time of one call
+    async def cpu_per_call(self, func, repeat):
+        await func()  # warm up
+        start = time.process_time()
+        for _ in range(repeat):
+            await func()
+        return (time.process_time() - start) / repeat
@@ -0,0 +1,321 @@
+"""
+Benchmark: end-to-end load test of the WebSocket stack.
+
+Drives the full ASGI application (chatproject.asgi: JWT middleware, URL
+router, ChatConsumer) in-process with --clients simulated users. Users
+are put in group rooms of --room-size members, each holds one socket to
+its room and, until --duration runs out, acts at random intervals
+(--rate actions per second on average) picking from the mix:
+
+- send: a chat_message; its delivery latency is measured on every socket
+  of the room that receives the broadcast, the sender's own included
+- typing: a typing frame
+- reconnect: close the socket and open it again (handshake timed)
+
+The report gives p50/p90/p99/max delivery and connect latency, messages
+and deliveries per second, error frames by code, and the CPU used by the
+process. Load generator and server share one process and event loop, so
+CPU and latency include the clients' own work: treat the numbers as a
+worker's upper bound and compare runs against each other.
+
+The channel layer and cache are in-memory unless --real-backends is given
+(e.g. a local Redis); the database is the configured one. Rate limits are
+lifted for the run. Rows created by the run are deleted afterwards.
+
+Usage:
+    python manage.py bench_load
+    python manage.py bench_load --clients 2000 --room-size 20 --duration 30 \\
+        --mix 0.8 0.15 0.05 --threads 4 --json --output load.json
+"""
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import time
+from collections import Counter
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chatapp.dbexecutor import db_executor
+from chatapp.management.commands.bench_consumer import IN_MEMORY, UNLIMITED
+from chatapp.middleware import token_user_cache
+from chatapp.models import Conversation, ConversationParticipant
+from chatapp.throttling import typing_coalescer, user_control_limiter, user_rate_limiter
+
+User = get_user_model()
+
+PREFIX = "bench_load"
+
+ACTIONS = ("send", "typing", "reconnect")
+
+
+# Nearest-rank percentile of an already sorted list, in milliseconds
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))] * 1e3
+
+
+def latency_summary(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 0.50),
+        "p90_ms": percentile(values, 0.90),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": values[-1] * 1e3 if values else None,
+    }
+
+
+class LoadRun:
+    """State shared by all simulated clients of one run."""
+
+    def __init__(self, application, options):
+        self.application = application
+        self.duration = options["duration"]
+        self.rate = options["rate"]
+        self.mix = options["mix"]
+        self.drain = options["drain"]
+        self.connect_slots = asyncio.Semaphore(options["connect_concurrency"])
+        # content -> perf_counter() when sent; contents the sender has not seen back yet
+        self.sent_at = {}
+        self.unechoed = set()
+        self.delivery = []
+        self.connect = []
+        self.counts = Counter()
+        self.errors = Counter()
+
+    async def open(self, path):
+        async with self.connect_slots:
+            start = time.perf_counter()
+            communicator = WebsocketCommunicator(self.application, path)
+            connected, code = await communicator.connect(timeout=30)
+            if not connected:
+                self.errors[f"rejected_{code}"] += 1
+                return None
+            frame = json.loads(await communicator.receive_from(timeout=30))
+            if frame["type"] != "connection_established":
+                self.errors["handshake"] += 1
+            self.connect.append(time.perf_counter() - start)
+            return communicator
+
+    async def read(self, communicator):
+        while True:
+            frame = json.loads(await communicator.receive_from(timeout=3600))
+            kind = frame["type"]
+            self.counts[f"received_{kind}"] += 1
+            if kind == "new_message":
+                content = frame["message"]["content"]
+                sent = self.sent_at.get(content)
+                if sent is not None:
+                    self.delivery.append(time.perf_counter() - sent)
+                    self.unechoed.discard(content)
+            elif kind == "error":
+                self.errors[frame.get("code") or frame.get("message", "error")] += 1
+
+    async def client(self, index, path, communicator, deadline):
+        rng = random.Random(index)
+        if communicator is None:
+            return
+        reader = asyncio.create_task(self.read(communicator))
+        sent = 0
+        try:
+            while True:
+                # Poisson arrivals: exponential gaps at --rate per second
+                wait = rng.expovariate(self.rate)
+                if time.perf_counter() + wait >= deadline:
+                    break
+                await asyncio.sleep(wait)
+                action = rng.choices(ACTIONS, weights=self.mix)[0]
+                self.counts[action] += 1
+                if action == "send":
+                    content = f"{PREFIX}:{index}:{sent}"
+                    sent += 1
+                    self.sent_at[content] = time.perf_counter()
+                    self.unechoed.add(content)
+                    await communicator.send_json_to({"type": "chat_message", "content": content})
+                elif action == "typing":
+                    await communicator.send_json_to({"type": "typing", "is_typing": True})
+                else:
+                    reader.cancel()
+                    await communicator.disconnect()
+                    communicator = await self.open(path)
+                    if communicator is None:
+                        return
+                    reader = asyncio.create_task(self.read(communicator))
+            # let the last broadcasts arrive before closing
+            until = time.perf_counter() + self.drain
+            while self.unechoed and time.perf_counter() < until:
+                await asyncio.sleep(0.05)
+        finally:
+            reader.cancel()
+            if communicator is not None:
+                await communicator.disconnect()
+
+    async def run(self, paths):
+        """Connect every client, then run the load; returns (wall, cpu) seconds of the load."""
+        sockets = await asyncio.gather(*(self.open(path) for path in paths))
+        cpu_start, start = time.process_time(), time.perf_counter()
+        deadline = start + self.duration
+        await asyncio.gather(*(
+            self.client(i, path, communicator, deadline)
+            for i, (path, communicator) in enumerate(zip(paths, sockets))
+        ))
+        return time.perf_counter() - start, time.process_time() - cpu_start
+
+
+class Command(BaseCommand):
+    help = "Load-test the WebSocket stack and report latency, throughput and CPU as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=1000)
+        parser.add_argument("--room-size", type=int, default=10, help="users per group room")
+        parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+        parser.add_argument("--rate", type=float, default=0.5,
+                            help="actions per client per second (average)")
+        parser.add_argument("--mix", type=float, nargs=3, default=[0.8, 0.15, 0.05],
+                            metavar=("SEND", "TYPING", "RECONNECT"),
+                            help="relative weights of the actions")
+        parser.add_argument("--drain", type=float, default=5.0,
+                            help="seconds to wait for outstanding broadcasts")
+        parser.add_argument("--connect-concurrency", type=int, default=200,
+                            help="handshakes in flight at once")
+        parser.add_argument("--threads", type=int, default=0, help="CHAT_DB_THREADS")
+        parser.add_argument("--write-behind", action="store_true", help="CHAT_WRITE_BEHIND")
+        parser.add_argument("--real-backends", action="store_true",
+                            help="use the configured cache and channel layer")
+        parser.add_argument("--json", action="store_true", help="print results as JSON")
+        parser.add_argument("--output", help="also write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        if options["clients"] < 1 or options["room_size"] < 1 or options["rate"] <= 0:
+            raise CommandError("--clients, --room-size and --rate must be positive")
+        if sum(options["mix"]) <= 0:
+            raise CommandError("--mix needs a positive weight")
+
+        overrides = dict(UNLIMITED, CHAT_DB_THREADS=options["threads"],
+                         CHAT_WRITE_BEHIND=options["write_behind"])
+        if not options["real_backends"]:
+            overrides.update(IN_MEMORY)
+
+        paths = self.populate(options["clients"], options["room_size"])
+        try:
+            with override_settings(**overrides):
+                results = self.measure(paths, options)
+        finally:
+            self.cleanup()
+
+        report = {
+            "benchmark": "load",
+            "config": {
+                key: options[key]
+                for key in ("clients", "room_size", "duration", "rate", "mix", "drain",
+                            "threads", "write_behind", "real_backends")
+            },
+            "results": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        self.write_summary(results)
+
+    def measure(self, paths, options):
+        # imported here: building the ASGI application sets up Django's handler
+        from chatproject.asgi import application
+
+        user_rate_limiter.clear()
+        user_control_limiter.clear()
+        typing_coalescer.clear()
+        token_user_cache.clear()
+        db_executor.reset_stats()
+        run = LoadRun(application, options)
+
+        # ChatConsumer prints a DEBUG line per frame; keep them out of the timing
+        with contextlib.redirect_stdout(io.StringIO()):
+            wall, cpu = asyncio.run(run.run(paths))
+
+        # rates over the load window; wall also covers the final drain
+        window = min(wall, options["duration"])
+        messages = run.counts["send"]
+        deliveries = len(run.delivery)
+        return {
+            "seconds": wall,
+            "actions": {action: run.counts[action] for action in ACTIONS},
+            "messages_sent": messages,
+            "messages_echoed": messages - len(run.unechoed),
+            "deliveries": deliveries,
+            "messages_per_sec": messages / window,
+            "deliveries_per_sec": deliveries / window,
+            "delivery_latency": latency_summary(run.delivery),
+            "connect_latency": latency_summary(run.connect),
+            "frames_received": {
+                key.removeprefix("received_"): value
+                for key, value in sorted(run.counts.items()) if key.startswith("received_")
+            },
+            "errors": dict(run.errors),
+            "cpu": {
+                "seconds": cpu,
+                "percent_of_one_core": cpu / wall * 100,
+                "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "pid": os.getpid(),
+            },
+            "executor": db_executor.stats(),
+        }
+
+    def write_summary(self, results):
+        delivery, connect, cpu = (
+            results["delivery_latency"], results["connect_latency"], results["cpu"]
+        )
+        self.stdout.write(
+            f"{results['messages_sent']} messages ({results['messages_echoed']} echoed), "
+            f"{results['deliveries']} deliveries in {results['seconds']:.2f} s: "
+            f"{results['messages_per_sec']:.1f} msg/s, "
+            f"{results['deliveries_per_sec']:.1f} deliveries/s"
+        )
+        for name, summary in (("delivery", delivery), ("connect", connect)):
+            if summary["count"]:
+                self.stdout.write(
+                    f"{name:>8} latency: p50 {summary['p50_ms']:.1f} ms, "
+                    f"p90 {summary['p90_ms']:.1f} ms, p99 {summary['p99_ms']:.1f} ms, "
+                    f"max {summary['max_ms']:.1f} ms ({summary['count']})"
+                )
+        self.stdout.write(
+            f"cpu {cpu['seconds']:.2f} s = {cpu['percent_of_one_core']:.0f}% of one core; "
+            f"errors {results['errors'] or 'none'}"
+        )
+
+    def populate(self, clients, room_size):
+        self.cleanup()
+        User.objects.bulk_create([
+            User(username=f"{PREFIX}_{i}", email=f"{PREFIX}_{i}@example.com")
+            for i in range(clients)
+        ])
+        users = list(User.objects.filter(username__startswith=f"{PREFIX}_").order_by("id"))
+        rooms_needed = (clients + room_size - 1) // room_size
+        Conversation.objects.bulk_create([
+            Conversation(slug=f"{PREFIX}_{i}", type=Conversation.TYPE_GROUP, name=f"{PREFIX} {i}")
+            for i in range(rooms_needed)
+        ])
+        rooms = list(Conversation.objects.filter(slug__startswith=f"{PREFIX}_").order_by("id"))
+        members = [(rooms[i // room_size], user) for i, user in enumerate(users)]
+        ConversationParticipant.objects.bulk_create([
+            ConversationParticipant(conversation=room, user=user) for room, user in members
+        ])
+        return [
+            f"/ws/chat/{room.id}/?token={AccessToken.for_user(user)}" for room, user in members
+        ]
+
+    def cleanup(self):
+        # messages and participants go with their conversation
+        Conversation.objects.filter(slug__startswith=f"{PREFIX}_").delete()
+        User.objects.filter(username__startswith=f"{PREFIX}_").delete()
@@ -0,0 +1,108 @@
+"""
+This file contains membership checks for conversations.
+Checks are answered from a short-lived cache entry per (conversation, user),
+backed by the unique (conversation, user) index on ConversationParticipant,
+so large group rooms do not hit the database on every message.
+
+For sockets, aget_conversation() and ais_member() answer from the cache
+in async code and only use the database executor on a miss. Unknown
+conversation ids and slugs are cached too (for the membership TTL), so
+probing them does not reach the database every time; creating a
+conversation drops that answer (forget_conversation).
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from .dbexecutor import db_executor
+from .models import Conversation, ConversationParticipant
+from .presence import acache
+
+# Default seconds a membership answer is cached
+DEFAULT_MEMBERSHIP_TTL = 60
+
+# Seconds a conversation snapshot is cached (the fields kept never change)
+CONVERSATION_CACHE_TIMEOUT = 60 * 60
+
+# Cached in place of a snapshot for a conversation that does not exist
+MISSING = "missing"
+
+# Conversation fields kept in the cached snapshot
+CONVERSATION_FIELDS = ("id", "slug", "type", "name", "created_at")
+
+
+# Cache key holding whether a user belongs to a conversation
+def member_key(conversation_id, user_id):
+    return f"member:{conversation_id}:{user_id}"
+
+
+# Cache key holding the snapshot of a conversation, by id or by slug
+def conversation_key(ref):
+    if isinstance(ref, int):
+        return f"conv_id:{ref}"
+    return f"conv_slug:{ref}"
+
+
+def is_member(conversation_id, user_id):
+    """Return True if the user has a participant row in the conversation."""
+    key = member_key(conversation_id, user_id)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    return load_membership(conversation_id, user_id)
+
+
+# Read membership from the database and cache the answer
+def load_membership(conversation_id, user_id):
+    key = member_key(conversation_id, user_id)
+    found = ConversationParticipant.objects.filter(
+        conversation_id=conversation_id, user_id=user_id
+    ).exists()
+    ttl = getattr(settings, "CHAT_MEMBERSHIP_TTL", DEFAULT_MEMBERSHIP_TTL)
+    cache.set(key, found, timeout=ttl)
+    return found
+
+
+# Drop cached answers after members are added or removed
+def forget_membership(conversation_id, user_ids):
+    cache.delete_many([member_key(conversation_id, uid) for uid in user_ids])
+
+
+# Drop cached answers for a new conversation (it may have been looked up
+# and found missing before)
+def forget_conversation(conversation):
+    cache.delete_many([conversation_key(conversation.id), conversation_key(conversation.slug)])
+
+
+# is_member for async code: one cache read, the database only on a miss
+async def ais_member(conversation_id, user_id):
+    cached = await acache("get", member_key(conversation_id, user_id))
+    if cached is not None:
+        return cached
+    return await db_executor.run(load_membership, conversation_id, user_id)
+
+
+def load_conversation_snapshot(ref):
+    lookup = {"id": ref} if isinstance(ref, int) else {"slug": ref}
+    return Conversation.objects.filter(**lookup).values(*CONVERSATION_FIELDS).first()
+
+
+async def aget_conversation(ref):
+    """
+    Conversation by id or slug for async code, from a cached snapshot
+    (id, slug, type, name, created_at only, so it must never be saved);
+    None if it does not exist.
+    """
+    key = conversation_key(ref)
+    snapshot = await acache("get", key)
+    if snapshot is None:
+        snapshot = await db_executor.run(load_conversation_snapshot, ref)
+        if snapshot is None:
+            ttl = getattr(settings, "CHAT_MEMBERSHIP_TTL", DEFAULT_MEMBERSHIP_TTL)
+            await acache("set", key, MISSING, timeout=ttl)
+            return None
+        await acache("set", key, snapshot, timeout=CONVERSATION_CACHE_TIMEOUT)
+    if snapshot == MISSING:
+        return None
+    conversation = Conversation(**snapshot)
+    conversation._state.adding = False
+    return conversation
@@ -0,0 +1,255 @@
+"""
+This file contains helpers shared by the REST views and the WebSocket
+consumer for creating messages and building their broadcast events.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.db import connection, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import metrics
+from .models import Conversation, ConversationParticipant, Message, MessageDeletion
+
+logger = logging.getLogger(__name__)
+
+
+# Reserve the next `count` sequence numbers of a conversation and return the
+# last one (locks its row until commit)
+def next_seq(conversation_id, count=1):
+    Conversation.objects.filter(pk=conversation_id).update(
+        last_seq=F("last_seq") + count, updated_at=timezone.now()
+    )
+    return (
+        Conversation.objects.filter(pk=conversation_id)
+        .values_list("last_seq", flat=True)
+        .get()
+    )
+
+
+def allocate_seq(conversation, count=1):
+    """
+    Next sequence number of a conversation, for a message (with count > 1,
+    the last of a block of numbers). Call inside a transaction.
+    Write-behind rooms use the shared cache counter (like messages queued
+    by ChatConsumer) and only raise last_seq.
+    """
+    from .writebehind import reserve_seq, uses_write_behind
+
+    if not uses_write_behind(conversation):
+        return next_seq(conversation.id, count)
+    seq = reserve_seq(conversation.id, count)
+    Conversation.objects.filter(pk=conversation.id).update(
+        last_seq=Greatest(F("last_seq"), seq), updated_at=timezone.now()
+    )
+    return seq
+
+
+# Record a change to a conversation's messages that takes no sequence
+# number (e.g. a hard delete), so ETags of cached pages change
+def touch_conversation(conversation_id):
+    Conversation.objects.filter(pk=conversation_id).update(updated_at=timezone.now())
+
+
+def current_seq(conversation):
+    """
+    Last sequence number handed out in a conversation, to stamp a "delete
+    for me" with: it only concerns one user, so it takes no number of its
+    own and other members see no gap in the message seqs. Call inside a
+    transaction; touching the row waits for messages being created.
+    """
+    from .writebehind import peek_seq, uses_write_behind
+
+    touch_conversation(conversation.id)
+    last_seq = (
+        Conversation.objects.filter(pk=conversation.id)
+        .values_list("last_seq", flat=True)
+        .get()
+    )
+    if uses_write_behind(conversation):
+        # queued messages are numbered ahead of last_seq
+        last_seq = max(last_seq, peek_seq(conversation.id))
+    return last_seq
+
+
+def create_message(conversation, sender, content):
+    """Create a message stamped with the next sequence number of its conversation."""
+    # no savepoint inside a caller's transaction: a failure aborts it anyway
+    with transaction.atomic(savepoint=False):
+        return Message.objects.create(
+            conversation=conversation,
+            sender=sender,
+            content=content,
+            seq=allocate_seq(conversation),
+        )
+
+
+def delete_for_me(message, user):
+    """
+    Hide a message for one user, stamped with the current sequence number
+    of its conversation. Returns False if it was already hidden.
+    """
+    # get_or_create inserts in its own transaction (the seq is only read
+    # then) and looks the row up again when a concurrent request won the race
+    _, created = MessageDeletion.objects.get_or_create(
+        message=message,
+        user=user,
+        defaults={
+            "conversation_id": message.conversation_id,
+            "seq": lambda: current_seq(message.conversation),
+        },
+    )
+    return created
+
+
+def delete_many_for_me(conversation, user, message_ids):
+    """
+    Hide many messages of a conversation for one user with a fixed number
+    of queries. Ids of other conversations and messages already hidden are
+    skipped. Returns the ids hidden now (a message hidden at the same time
+    by another request may be reported by both).
+    """
+    with transaction.atomic():
+        ids = set(
+            Message.objects.filter(conversation=conversation, id__in=message_ids)
+            .order_by()
+            .values_list("id", flat=True)
+        )
+        ids -= set(
+            MessageDeletion.objects.filter(user=user, message_id__in=ids)
+            .values_list("message_id", flat=True)
+        )
+        if not ids:
+            return []
+        ids = sorted(ids)
+        seq = current_seq(conversation)
+        # a concurrent delete_for_me may insert one of them after the read
+        # above: skip it instead of failing on the unique constraint
+        MessageDeletion.objects.bulk_create([
+            MessageDeletion(
+                message_id=message_id,
+                user=user,
+                conversation=conversation,
+                seq=seq,
+            )
+            for message_id in ids
+        ], ignore_conflicts=True)
+        return ids
+
+
+# Whether the database can return rows from an UPDATE (PostgreSQL, SQLite 3.35+)
+def update_returning_supported():
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+def increment_unread(conversation_id, sender_id):
+    """
+    Add one unread message for every participant except the sender.
+    Returns [(user_id, unread_count), ...] with the new counts, using a
+    single UPDATE ... RETURNING (UPDATE then SELECT where not supported).
+    """
+    if update_returning_supported():
+        table = ConversationParticipant._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET unread_count = unread_count + 1 "
+                "WHERE conversation_id = %s AND user_id <> %s "
+                "RETURNING user_id, unread_count",
+                [conversation_id, sender_id],
+            )
+            return cursor.fetchall()
+
+    others = ConversationParticipant.objects.filter(
+        conversation_id=conversation_id
+    ).exclude(user_id=sender_id)
+    others.update(unread_count=F("unread_count") + 1)
+    return list(others.values_list("user_id", "unread_count"))
+
+
+def increment_unread_many(conversation_id, sender_counts):
+    """
+    Add a batch of messages to the unread counts of a conversation in one
+    UPDATE. sender_counts is {sender_id: messages sent}; every participant
+    gets the messages sent by the others.
+    """
+    total = sum(sender_counts.values())
+    ConversationParticipant.objects.filter(conversation_id=conversation_id).update(
+        unread_count=F("unread_count") + Case(
+            *[
+                When(user_id=sender_id, then=Value(total - count))
+                for sender_id, count in sender_counts.items()
+            ],
+            default=Value(total),
+        )
+    )
+
+
+async def group_send(channel_layer, group, event):
+    """channel_layer.group_send, timed into metrics.group_send_seconds."""
+    start = time.perf_counter()
+    try:
+        await channel_layer.group_send(group, event)
+    finally:
+        metrics.group_send_seconds.observe(time.perf_counter() - start)
+
+
+async def asend_group_events(events, channel_layer=None):
+    """
+    Send [(group, event), ...] through the channel layer (the default one
+    unless given) with all group_send calls in flight together. Errors are
+    logged, not raised.
+    """
+    if not events:
+        return
+    channel_layer = channel_layer or get_channel_layer()
+    results = await asyncio.gather(
+        *(group_send(channel_layer, group, event) for group, event in events),
+        return_exceptions=True,
+    )
+    for (group, _), result in zip(events, results):
+        if isinstance(result, Exception):
+            logger.error("Error broadcasting to group %s: %s", group, result)
+
+
+def group_event(handler, frame, **extra):
+    """
+    Channel layer event for ChatConsumer.<handler>.
+    The client frame is JSON-encoded once here by the sender and carried as
+    "text"; receivers forward it unchanged instead of re-encoding per socket.
+    Extra keys are for cheap receiver-side checks (e.g. typing self-filter).
+    """
+    return {"type": handler, "text": json.dumps(frame), **extra}
+
+
+# Event telling a user's sockets the new unread count of a conversation
+def chat_list_event(conversation_id, unread_count):
+    return group_event(
+        "chat_list_update",
+        {
+            "type": "chat_list_update",
+            "conversation_id": conversation_id,
+            "unread_count": unread_count,
+        },
+    )
+
+
+# Event carrying a serialized message to the chat_<id> group
+def message_event(message_data):
+    return group_event(
+        "chat_message_broadcast",
+        {
+            "type": "new_message",
+            "conversation_id": message_data["conversation"],
+            "seq": message_data["seq"],
+            "message": message_data,
+        },
+    )
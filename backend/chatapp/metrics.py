@@ -0,0 +1,255 @@
+"""
+This file contains the worker's metrics and their Prometheus text export.
+
+Metrics are plain in-process counters, gauges and histograms: recording
+one is a dict update (plus a bisect for histograms), with no I/O and no
+locks, so they stay on in production. Values recorded from sync threads
+may rarely lose an increment under contention; that is accepted.
+
+Every worker publishes a snapshot of its metrics to the cache at most
+once per CHAT_METRICS_PUBLISH_INTERVAL seconds, from its event loop
+(maybe_publish() is called on the hot async paths and only compares a
+timestamp). /api/metrics/ (admin users only) renders the snapshots of all
+live workers with a "worker" label, so a scrape through any worker sees
+the whole deployment; sum() over the label for totals.
+CHAT_METRICS = False stops recording and publishing.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Default seconds between snapshots a worker publishes to the cache
+DEFAULT_PUBLISH_INTERVAL = 15
+
+# Histogram buckets in seconds (1 ms .. 10 s)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Cache key listing the workers that published a snapshot
+WORKERS_KEY = "metrics_workers"
+
+
+def metrics_enabled():
+    return getattr(settings, "CHAT_METRICS", True)
+
+
+def publish_interval():
+    return getattr(settings, "CHAT_METRICS_PUBLISH_INTERVAL", DEFAULT_PUBLISH_INTERVAL)
+
+
+# This worker in the "worker" label (read per call: servers may fork after import)
+def current_worker():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# Cache key holding a worker's latest snapshot
+def worker_key(worker_id):
+    return f"metrics_worker:{worker_id}"
+
+
+class Metric:
+    """Base of the metric types: a name, help text and label names."""
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = defaultdict(float)  # label values -> value
+        registry.append(self)
+
+    # Label values as a dict, for the sample lines
+    def label_dict(self, values):
+        return dict(zip(self.labels, values))
+
+    # [(sample name, labels, value), ...] for the snapshot
+    def samples(self):
+        return [(self.name, self.label_dict(key), value) for key, value in self.values.items()]
+
+    def reset(self):
+        self.values.clear()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        if metrics_enabled():
+            self.values[labels] += amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        if metrics_enabled():
+            self.values[labels] += amount
+
+    def dec(self, *labels, amount=1):
+        if metrics_enabled():
+            self.values[labels] -= amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        if not metrics_enabled():
+            return
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for key, counts in self.values.items():
+            labels = self.label_dict(key)
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                samples.append((f"{self.name}_bucket", {**labels, "le": str(bound)}, total))
+            samples.append((f"{self.name}_sum", labels, counts[-1]))
+            samples.append((f"{self.name}_count", labels, total))
+        return samples
+
+
+# Every metric of this worker, in definition order
+registry = []
+
+ws_connections = Gauge("chat_ws_connections", "Open WebSocket connections")
+ws_connects = Counter(
+    "chat_ws_connects_total", "WebSocket handshakes by result", ["result"]
+)
+ws_frames = Counter(
+    "chat_ws_frames_total", "Frames received from clients by type", ["type"]
+)
+group_send_seconds = Histogram(
+    "chat_group_send_seconds", "Time of one channel layer group_send"
+)
+message_save_seconds = Histogram(
+    "chat_message_save_seconds",
+    "Time to save a message, database queue wait included",
+    ["source"],
+)
+db_wait_seconds = Histogram(
+    "chat_db_wait_seconds", "Time database work waited for a db_executor thread"
+)
+db_run_seconds = Histogram("chat_db_run_seconds", "Time of database work in db_executor")
+db_errors = Counter("chat_db_errors_total", "db_executor calls that raised a DatabaseError")
+cache_ops = Counter(
+    "chat_cache_ops_total", "Cache calls from async code (presence, auth, lists)", ["op"]
+)
+auth_results = Counter(
+    "chat_auth_total", "Bearer token lookups by result", ["result"]
+)
+http_requests = Counter(
+    "chat_http_requests_total", "Requests to the async views", ["view", "method", "status"]
+)
+http_seconds = Histogram(
+    "chat_http_request_seconds", "Time to handle a request to an async view", ["view"]
+)
+
+
+def snapshot():
+    """This worker's metrics as [(name, type, documentation, samples), ...]."""
+    return [(m.name, m.type, m.documentation, m.samples()) for m in registry]
+
+
+def reset():
+    for metric in registry:
+        metric.reset()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(
+            name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in labels.items()
+    )
+    return "{" + body + "}"
+
+
+def render(snapshots):
+    """Prometheus text format for {worker id: snapshot}."""
+    families = {}
+    for worker_id, metrics in sorted(snapshots.items()):
+        for name, kind, documentation, samples in metrics:
+            family = families.setdefault(name, (kind, documentation, []))
+            for sample, labels, value in samples:
+                family[2].append((sample, {**labels, "worker": worker_id}, value))
+
+    lines = []
+    for name, (kind, documentation, samples) in families.items():
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample, labels, value in samples:
+            lines.append(f"{sample}{_format_labels(labels)} {value!r}")
+    return "\n".join(lines) + "\n"
+
+
+def collect():
+    """Snapshots of every live worker, this one always current."""
+    worker = current_worker()
+    workers = cache.get(WORKERS_KEY) or []
+    found = cache.get_many([worker_key(w) for w in workers if w != worker])
+    snapshots = {key.split(":", 1)[1]: value for key, value in found.items()}
+    snapshots[worker] = snapshot()
+    return snapshots
+
+
+class MetricsPublisher:
+    """Publishes this worker's snapshot to the cache, at most once per interval."""
+
+    def __init__(self):
+        # the first snapshot goes out one interval after start
+        self._last = time.monotonic()
+
+    def maybe_publish(self):
+        now = time.monotonic()
+        if now - self._last < publish_interval() or not metrics_enabled():
+            return
+        self._last = now
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        loop.create_task(self.publish())
+
+    async def publish(self):
+        # imported here: presence records its cache calls in this module
+        from .presence import acache
+
+        interval, worker = publish_interval(), current_worker()
+        try:
+            await acache("set", worker_key(worker), snapshot(), timeout=interval * 3)
+            # keep the list to workers whose snapshot has not expired
+            workers = set(await acache("get", WORKERS_KEY) or []) | {worker}
+            live = await acache("get_many", [worker_key(w) for w in workers])
+            await acache(
+                "set", WORKERS_KEY, sorted(key.split(":", 1)[1] for key in live), timeout=None
+            )
+        except Exception:
+            logger.exception("Publishing metrics failed")
+
+
+publisher = MetricsPublisher()
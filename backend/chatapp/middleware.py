@@ -3,16 +3,177 @@ This file contains custom middleware for JWT authentication in WebSocket connect
 It extracts the JWT token from the query parameters, validates it, and attaches the
 corresponding user to the connection scope for use in consumers.
 
+Validated tokens are kept in a small in-process LRU (keyed by token hash, expiring
+at the token's exp) together with a snapshot of the user, so reconnect storms do
+not decode tokens or query the database again.
+
+Logout and password changes revoke every access token the user was issued so far
+(revoke_user_tokens): the time is stored in the shared cache, and a token issued
+before it is refused on the cached and the database path alike. Token "iat" has
+whole seconds, so a token issued in the same second as the revocation is refused
+too.
 """
 
+import hashlib
+import time
+from collections import OrderedDict
 from urllib.parse import parse_qs
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from rest_framework_simplejwt.tokens import AccessToken, TokenError
+from . import metrics
+from .dbexecutor import db_task
+from .presence import acache
 # Get the default User model
 User = get_user_model()
 
+# Default maximum number of cached tokens per worker
+DEFAULT_AUTH_CACHE_SIZE = 10000
+
+# User fields kept in the cached snapshot
+SNAPSHOT_FIELDS = (
+    "id", "username", "first_name", "last_name", "email", "is_active", "is_staff", "is_superuser",
+)
+
+
+# Cache key holding the time of the user's last logout/password change
+def revoked_key(user_id):
+    return f"auth_revoked:{user_id}"
+
+
+# How long the revocation must be kept: longer than any access token can live
+def revoked_timeout():
+    lifetime = settings.SIMPLE_JWT.get("ACCESS_TOKEN_LIFETIME")
+    return int(lifetime.total_seconds()) + 60 if lifetime else None
+
+
+class TokenUserCache:
+    """
+    Bounded LRU of validated access tokens -> user snapshot.
+    Entries expire at the token's exp and are dropped once the user's
+    tokens are revoked (logout, password change).
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # token hash -> (exp, iat, snapshot)
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    # Return (iat, snapshot) for a live entry, or None
+    def get(self, token_hash):
+        entry = self._entries.get(token_hash)
+        if entry is None:
+            return None
+        exp, iat, snapshot = entry
+        if exp <= time.time():
+            del self._entries[token_hash]
+            return None
+        self._entries.move_to_end(token_hash)
+        return iat, snapshot
+
+    def discard(self, token_hash):
+        self._entries.pop(token_hash, None)
+
+    def put(self, token_hash, exp, iat, snapshot):
+        self._entries[token_hash] = (exp, iat, snapshot)
+        self._entries.move_to_end(token_hash)
+        max_size = self.max_size or getattr(
+            settings, "CHAT_WS_AUTH_CACHE_SIZE", DEFAULT_AUTH_CACHE_SIZE
+        )
+        while len(self._entries) > max_size:
+            self._entries.popitem(last=False)
+
+    # Drop every entry of a user in this worker
+    def forget_user(self, user_id):
+        stale = [k for k, (_, _, snap) in self._entries.items() if snap["id"] == user_id]
+        for k in stale:
+            del self._entries[k]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared token cache for all connections in this worker
+token_user_cache = TokenUserCache()
+
+
+def revoke_user_tokens(user_id):
+    """
+    Refuse every access token issued to a user until now, on every worker
+    (WebSocket handshakes, async views and, through
+    authentication.RevocableJWTAuthentication, the DRF views). Call after
+    logout/blacklist and password changes.
+    """
+    token_user_cache.forget_user(user_id)
+    cache.set(revoked_key(user_id), time.time(), timeout=revoked_timeout())
+
+
+# Whether a token issued at iat was revoked at revoked_at (or never)
+def is_revoked(iat, revoked_at):
+    return revoked_at is not None and iat < revoked_at
+
+
+# Build a User instance from a snapshot without touching the database
+def user_from_snapshot(snapshot):
+    user = User(**snapshot)
+    user._state.adding = False
+    return user
+
+
+# Helper method to get user from token
+@db_task
+def get_user_from_token(token):
+    # Validate token and retrieve user
+    try:
+        access_token = AccessToken(token)
+        user_id = access_token["user_id"] # Extract user ID from token
+        user = User.objects.get(id=user_id) # Get user from database
+        return user, access_token["exp"], access_token.get("iat", 0)
+    except TokenError:
+        return None # Invalid token
+    except User.DoesNotExist:
+        return None # User not found
+
+
+async def resolve_token_user(token):
+    """
+    User for an access token, through the LRU first, then the database.
+    Shared by WebSocket connections and the async HTTP views.
+    """
+    token_hash = TokenUserCache.key(token)
+    hit = token_user_cache.get(token_hash)
+    if hit is not None:
+        iat, snapshot = hit
+        # one cache read tells whether the user logged out or changed password
+        if not is_revoked(iat, await acache("get", revoked_key(snapshot["id"]))):
+            metrics.auth_results.inc("cached")
+            return user_from_snapshot(snapshot)
+        token_user_cache.discard(token_hash)
+        metrics.auth_results.inc("revoked")
+        return AnonymousUser()
+
+    result = await get_user_from_token(token)
+    if result is None:
+        metrics.auth_results.inc("invalid")
+        return AnonymousUser()
+    user, exp, iat = result
+    if is_revoked(iat, await acache("get", revoked_key(user.id))):
+        metrics.auth_results.inc("revoked")
+        return AnonymousUser()
+    metrics.auth_results.inc("database")
+    snapshot = {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+    token_user_cache.put(token_hash, exp, iat, snapshot)
+    return user
+
+
 # Custom middleware for JWT authentication in WebSocket connections
 class JWTAuthMiddleware:
     """Fully ASGI-compliant middleware that receives (scope, receive, send) directly."""
@@ -28,7 +189,7 @@ class JWTAuthMiddleware:
         print(f"DEBUG: WebSocket Connection Attempt. Token found: {bool(token)}")
         # Validate token and get user
         if token:
-            user = await self.get_user_from_token(token)
+            user = await self.resolve_user(token)
         else:
             user = AnonymousUser()
 
@@ -38,16 +199,6 @@ class JWTAuthMiddleware:
 
         return await self.app(scope, receive, send)
 
-    # Helper method to get user from token
-    @database_sync_to_async
-    def get_user_from_token(self, token):
-        # Validate token and retrieve user
-        try:
-            access_token = AccessToken(token) 
-            user_id = access_token["user_id"] # Extract user ID from token
-            user = User.objects.get(id=user_id) # Get user from database
-            return user
-        except TokenError as e:
-            return AnonymousUser() # Invalid token
-        except User.DoesNotExist:
-            return AnonymousUser() # User not found
+    # Resolve a token through the LRU first, then the database
+    async def resolve_user(self, token):
+        return await resolve_token_user(token)
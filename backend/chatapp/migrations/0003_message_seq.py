@@ -0,0 +1,82 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:37
+
+from django.db import migrations, models
+
+
+# Messages numbered per batch by the fallback backfill
+BACKFILL_BATCH_SIZE = 1000
+
+
+# Number existing messages of each conversation in (timestamp, id) order
+def backfill_seq(apps, schema_editor):
+    Conversation = apps.get_model('chatapp', 'Conversation')
+    Message = apps.get_model('chatapp', 'Message')
+    if schema_editor.connection.vendor == 'postgresql':
+        backfill_seq_sql(schema_editor, Conversation._meta.db_table, Message._meta.db_table)
+    else:
+        backfill_seq_batched(Conversation, Message)
+
+
+# One UPDATE numbering every message with a window function, one for last_seq
+def backfill_seq_sql(schema_editor, conversations, messages):
+    q = schema_editor.quote_name
+    schema_editor.execute(
+        f"UPDATE {q(messages)} AS m SET seq = numbered.seq "
+        f"FROM (SELECT id, ROW_NUMBER() OVER ("
+        f"PARTITION BY conversation_id ORDER BY {q('timestamp')}, id) AS seq "
+        f"FROM {q(messages)}) AS numbered "
+        f"WHERE m.id = numbered.id"
+    )
+    schema_editor.execute(
+        f"UPDATE {q(conversations)} AS c SET last_seq = counts.n "
+        f"FROM (SELECT conversation_id, COUNT(*) AS n FROM {q(messages)} "
+        f"GROUP BY conversation_id) AS counts "
+        f"WHERE c.id = counts.conversation_id"
+    )
+
+
+# Other databases (SQLite): one ordered scan, written with batched bulk_update
+def backfill_seq_batched(Conversation, Message):
+    last_seq = {}
+    batch = []
+    rows = (
+        Message.objects.order_by('conversation_id', 'timestamp', 'id')
+        .only('id', 'conversation_id')
+    )
+    for msg in rows.iterator(chunk_size=BACKFILL_BATCH_SIZE):
+        msg.seq = last_seq[msg.conversation_id] = last_seq.get(msg.conversation_id, 0) + 1
+        batch.append(msg)
+        if len(batch) >= BACKFILL_BATCH_SIZE:
+            Message.objects.bulk_update(batch, ['seq'])
+            batch = []
+    Message.objects.bulk_update(batch, ['seq'])
+    Conversation.objects.bulk_update(
+        [Conversation(pk=pk, last_seq=seq) for pk, seq in last_seq.items()],
+        ['last_seq'],
+        batch_size=BACKFILL_BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0002_message_conv_ts_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('conversation', 'seq'), name='msg_conv_seq_unique'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0003_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='name',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='conversation',
+            name='type',
+            field=models.CharField(choices=[('global', 'Global'), ('private', 'Private'), ('group', 'Group')], default='global', max_length=20),
+        ),
+    ]
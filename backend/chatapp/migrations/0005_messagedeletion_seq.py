@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0004_group_conversations'),
+    ]
+
+    operations = [
+        # indexed together with the conversation in 0006
+        migrations.AddField(
+            model_name='messagedeletion',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
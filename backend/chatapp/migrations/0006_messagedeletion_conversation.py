@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+# Copy the conversation of each deleted message onto its deletion rows
+def backfill_conversation(apps, schema_editor):
+    Message = apps.get_model('chatapp', 'Message')
+    MessageDeletion = apps.get_model('chatapp', 'MessageDeletion')
+    MessageDeletion.objects.filter(conversation__isnull=True).update(
+        conversation_id=Subquery(
+            Message.objects.filter(pk=OuterRef('message_id')).values('conversation_id')[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0005_messagedeletion_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagedeletion',
+            name='conversation',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='message_deletions', to='chatapp.conversation'),
+        ),
+        migrations.RunPython(backfill_conversation, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='messagedeletion',
+            index=models.Index(fields=['user', 'conversation', 'seq'], name='msgdel_user_conv_seq_idx'),
+        ),
+    ]
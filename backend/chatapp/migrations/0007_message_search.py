@@ -0,0 +1,80 @@
+from django.db import migrations
+
+# The SQL below is frozen with this migration on purpose: chatapp/search.py
+# queries these objects but must not be imported from here
+
+# Must match the expression built by SearchVector("content", config="simple")
+PG_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS msg_content_fts_idx ON chatapp_message "
+    "USING GIN (to_tsvector('simple'::regconfig, COALESCE(content, '')))"
+)
+PG_INDEX_DROP_SQL = "DROP INDEX IF EXISTS msg_content_fts_idx"
+
+# External-content FTS5 table over chatapp_message.content, kept in sync by triggers
+SQLITE_FTS_SQL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chatapp_message_fts USING fts5("
+    "content, content='chatapp_message', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "INSERT INTO chatapp_message_fts(chatapp_message_fts) VALUES('rebuild')",
+    "CREATE TRIGGER IF NOT EXISTS chatapp_message_fts_ai AFTER INSERT ON chatapp_message BEGIN "
+    "INSERT INTO chatapp_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chatapp_message_fts_ad AFTER DELETE ON chatapp_message BEGIN "
+    "INSERT INTO chatapp_message_fts(chatapp_message_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chatapp_message_fts_au AFTER UPDATE OF content ON chatapp_message BEGIN "
+    "INSERT INTO chatapp_message_fts(chatapp_message_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    "INSERT INTO chatapp_message_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+SQLITE_FTS_DROP_SQL = [
+    "DROP TRIGGER IF EXISTS chatapp_message_fts_ai",
+    "DROP TRIGGER IF EXISTS chatapp_message_fts_ad",
+    "DROP TRIGGER IF EXISTS chatapp_message_fts_au",
+    "DROP TABLE IF EXISTS chatapp_message_fts",
+]
+
+
+def sqlite_has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        if cursor.fetchone()[0]:
+            return True
+        # builds may ship FTS5 without reporting the compile option
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+            cursor.execute("DROP TABLE temp.fts5_probe")
+            return True
+        except Exception:
+            return False
+
+
+# Full-text index for message search: GIN on PostgreSQL, FTS5 on SQLite
+# (other databases fall back to an unindexed search)
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(PG_INDEX_SQL)
+    elif vendor == 'sqlite' and sqlite_has_fts5(schema_editor.connection):
+        for sql in SQLITE_FTS_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(PG_INDEX_DROP_SQL)
+    elif vendor == 'sqlite':
+        for sql in SQLITE_FTS_DROP_SQL:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0006_messagedeletion_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+# Trigram index for username__icontains, whose SQL on PostgreSQL is
+# UPPER("username"::text) LIKE UPPER(...)
+PG_USER_INDEX_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS user_username_trgm_idx ON chatapp_user "
+    "USING GIN (UPPER(username::text) gin_trgm_ops)",
+]
+PG_USER_INDEX_DROP_SQL = "DROP INDEX IF EXISTS user_username_trgm_idx"
+
+# Index for the prefix range on LOWER(username) used by other databases
+USER_PREFIX_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS user_username_lower_idx ON chatapp_user (LOWER(username))"
+)
+USER_PREFIX_INDEX_DROP_SQL = "DROP INDEX IF EXISTS user_username_lower_idx"
+
+
+# Index for user search: pg_trgm GIN on PostgreSQL, LOWER(username) elsewhere
+def create_user_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in PG_USER_INDEX_SQL:
+            schema_editor.execute(sql)
+    else:
+        schema_editor.execute(USER_PREFIX_INDEX_SQL)
+
+
+def drop_user_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(PG_USER_INDEX_DROP_SQL)
+    else:
+        schema_editor.execute(USER_PREFIX_INDEX_DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0007_message_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_user_search_index, drop_user_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0008_user_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:34
+
+from django.db import migrations, models
+
+# Hazard: SQLite alters chatapp_message (adding a unique column here, and
+# removing it when unapplied) by rebuilding the table, which silently drops
+# the triggers that keep the chatapp_message_fts search index from 0007 up
+# to date. Every migration that rebuilds chatapp_message on SQLite must put
+# them back, in both directions. The SQL is frozen here, as in 0007.
+SQLITE_FTS_TRIGGERS_SQL = [
+    "CREATE TRIGGER IF NOT EXISTS chatapp_message_fts_ai AFTER INSERT ON chatapp_message BEGIN "
+    "INSERT INTO chatapp_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chatapp_message_fts_ad AFTER DELETE ON chatapp_message BEGIN "
+    "INSERT INTO chatapp_message_fts(chatapp_message_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chatapp_message_fts_au AFTER UPDATE OF content ON chatapp_message BEGIN "
+    "INSERT INTO chatapp_message_fts(chatapp_message_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    "INSERT INTO chatapp_message_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+
+# Recreate the search triggers if 0007 created the FTS5 table
+def restore_search_triggers(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    if 'chatapp_message_fts' not in connection.introspection.table_names():
+        return
+    for sql in SQLITE_FTS_TRIGGERS_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0009_conversation_updated_at'),
+    ]
+
+    operations = [
+        # unapplying runs this last, after RemoveField rebuilt the table
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.AddField(
+            model_name='message',
+            name='uuid',
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
@@ -19,26 +19,38 @@ class Conversation(models.Model):
     # Conversation types
     TYPE_GLOBAL = 'global'
     TYPE_PRIVATE = 'private'
+    TYPE_GROUP = 'group'
 
     # Choices for conversation type
     TYPE_CHOICES = [
         (TYPE_GLOBAL, 'Global'),
         (TYPE_PRIVATE, 'Private'),
+        (TYPE_GROUP, 'Group'),
     ]
 
     # Unique identifier for conversation (example: global or private slug)
     slug = models.CharField(max_length=128, unique=True)
 
-    # Type of conversation (global or private)
+    # Type of conversation (global, private or group)
     type = models.CharField(
         max_length=20,
         choices=TYPE_CHOICES,
         default=TYPE_GLOBAL
     )
 
+    # Display name (used by group conversations)
+    name = models.CharField(max_length=128, blank=True, default='')
+
     # Time when conversation was created
     created_at = models.DateTimeField(default=timezone.now)
 
+    # Last sequence number handed out to a message
+    last_seq = models.BigIntegerField(default=0)
+
+    # Time of the last change to the messages (set together with last_seq,
+    # and by deletions that take no sequence number); part of page ETags
+    updated_at = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
         return f"{self.slug} ({self.type})"
 
@@ -98,10 +110,34 @@ class Message(models.Model):
     # Time when message was sent
     timestamp = models.DateTimeField(default=timezone.now)
 
+    # Position of the message in its conversation (increasing, without
+    # gaps from other changes); clients use it to detect missed messages
+    seq = models.BigIntegerField(null=True, blank=True)
+
+    # Set on messages queued by the write-behind path, which are broadcast
+    # before they have an id; clients match the id sent after the flush by it
+    uuid = models.UUIDField(null=True, blank=True, unique=True, editable=False)
+
     class Meta:
         # Messages ordered by time
         ordering = ['timestamp']
 
+        # One sequence number per message in a conversation
+        constraints = [
+            models.UniqueConstraint(
+                fields=['conversation', 'seq'],
+                name='msg_conv_seq_unique',
+            )
+        ]
+
+        # Index used by cursor pagination of message history
+        indexes = [
+            models.Index(
+                fields=['conversation', 'timestamp', 'id'],
+                name='msg_conv_ts_id_idx',
+            )
+        ]
+
     def __str__(self):
         return f"{self.sender}: {self.content[:40]}"
 
@@ -123,14 +159,33 @@ class MessageDeletion(models.Model):
     # User who deleted the message
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    # Conversation of the message (copied from it), so a user's deletions
+    # in one room are found without a join through Message
+    conversation = models.ForeignKey(
+        Conversation,
+        related_name="message_deletions",
+        on_delete=models.CASCADE,
+        null=True,
+    )
+
     # Time when message was deleted
     deleted_at = models.DateTimeField(default=timezone.now)
 
+    # Conversation's last sequence number when the message was deleted (no
+    # new one is taken), so the sync API can return deletions made since a
+    # client's last seq
+    seq = models.BigIntegerField(null=True, blank=True)
+
     class Meta:
         # One delete record per user per message
         unique_together = ('message', 'user')
 
         # Index to improve query speed
         indexes = [
-            models.Index(fields=['user', 'deleted_at'])
+            models.Index(fields=['user', 'deleted_at']),
+            # deletions of a user in a room after a sequence number (sync API)
+            models.Index(
+                fields=['user', 'conversation', 'seq'],
+                name='msgdel_user_conv_seq_idx',
+            ),
         ]
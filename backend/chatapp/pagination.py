@@ -0,0 +1,106 @@
+"""
+This file contains cursor (keyset) pagination helpers for message history.
+Pages are selected with a (timestamp, id) position instead of OFFSET, so
+loading a page costs the same no matter how long the conversation is.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+
+# Default and maximum number of messages returned in one page
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Reference point for encoding timestamps as integers
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+# Raised when a cursor or page size from the client cannot be parsed
+class InvalidCursor(ValueError):
+    pass
+
+
+# Encode message position as "<microseconds since epoch>:<id>"
+def encode_cursor(message):
+    micros = (message.timestamp - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}:{message.id}"
+
+
+# Decode "<microseconds>:<id>" back to a (timestamp, id) pair
+def decode_cursor(value):
+    try:
+        micros, msg_id = value.split(":", 1)
+        return EPOCH + timedelta(microseconds=int(micros)), int(msg_id)
+    except (ValueError, OverflowError):
+        raise InvalidCursor("Invalid cursor")
+
+
+# Read page size from the query string, clamped to the configured maximum
+def get_page_size(params):
+    default = getattr(settings, "CHAT_MESSAGES_PAGE_SIZE", DEFAULT_PAGE_SIZE)
+    maximum = getattr(settings, "CHAT_MESSAGES_MAX_PAGE_SIZE", MAX_PAGE_SIZE)
+    raw = params.get("limit")
+    if raw in (None, ""):
+        return default
+    try:
+        size = int(raw)
+    except ValueError:
+        raise InvalidCursor("Invalid limit")
+    if size < 1:
+        raise InvalidCursor("Invalid limit")
+    return min(size, maximum)
+
+
+# Resolve a "before"/"after" value: either a message id or an encoded cursor
+def resolve_position(conv, value):
+    if ":" in value:
+        return decode_cursor(value)
+    try:
+        msg_id = int(value)
+    except ValueError:
+        raise InvalidCursor("Invalid cursor")
+    # look up the timestamp of the anchor message (single primary key lookup)
+    timestamp = (
+        conv.messages.filter(pk=msg_id).values_list("timestamp", flat=True).first()
+    )
+    if timestamp is None:
+        raise InvalidCursor("Unknown message id")
+    return timestamp, msg_id
+
+
+def paginate_messages(conv, msgs_qs, params):
+    """
+    Return one page of messages in chronological order.
+
+    Query params:
+    - before=<id or cursor>: messages older than the position (default: latest)
+    - after=<id or cursor>: messages newer than the position
+    - limit=<n>: page size
+
+    Returns (messages, has_more) where has_more tells whether another
+    page exists in the requested direction.
+    """
+    size = get_page_size(params)
+    before = params.get("before")
+    after = params.get("after")
+
+    if after:
+        ts, msg_id = resolve_position(conv, after)
+        page_qs = msgs_qs.filter(
+            Q(timestamp__gt=ts) | Q(timestamp=ts, id__gt=msg_id)
+        ).order_by("timestamp", "id")
+        rows = list(page_qs[: size + 1])
+        return rows[:size], len(rows) > size
+
+    if before:
+        ts, msg_id = resolve_position(conv, before)
+        msgs_qs = msgs_qs.filter(
+            Q(timestamp__lt=ts) | Q(timestamp=ts, id__lt=msg_id)
+        )
+    # newest first so the slice hits the index, then flip to chronological
+    rows = list(msgs_qs.order_by("-timestamp", "-id")[: size + 1])
+    has_more = len(rows) > size
+    rows = rows[:size]
+    rows.reverse()
+    return rows, has_more
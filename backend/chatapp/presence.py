@@ -0,0 +1,260 @@
+"""
+This file contains helpers for user online status (presence).
+A user is online while the cache key "online:<user_id>" exists.
+PresenceProvider resolves the status of many users with a single
+cache.get_many call instead of one cache.get per serialized user.
+PresenceTracker writes presence for ChatConsumer connections and
+pushes online/offline changes to the user's contacts.
+"""
+import asyncio
+import logging
+import time
+from itertools import chain
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.base import BaseCache
+from rest_framework import serializers
+
+from . import metrics
+from .dbexecutor import db_executor
+
+logger = logging.getLogger(__name__)
+
+# Default lifetime of the online key in seconds
+DEFAULT_PRESENCE_TTL = 60
+
+# Default seconds to wait before announcing that a user went offline
+DEFAULT_PRESENCE_DEBOUNCE = 5
+
+# Lifetime of the shared connection counter (cleaned up if a worker dies)
+CONNECTIONS_TIMEOUT = 60 * 60 * 24
+
+
+# Cache key that marks a user as online
+def online_key(user_id):
+    return f"online:{user_id}"
+
+
+# Cache key holding the number of open sockets of a user (all workers)
+def connections_key(user_id):
+    return f"online_conns:{user_id}"
+
+
+# Cache key holding the last status announced to the user's contacts
+def announced_key(user_id):
+    return f"online_announced:{user_id}"
+
+
+# Users who share a private conversation with the given user
+def get_contact_ids(user_id):
+    from .models import Conversation, ConversationParticipant
+
+    return list(
+        ConversationParticipant.objects.filter(
+            conversation__type=Conversation.TYPE_PRIVATE,
+            conversation__participants__user_id=user_id,
+        )
+        .exclude(user_id=user_id)
+        .values_list("user_id", flat=True)
+        .distinct()
+    )
+
+
+async def acache(method, *args, **kwargs):
+    """
+    Call a cache method from async code.
+    Uses the backend's native async method when it has one; otherwise runs
+    the sync method outside the threads used by db_executor so
+    cache I/O never queues behind database work.
+    """
+    metrics.cache_ops.inc(method)
+    backend = caches["default"]
+    async_name = f"a{method}"
+    if getattr(type(backend), async_name) is not getattr(BaseCache, async_name):
+        return await getattr(backend, async_name)(*args, **kwargs)
+    return await sync_to_async(getattr(backend, method), thread_sensitive=False)(
+        *args, **kwargs
+    )
+
+
+class PresenceProvider:
+    """
+    Caches online status for the users seen in one serializer pass.
+    Call prime() with every user id first; is_online() then reads the
+    local result and only hits the cache for ids that were never primed.
+    """
+
+    def __init__(self):
+        self._status = {}
+
+    # Resolve all unknown user ids with one round trip
+    def prime(self, user_ids):
+        missing = {uid for uid in user_ids if uid is not None and uid not in self._status}
+        if not missing:
+            return
+        found = cache.get_many([online_key(uid) for uid in missing])
+        for uid in missing:
+            self._status[uid] = online_key(uid) in found
+
+    # Record a status already known (e.g. the user sending on an open socket)
+    def set(self, user_id, is_online):
+        self._status[user_id] = is_online
+
+    def is_online(self, user_id):
+        if user_id not in self._status:
+            self.prime([user_id])
+        return self._status[user_id]
+
+
+# Return the provider shared by every serializer in the current pass
+def get_presence(context):
+    provider = context.get("presence")
+    if provider is None:
+        provider = context["presence"] = PresenceProvider()
+    return provider
+
+
+# List serializer that primes presence for all items before rendering them
+class PresenceListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        items = list(data.all() if hasattr(data, "all") else data)
+        ids = chain.from_iterable(self.child.presence_user_ids(i) for i in items)
+        get_presence(self.context).prime(ids)
+        return super().to_representation(items)
+
+
+class PresenceMixin:
+    """
+    Mixin for serializers that render users.
+    Subclasses return the user ids they will render from presence_user_ids();
+    the top-level serializer primes them all before rendering.
+    """
+
+    def presence_user_ids(self, instance):
+        return []
+
+    def to_representation(self, instance):
+        # nested serializers are primed by their parent
+        if self.parent is None:
+            get_presence(self.context).prime(self.presence_user_ids(instance))
+        return super().to_representation(instance)
+
+
+class PresenceTracker:
+    """
+    Per-worker presence writer used by ChatConsumer.
+    - counts open sockets per user, so closing one tab keeps the user online
+    - refreshes the online key at most once per half TTL per user, no matter
+      how many frames arrive
+    """
+
+    def __init__(self):
+        self._connections = {}  # user_id -> open sockets in this worker
+        self._refreshed = {}  # user_id -> time of the last online key write
+        self._pending_offline = {}  # user_id -> delayed offline announcement
+
+    @property
+    def ttl(self):
+        return getattr(settings, "CHAT_PRESENCE_TTL", DEFAULT_PRESENCE_TTL)
+
+    @property
+    def debounce(self):
+        return getattr(settings, "CHAT_PRESENCE_DEBOUNCE", DEFAULT_PRESENCE_DEBOUNCE)
+
+    async def connect(self, user_id):
+        """Register a new socket and mark the user online. Returns True for the first socket."""
+        self._connections[user_id] = self._connections.get(user_id, 0) + 1
+        pending = self._pending_offline.pop(user_id, None)
+        if pending:
+            pending.cancel()
+        key = connections_key(user_id)
+        first = await acache("add", key, 1, timeout=CONNECTIONS_TIMEOUT)
+        if not first:
+            first = await acache("incr", key) == 1
+        await self._refresh(user_id)
+        return first
+
+    # Refresh the online key if the last write is older than half the TTL
+    async def heartbeat(self, user_id):
+        last = self._refreshed.get(user_id)
+        if last is not None and time.monotonic() - last < self.ttl / 2:
+            return False
+        await self._refresh(user_id)
+        return True
+
+    async def disconnect(self, user_id):
+        """Unregister a socket. Returns True when the user went offline."""
+        count = self._connections.get(user_id, 0) - 1
+        if count > 0:
+            self._connections[user_id] = count
+        else:
+            self._connections.pop(user_id, None)
+            self._refreshed.pop(user_id, None)
+
+        try:
+            remaining = await acache("decr", connections_key(user_id))
+        except ValueError:
+            # counter expired or was never written
+            remaining = 0
+        if remaining > 0:
+            return False
+        await acache("delete_many", [online_key(user_id), connections_key(user_id)])
+        return True
+
+    async def announce(self, channel_layer, user_id, is_online):
+        """
+        Send presence_changed to the user_<id> group of every contact.
+        Skipped when contacts were already told this status, so one
+        transition is published once even with sockets on several workers.
+        """
+        if await acache("get", announced_key(user_id)) == is_online:
+            return False
+        await acache("set", announced_key(user_id), is_online, timeout=CONNECTIONS_TIMEOUT)
+        contact_ids = await db_executor.run(get_contact_ids, user_id)
+        from .messaging import asend_group_events, group_event
+
+        event = group_event(
+            "presence_changed",
+            {"type": "presence_changed", "user_id": user_id, "is_online": is_online},
+        )
+        # one round of concurrent sends, not one channel layer round trip per contact
+        await asend_group_events(
+            [(f"user_{contact_id}", event) for contact_id in contact_ids], channel_layer
+        )
+        return True
+
+    def announce_offline_later(self, channel_layer, user_id):
+        """
+        Announce offline after the debounce delay, unless the user comes
+        back first (a reconnect in this worker cancels it; a reconnect on
+        another worker is seen through the online key).
+        """
+        async def run():
+            try:
+                await asyncio.sleep(self.debounce)
+                if await acache("get", online_key(user_id)) is None:
+                    await self.announce(channel_layer, user_id, False)
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                logger.exception("Presence announcement failed")
+            finally:
+                if self._pending_offline.get(user_id) is task:
+                    del self._pending_offline[user_id]
+
+        previous = self._pending_offline.get(user_id)
+        if previous:
+            previous.cancel()
+        task = asyncio.get_running_loop().create_task(run())
+        self._pending_offline[user_id] = task
+        return task
+
+    async def _refresh(self, user_id):
+        self._refreshed[user_id] = time.monotonic()
+        await acache("set", online_key(user_id), True, timeout=self.ttl)
+
+
+# Shared tracker for all consumers in this worker
+presence_tracker = PresenceTracker()
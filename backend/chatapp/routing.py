@@ -7,5 +7,6 @@ from . import consumers
 
 # WebSocket URL patterns for chat application
 websocket_urlpatterns = [
+re_path(r'ws/chat/$', consumers.ChatConsumer.as_asgi()),
 re_path(r'ws/chat/(?P<conversation_id>[\w-]+)/$', consumers.ChatConsumer.as_asgi()),
 ]
\ No newline at end of file
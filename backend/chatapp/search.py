@@ -0,0 +1,294 @@
+"""
+This file contains message and user search.
+
+Messages: full-text search over message content.
+Results are limited to the caller's conversations and respect both
+"delete for me" (MessageDeletion) and hidden conversations (deleted_at).
+
+Backends, picked from the database in use:
+- PostgreSQL: GIN index on to_tsvector('simple', content), ranked with
+  ts_rank and highlighted with ts_headline
+- SQLite: FTS5 table chatapp_message_fts kept in sync by triggers, ranked
+  with bm25() and highlighted with snippet()
+- anything else: unindexed icontains, newest first
+
+The index is created by migration 0007_message_search. On SQLite, a later
+migration that rebuilds chatapp_message drops the triggers and must create
+them again (see 0010_message_uuid).
+
+Users (people picker): on PostgreSQL a substring match served by a pg_trgm
+GIN index, elsewhere a prefix match served by an index on LOWER(username)
+(migration 0008_user_search_index). Exact and prefix matches rank first,
+then people the caller already talks to. The matches of a query are cached
+for everyone under the normalised query, and each caller's conversation
+partners under the caller, both for CHAT_USER_SEARCH_CACHE_TIMEOUT seconds:
+a hot prefix typed by many clients reaches the database once per timeout,
+and the partner ranking is applied in memory.
+"""
+import hashlib
+import html
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Case, Exists, F, IntegerField, OuterRef, Q, Value, When
+from django.db.models.functions import Length, Lower
+
+from .models import Conversation, ConversationParticipant, Message, MessageDeletion
+
+User = get_user_model()
+
+# Default and maximum number of results per page
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+
+# Text search configuration (no stemming, works for any language)
+PG_CONFIG = "simple"
+
+# Highlight markers used inside the database; replaced by <mark> after
+# the snippet is HTML-escaped
+START_SEL = "\x02"
+STOP_SEL = "\x03"
+
+# FTS5 table and GIN index created by migration 0007 (the index must match
+# the expression built by SearchVector("content", config=PG_CONFIG))
+FTS_TABLE = "chatapp_message_fts"
+
+# Default and maximum number of users per search page, and the last page
+USER_SEARCH_PAGE_SIZE = 20
+USER_SEARCH_MAX_PAGE_SIZE = 50
+USER_SEARCH_MAX_PAGES = 10
+
+# Matches kept per query: enough for the last page of the largest size,
+# one more for has_more and one for the caller, who is left out
+USER_SEARCH_CANDIDATES = USER_SEARCH_MAX_PAGES * USER_SEARCH_MAX_PAGE_SIZE + 2
+
+# Default seconds user search matches and partners stay cached
+DEFAULT_USER_SEARCH_CACHE_TIMEOUT = 30
+
+# Sorts after every character, closes the prefix range
+PREFIX_END = "\U0010ffff"
+
+
+# database name -> backend, checked once per process
+_backends = {}
+
+
+# Which search implementation the current database supports
+def search_backend():
+    name = connection.settings_dict["NAME"]
+    if name not in _backends:
+        backend = "basic"
+        if connection.vendor == "postgresql":
+            backend = "postgresql"
+        elif connection.vendor == "sqlite" and FTS_TABLE in connection.introspection.table_names():
+            backend = "sqlite"
+        _backends[name] = backend
+    return _backends[name]
+
+
+def fts5_query(text):
+    """
+    Turn user input into a safe FTS5 MATCH expression: every word must
+    match, the last one as a prefix (search while typing).
+    """
+    terms = ['"%s"' % word.replace('"', '""') for word in text.split()]
+    if not terms:
+        return None
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+# HTML-escape a snippet and turn the database markers into <mark> tags
+def render_snippet(snippet):
+    return (
+        html.escape(snippet or "")
+        .replace(START_SEL, "<mark>")
+        .replace(STOP_SEL, "</mark>")
+    )
+
+
+def searchable_messages(user, conversation_id=None):
+    """Messages the user may see: their conversations, minus deletions."""
+    qs = Message.objects.filter(
+        Q(conversation__participants__deleted_at__isnull=True)
+        | Q(timestamp__gt=F("conversation__participants__deleted_at")),
+        conversation__participants__user=user,
+    ).filter(
+        ~Exists(MessageDeletion.objects.filter(message=OuterRef("pk"), user=user))
+    )
+    if conversation_id is not None:
+        qs = qs.filter(conversation_id=conversation_id)
+    return qs
+
+
+def search_messages(user, text, conversation_id=None, offset=0, limit=SEARCH_PAGE_SIZE):
+    """
+    Ranked search. Returns ([(message, snippet), ...], has_more); messages
+    come with their sender loaded.
+    """
+    backend = search_backend()
+    if backend == "postgresql":
+        rows = _search_postgresql(user, text, conversation_id, offset, limit + 1)
+    elif backend == "sqlite":
+        rows = _search_sqlite(user, text, conversation_id, offset, limit + 1)
+    else:
+        rows = _search_basic(user, text, conversation_id, offset, limit + 1)
+    return rows[:limit], len(rows) > limit
+
+
+def _search_postgresql(user, text, conversation_id, offset, limit):
+    from django.contrib.postgres.search import (
+        SearchHeadline, SearchQuery, SearchRank, SearchVector,
+    )
+
+    query = SearchQuery(text, config=PG_CONFIG, search_type="websearch")
+    vector = SearchVector("content", config=PG_CONFIG)
+    qs = (
+        searchable_messages(user, conversation_id)
+        .annotate(search=vector)
+        .filter(search=query)
+        .annotate(
+            rank=SearchRank(vector, query),
+            snippet=SearchHeadline(
+                "content", query, config=PG_CONFIG,
+                start_sel=START_SEL, stop_sel=STOP_SEL, max_words=24, min_words=8,
+            ),
+        )
+        .select_related("sender")
+        .order_by("-rank", "-timestamp", "-id")[offset:offset + limit]
+    )
+    return [(m, render_snippet(m.snippet)) for m in qs]
+
+
+def _search_sqlite(user, text, conversation_id, offset, limit):
+    match = fts5_query(text)
+    if match is None:
+        return []
+    room_filter = ""
+    room_params = []
+    if conversation_id is not None:
+        room_filter = "AND m.conversation_id = %s"
+        room_params = [conversation_id]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT m.id, snippet({FTS_TABLE}, 0, %s, %s, '…', 16)
+            FROM {FTS_TABLE}
+            JOIN chatapp_message m ON m.id = {FTS_TABLE}.rowid
+            JOIN chatapp_conversationparticipant p
+              ON p.conversation_id = m.conversation_id AND p.user_id = %s
+            WHERE {FTS_TABLE} MATCH %s
+              AND (p.deleted_at IS NULL OR m.timestamp > p.deleted_at)
+              AND NOT EXISTS (
+                SELECT 1 FROM chatapp_messagedeletion d
+                WHERE d.message_id = m.id AND d.user_id = %s
+              )
+              {room_filter}
+            ORDER BY bm25({FTS_TABLE}), m.timestamp DESC, m.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [START_SEL, STOP_SEL, user.id, match, user.id, *room_params, limit, offset],
+        )
+        found = cursor.fetchall()
+    messages = Message.objects.select_related("sender").in_bulk([mid for mid, _ in found])
+    return [(messages[mid], render_snippet(snippet)) for mid, snippet in found if mid in messages]
+
+
+def _search_basic(user, text, conversation_id, offset, limit):
+    qs = (
+        searchable_messages(user, conversation_id)
+        .filter(content__icontains=text)
+        .select_related("sender")
+        .order_by("-timestamp", "-id")[offset:offset + limit]
+    )
+    return [(m, html.escape(m.content[:200])) for m in qs]
+
+
+# Cache key of the matches of a normalised query, shared by all callers
+def user_search_key(query):
+    digest = hashlib.md5(query.encode()).hexdigest()
+    return f"user_search:{digest}"
+
+
+# Cache key of the ids of the people a user shares a conversation with
+def search_partners_key(user_id):
+    return f"search_partners:{user_id}"
+
+
+def user_search_timeout():
+    return getattr(settings, "CHAT_USER_SEARCH_CACHE_TIMEOUT", DEFAULT_USER_SEARCH_CACHE_TIMEOUT)
+
+
+def user_match(query):
+    """
+    Filter for usernames matching the query: any substring on PostgreSQL
+    (trigram index), a prefix elsewhere (range on the LOWER(username)
+    index, which LIKE cannot use on SQLite).
+    """
+    if connection.vendor == "postgresql":
+        return Q(username__icontains=query)
+    lowered = query.lower()
+    return Q(username_lower__gte=lowered, username_lower__lt=lowered + PREFIX_END)
+
+
+def user_matches(query):
+    """
+    The first USER_SEARCH_CANDIDATES users matching a normalised query as
+    [(id, username, match rank), ...], exact username first, then prefix,
+    then substring; shorter names first within each.
+    """
+    return list(
+        User.objects.annotate(username_lower=Lower("username"))
+        .filter(user_match(query))
+        .annotate(
+            match_rank=Case(
+                When(username_lower=query, then=Value(0)),
+                When(username_lower__startswith=query, then=Value(1)),
+                default=Value(2),
+                output_field=IntegerField(),
+            ),
+        )
+        .order_by("match_rank", Length("username"), "username")
+        .values_list("id", "username", "match_rank")[:USER_SEARCH_CANDIDATES]
+    )
+
+
+def conversation_partners(user):
+    """Ids of the users sharing a private or group conversation with `user`."""
+    return set(
+        ConversationParticipant.objects.filter(
+            conversation__participants__user=user,
+            conversation__type__in=(Conversation.TYPE_PRIVATE, Conversation.TYPE_GROUP),
+        ).values_list("user_id", flat=True)
+    )
+
+
+def search_users(user, query, offset=0, limit=USER_SEARCH_PAGE_SIZE):
+    """
+    Users other than `user` matching `query`, best first: exact username,
+    then prefix, then substring; within each, people sharing a private or
+    group conversation with `user`, then shorter names. Partners only move
+    up among the first USER_SEARCH_CANDIDATES matches.
+    Returns ([{"id", "username"}, ...], has_more).
+    """
+    query = query.strip().lower()
+    matches_key, partners_key = user_search_key(query), search_partners_key(user.id)
+    cached = cache.get_many([matches_key, partners_key])
+    missing = {}
+    matches = cached.get(matches_key)
+    if matches is None:
+        matches = missing[matches_key] = user_matches(query)
+    partners = cached.get(partners_key)
+    if partners is None:
+        partners = missing[partners_key] = conversation_partners(user)
+    if missing:
+        cache.set_many(missing, timeout=user_search_timeout())
+
+    ranked = sorted(
+        (row for row in matches if row[0] != user.pk),
+        key=lambda row: (row[2], row[0] not in partners, len(row[1]), row[1]),
+    )
+    rows = [{"id": pk, "username": username} for pk, username, _ in ranked[offset:offset + limit + 1]]
+    return rows[:limit], len(rows) > limit
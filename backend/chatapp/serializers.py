@@ -10,6 +10,7 @@ validate incoming data from API requests.
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import Conversation, Message
+from .presence import PresenceListSerializer, PresenceMixin, get_presence
 from django.contrib.auth.password_validation import validate_password
 
 # Get the default User model
@@ -50,15 +51,19 @@ class RegisterSerializer(serializers.ModelSerializer):
 
 
 # Serializer to show basic user details
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(PresenceMixin, serializers.ModelSerializer):
     is_online = serializers.SerializerMethodField() # Custom field to show online status
     class Meta:
         model = User
         fields = ('id','username','first_name','last_name','is_online')
-    
+        list_serializer_class = PresenceListSerializer
+
+    def presence_user_ids(self, instance):
+        return [instance.id]
+
+    # Online status comes from the shared presence provider (batched lookups)
     def get_is_online(self, obj):
-        from django.core.cache import cache
-        return cache.get(f"online:{obj.id}") is not None
+        return get_presence(self.context).is_online(obj.id)
 
 # Update/Change password serializer
 class ChangePasswordSerializer(serializers.Serializer):
@@ -71,21 +76,26 @@ class ChangePasswordSerializer(serializers.Serializer):
         return value
 
 # Serializer for chat messages
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(PresenceMixin, serializers.ModelSerializer):
     # Show sender details using UserSerializer
     sender = UserSerializer(read_only=True)
 
     class Meta:
         model = Message
-        fields = ('id','conversation','sender','content','timestamp')
+        fields = ('id','conversation','sender','content','timestamp','seq','uuid')
+        list_serializer_class = PresenceListSerializer
+
+    def presence_user_ids(self, instance):
+        return [instance.sender_id]
 
 
 # Serializer for showing conversation list
-class ConversationListSerializer(serializers.ModelSerializer):
+class ConversationListSerializer(PresenceMixin, serializers.ModelSerializer):
     # Custom fields calculated using methods
     last_message = serializers.SerializerMethodField()
     participants = serializers.SerializerMethodField()
     unread_count = serializers.SerializerMethodField()
+    participant_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Conversation
@@ -93,26 +103,58 @@ class ConversationListSerializer(serializers.ModelSerializer):
             'id',
             'slug',
             'type',
+            'name',
             'created_at',
             'last_message',
             'participants',
+            'participant_count',
             'unread_count'
         ]
+        list_serializer_class = PresenceListSerializer
+
+    # Participants and last message sender of this conversation
+    def presence_user_ids(self, instance):
+        ids = [p.user_id for p in self.participant_rows(instance)]
+        last = getattr(instance, 'last_message', None)
+        if last:
+            ids.append(last.sender_id)
+        return ids
      
     # Get the most recent message of the conversation
+    # (uses obj.last_message when attached by get_conversation_list)
     def get_last_message(self, obj):
-        msg = obj.messages.order_by('-timestamp').first()
+        if hasattr(obj, 'last_message'):
+            msg = obj.last_message
+        else:
+            msg = obj.messages.select_related('sender').order_by('-timestamp', '-id').first()
         if not msg:
             return None
-        return MessageSerializer(msg).data
+        return MessageSerializer(msg, context=self.context).data
     
-    # Get usernames of all participants in the conversation
+    # Participant rows to show: the prefetched preview when available
+    def participant_rows(self, obj):
+        if hasattr(obj, 'participant_preview'):
+            return obj.participant_preview
+        return obj.participants.select_related('user').all()
+
+    # Get usernames of the participants in the conversation
+    # (big groups only show a preview; see participant_count)
     def get_participants(self, obj):
-        user = [p.user for p in obj.participants.select_related('user').all()]
-        return UserSerializer(user, many=True).data
+        user = [p.user for p in self.participant_rows(obj)]
+        return UserSerializer(user, many=True, context=self.context).data
     
+    # Number of members (participants may only hold a preview for big groups)
+    # (uses the participant_count annotation when available)
+    def get_participant_count(self, obj):
+        if hasattr(obj, 'participant_count'):
+            return obj.participant_count
+        return obj.participants.count()
+
     # Get unread message count for the logged-in user
+    # (uses the my_unread_count annotation when available)
     def get_unread_count(self, obj):
+        if hasattr(obj, 'my_unread_count'):
+            return obj.my_unread_count or 0
         request = self.context.get('request')
         if not request or not request.user.is_authenticated:
             return 0
@@ -127,8 +169,26 @@ class ConversationCreateSerializer(serializers.Serializer):
     username = serializers.CharField(write_only=True)
 
 
+# Serializer used to create a group conversation
+class GroupCreateSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=128)
+    usernames = serializers.ListField(
+        child=serializers.CharField(), allow_empty=True, default=list
+    )
+
+
+# Serializer used to add members to a group conversation
+class GroupMembersSerializer(serializers.Serializer):
+    usernames = serializers.ListField(child=serializers.CharField(), allow_empty=False)
+
+
+# Serializer used to delete many messages for the current user
+class MessageIdsSerializer(serializers.Serializer):
+    message_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+
 # Serializer for conversation detail page
-class ConversationDetailSerializer(serializers.ModelSerializer):
+class ConversationDetailSerializer(PresenceMixin, serializers.ModelSerializer):
     # Show participants and messages in detail view
     participants = serializers.SerializerMethodField()
     messages = MessageSerializer(many=True, read_only=True)
@@ -139,16 +199,22 @@ class ConversationDetailSerializer(serializers.ModelSerializer):
             'id',
             'slug',
             'type',
+            'name',
             'created_at',
             'participants',
             'messages'
         ]
 
+    # Message senders are primed by the nested messages list
+    def presence_user_ids(self, instance):
+        return [p.user_id for p in instance.participants.all()]
+
     # Get full user details of participants
     def get_participants(self, obj):
         return UserSerializer(
             [p.user for p in obj.participants.all()],
-            many=True
+            many=True,
+            context=self.context
         ).data
 
 
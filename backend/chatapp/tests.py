@@ -1,3 +1,1742 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DatabaseError, connection
+from django.db.models.query import QuerySet
+from django.http import Http404
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.contrib.auth.tokens import default_token_generator
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import http_date, urlsafe_base64_encode
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from .consumers import ChatConsumer
+from .middleware import (
+    JWTAuthMiddleware,
+    revoke_user_tokens,
+    revoked_key,
+    token_user_cache,
+)
+from . import messaging, metrics
+from .dbexecutor import db_executor
+from .listcache import bump_list_versions, list_version_key
+from .membership import aget_conversation, ais_member, is_member
+from .messaging import create_message, delete_for_me, delete_many_for_me
+from .models import Conversation, ConversationParticipant, Message, MessageDeletion, User
+from .presence import PresenceTracker, acache, online_key
+from .search import USER_SEARCH_MAX_PAGES
+from .serializers import MessageSerializer
+from .writebehind import seq_key, write_behind, write_messages
+from .throttling import TokenBucket, typing_coalescer, user_control_limiter, user_rate_limiter
+
+
+# Wrap a cache method so each outer call counts as one round trip
+def _counted(name):
+    def method(self, *args, **kwargs):
+        if not self._in_call:
+            with _round_trips_lock:
+                _round_trips[self._location] += 1
+        self._in_call += 1
+        try:
+            return getattr(LocMemCache, name)(self, *args, **kwargs)
+        finally:
+            self._in_call -= 1
+    return method
+
+
+# Round trips per cache location, shared by the backend instances of all
+# threads (acache runs the sync methods on worker threads)
+_round_trips = Counter()
+_round_trips_lock = threading.Lock()
+
+
+class CountingLocMemCache(LocMemCache):
+    """LocMemCache that counts calls the way a network cache counts round trips."""
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self._location = name
+        self._in_call = 0
+
+    @property
+    def round_trips(self):
+        return _round_trips[self._location]
+
+    @round_trips.setter
+    def round_trips(self, value):
+        _round_trips[self._location] = value
+
+    get = _counted("get")
+    get_many = _counted("get_many")
+    set = _counted("set")
+    set_many = _counted("set_many")
+    add = _counted("add")
+    delete = _counted("delete")
+    delete_many = _counted("delete_many")
+    incr = _counted("incr")
+    decr = _counted("decr")
+    touch = _counted("touch")
+
+
+# Tests run without Redis: use in-process cache and channel layer
+TEST_CACHES = {
+    "default": {
+        "BACKEND": "chatapp.tests.CountingLocMemCache",
+        # room for per-member keys of big groups without culling
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    }
+}
+TEST_CHANNEL_LAYERS = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+}
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    CHANNEL_LAYERS=TEST_CHANNEL_LAYERS,
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    # no periodic metrics snapshot in the middle of a measured request
+    CHAT_METRICS_PUBLISH_INTERVAL=3600,
+)
+class ChatTestCase(TestCase):
+    """Base test case with two users sharing a private conversation."""
+
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", "alice@example.com", "pass1234")
+        self.bob = User.objects.create_user("bob", "bob@example.com", "pass1234")
+        self.conv = Conversation.objects.create(
+            slug=f"prv_{self.alice.id}_{self.bob.id}", type=Conversation.TYPE_PRIVATE
+        )
+        ConversationParticipant.objects.create(conversation=self.conv, user=self.alice)
+        ConversationParticipant.objects.create(conversation=self.conv, user=self.bob)
+        self.client = APIClient()
+        self.login(self.alice)
+        self.cache = caches["default"]
+        self.cache.clear()
+        self.cache.round_trips = 0
+        user_rate_limiter.clear()
+        user_control_limiter.clear()
+        typing_coalescer.clear()
+        token_user_cache.clear()
+
+    # Authenticate a client as user: the async views read a real bearer
+    # token like in production, force_authenticate covers the DRF views
+    def login(self, user, client=None):
+        client = client or self.client
+        client.force_authenticate(user)
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+
+    # Create n messages one second apart, oldest first
+    def make_messages(self, n, conv=None, sender=None):
+        start = timezone.now() - timedelta(seconds=n)
+        return Message.objects.bulk_create([
+            Message(
+                conversation=conv or self.conv,
+                sender=sender or self.bob,
+                content=f"msg {i}",
+                timestamp=start + timedelta(seconds=i),
+            )
+            for i in range(n)
+        ])
+
+
+class MessagePaginationTests(ChatTestCase):
+    def url(self):
+        return reverse("conversation-messages", args=[self.conv.id])
+
+    def test_default_page_returns_latest_messages_in_order(self):
+        msgs = self.make_messages(5)
+        res = self.client.get(self.url(), {"limit": 3})
+        self.assertEqual(res.status_code, 200)
+        ids = [m["id"] for m in res.data["messages"]]
+        self.assertEqual(ids, [m.id for m in msgs[2:]])
+        self.assertTrue(res.data["has_more"])
+
+    def test_before_cursor_walks_back_through_history(self):
+        msgs = self.make_messages(5)
+        first = self.client.get(self.url(), {"limit": 3})
+        res = self.client.get(
+            self.url(), {"limit": 3, "before": first.data["before_cursor"]}
+        )
+        self.assertEqual([m["id"] for m in res.data["messages"]], [m.id for m in msgs[:2]])
+        self.assertFalse(res.data["has_more"])
+
+    def test_after_message_id_returns_newer_messages(self):
+        msgs = self.make_messages(5)
+        res = self.client.get(self.url(), {"after": msgs[1].id, "limit": 2})
+        self.assertEqual([m["id"] for m in res.data["messages"]], [m.id for m in msgs[2:4]])
+        self.assertTrue(res.data["has_more"])
+
+    def test_same_timestamp_is_split_by_id(self):
+        ts = timezone.now()
+        msgs = Message.objects.bulk_create([
+            Message(conversation=self.conv, sender=self.bob, content=str(i), timestamp=ts)
+            for i in range(4)
+        ])
+        res = self.client.get(self.url(), {"before": msgs[2].id})
+        self.assertEqual([m["id"] for m in res.data["messages"]], [m.id for m in msgs[:2]])
+
+    def test_invalid_cursor_is_rejected(self):
+        res = self.client.get(self.url(), {"before": "nope"})
+        self.assertEqual(res.status_code, 400)
+
+    def test_query_count_does_not_grow_with_history(self):
+        self.make_messages(10)
+        # warm the bearer token's user
+        self.client.get(self.url(), {"limit": 5})
+        with self.assertNumQueries(3):
+            self.client.get(self.url(), {"limit": 5})
+        self.make_messages(200)
+        with self.assertNumQueries(3):
+            self.client.get(self.url(), {"limit": 5})
+
+
+class MessageConditionalGetTests(ChatTestCase):
+    def fetch(self, **headers):
+        return self.client.get(
+            reverse("conversation-messages", args=[self.conv.id]), {"limit": 20}, **headers
+        )
+
+    def test_unchanged_page_is_304_without_loading_messages(self):
+        create_message(self.conv, self.bob, "hello")
+        first = self.fetch()
+        self.assertEqual(first["Cache-Control"], "private, no-cache")
+        # conversation and participant rows only
+        with self.assertNumQueries(2):
+            res = self.fetch(HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res["ETag"], first["ETag"])
+
+    def test_changes_in_the_same_second_are_not_hidden(self):
+        create_message(self.conv, self.bob, "hello")
+        first = self.fetch()
+        # whole-second dates cannot tell this change apart: only the ETag validates
+        self.assertFalse(first.has_header("Last-Modified"))
+        create_message(self.conv, self.bob, "again")
+        res = self.fetch(HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 1))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.data["messages"]), 2)
+
+    def test_changes_invalidate_the_etag(self):
+        message = create_message(self.conv, self.bob, "hello")
+        etag = self.fetch()["ETag"]
+        self.assertNotEqual(self.client.get(
+            reverse("conversation-messages", args=[self.conv.id]), {"limit": 10},
+            HTTP_IF_NONE_MATCH=etag,
+        ).status_code, 304)
+
+        create_message(self.conv, self.bob, "again")
+        res = self.fetch(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        etag = res["ETag"]
+
+        delete_for_me(message, self.alice)
+        res = self.fetch(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.data["messages"]), 1)
+
+    def test_large_pages_are_gzipped(self):
+        self.make_messages(50)
+        res = self.client.get(
+            reverse("conversation-messages", args=[self.conv.id]),
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+        self.assertEqual(res["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", res["Vary"])
+
+
+class DeleteForMeTests(ChatTestCase):
+    def test_bulk_delete_skips_foreign_and_repeated_ids(self):
+        msgs = [create_message(self.conv, self.bob, f"m{i}") for i in range(3)]
+        elsewhere = Conversation.objects.create(slug="elsewhere", type=Conversation.TYPE_GLOBAL)
+        foreign = create_message(elsewhere, self.bob, "x")
+        url = reverse("conversation-delete-for-me", args=[self.conv.id])
+        ids = [msgs[0].id, msgs[1].id, foreign.id]
+        self.assertEqual(self.client.post(url, {"message_ids": ids}, format="json").json()["deleted"], ids[:2])
+        again = self.client.post(url, {"message_ids": [msgs[1].id, msgs[2].id]}, format="json")
+        self.assertEqual(again.json()["deleted"], [msgs[2].id])
+
+        rows = MessageDeletion.objects.filter(user=self.alice).order_by("seq")
+        # stamped with the seq of the last message; deletions take none
+        self.assertEqual([(r.message_id, r.seq) for r in rows], [(m.id, 3) for m in msgs])
+        self.assertEqual({r.conversation_id for r in rows}, {self.conv.id})
+
+    def test_bulk_delete_survives_concurrent_single_delete(self):
+        msgs = [create_message(self.conv, self.bob, f"m{i}") for i in range(3)]
+        real_current_seq = messaging.current_seq
+
+        # delete_for_me of msgs[1] lands between the read and the insert
+        def racing_current_seq(conversation):
+            MessageDeletion.objects.create(
+                message=msgs[1], user=self.alice, conversation=self.conv, seq=3
+            )
+            return real_current_seq(conversation)
+
+        url = reverse("conversation-delete-for-me", args=[self.conv.id])
+        with mock.patch("chatapp.messaging.current_seq", racing_current_seq):
+            res = self.client.post(url, {"message_ids": [m.id for m in msgs]}, format="json")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            sorted(MessageDeletion.objects.filter(user=self.alice).values_list("message_id", flat=True)),
+            [m.id for m in msgs],
+        )
+
+    def test_bulk_delete_query_count_is_fixed(self):
+        small = [m.id for m in self.make_messages(2)]
+        large = [m.id for m in self.make_messages(100)]
+        url = reverse("conversation-delete-for-me", args=[self.conv.id])
+        is_member(self.conv.id, self.alice.id)  # warm the membership cache
+        with CaptureQueriesContext(connection) as first:
+            self.client.post(url, {"message_ids": small}, format="json")
+        with self.assertNumQueries(len(first)):
+            self.client.post(url, {"message_ids": large}, format="json")
+
+    def test_page_ignores_deletions_in_other_rooms(self):
+        elsewhere = Conversation.objects.create(slug="elsewhere", type=Conversation.TYPE_PRIVATE)
+        ConversationParticipant.objects.create(conversation=elsewhere, user=self.alice)
+        hidden = self.make_messages(50, conv=elsewhere)
+        delete_many_for_me(elsewhere, self.alice, [m.id for m in hidden])
+        mine = self.make_messages(3)
+        delete_for_me(mine[1], self.alice)
+        data = self.client.get(reverse("conversation-messages", args=[self.conv.id])).json()
+        self.assertEqual([m["id"] for m in data["messages"]], [mine[0].id, mine[2].id])
+
+
+class MessageSearchTests(ChatTestCase):
+    def search(self, query, **params):
+        return self.client.get(reverse("message-search"), {"query": query, **params}).json()
+
+    def test_ranked_results_with_escaped_snippets(self):
+        create_message(self.conv, self.bob, "lunch at noon?")
+        best = create_message(self.conv, self.bob, "lunch lunch <b>lunch</b>")
+        create_message(self.conv, self.bob, "see you later")
+        data = self.search("lunch")
+        self.assertEqual(len(data["results"]), 2)
+        self.assertEqual(data["results"][0]["message"]["id"], best.id)
+        self.assertIn("<mark>lunch</mark>", data["results"][0]["snippet"])
+        self.assertIn("&lt;b&gt;", data["results"][0]["snippet"])
+        # the last word matches as a prefix
+        self.assertEqual(len(self.search("lun")["results"]), 2)
+
+    def test_scoped_to_visible_messages(self):
+        deleted = create_message(self.conv, self.bob, "secret plan")
+        delete_for_me(deleted, self.alice)
+        other = Conversation.objects.create(slug="not_mine", type=Conversation.TYPE_PRIVATE)
+        create_message(other, self.bob, "secret plan elsewhere")
+        kept = create_message(self.conv, self.bob, "secret plan b")
+        self.assertEqual([r["message"]["id"] for r in self.search("secret")["results"]], [kept.id])
+
+        ConversationParticipant.objects.filter(conversation=self.conv, user=self.alice).update(
+            deleted_at=timezone.now()
+        )
+        self.assertEqual(self.search("secret")["results"], [])
+
+    def test_pagination_and_bad_input(self):
+        for i in range(5):
+            create_message(self.conv, self.bob, f"report {i}")
+        first = self.search("report", limit=3)
+        second = self.search("report", limit=3, page=2)
+        self.assertTrue(first["has_more"])
+        self.assertFalse(second["has_more"])
+        ids = [r["message"]["id"] for r in first["results"] + second["results"]]
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(self.search('"unbalanced AND (')["results"], [])
+        self.assertEqual(
+            self.client.get(reverse("message-search"), {"query": "x", "page": "a"}).status_code, 400
+        )
+
+
+class UserSearchTests(ChatTestCase):
+    def search(self, query, **params):
+        return self.client.get(reverse("user-search"), {"query": query, **params})
+
+    def test_exact_then_partners_then_others(self):
+        for name in ("bobby", "bo", "bobcat"):
+            User.objects.create_user(name, f"{name}@example.com", "pass1234")
+        User.objects.create_user("abob", "abob@example.com", "pass1234")
+        names = [u["username"] for u in self.search("BO").json()]
+        # bob shares a conversation with alice; abob is not a prefix match
+        self.assertEqual(names, ["bo", "bob", "bobby", "bobcat"])
+        self.assertEqual(self.search("ali").json(), [])
+
+    def test_pages_are_capped_and_cached(self):
+        for i in range(60):
+            User.objects.create_user(f"carl{i:02d}", f"carl{i}@example.com", "pass1234")
+        first = self.search("carl", limit=500)
+        self.assertEqual(len(first.json()), 50)
+        self.assertEqual(first["X-Has-More"], "true")
+        second = self.search("carl", limit=50, page=2)
+        self.assertEqual(len(second.json()), 10)
+        self.assertEqual(second["X-Has-More"], "false")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search("carl", limit=50, page=2).json(), second.json())
+
+    def test_matches_are_shared_between_callers(self):
+        for i in range(3):
+            User.objects.create_user(f"carl{i}", f"carl{i}@example.com", "pass1234")
+        self.search("carl")
+        self.login(self.bob)
+        # only bob's conversation partners are read
+        with self.assertNumQueries(1):
+            names = [u["username"] for u in self.search("CARL ").json()]
+        self.assertEqual(names, ["carl0", "carl1", "carl2"])
+
+    def test_deep_pages_are_clamped(self):
+        with mock.patch("chatapp.views.search_users", return_value=([], True)) as search:
+            res = self.search("carl", limit=5, page=10**9)
+        self.assertEqual(search.call_args.args[2:], ((USER_SEARCH_MAX_PAGES - 1) * 5, 5))
+        self.assertEqual(res["X-Has-More"], "false")
+
+
+class BootstrapTests(ChatTestCase):
+    def make_rooms(self, n):
+        start = Conversation.objects.count()
+        for i in range(start, start + n):
+            other = User.objects.create_user(f"peer{i}", f"peer{i}@example.com", "pw")
+            conv = Conversation.objects.create(slug=f"boot_{i}", type=Conversation.TYPE_PRIVATE)
+            ConversationParticipant.objects.bulk_create([
+                ConversationParticipant(conversation=conv, user=self.alice),
+                ConversationParticipant(conversation=conv, user=other),
+            ])
+            self.make_messages(3, conv=conv, sender=other)
+
+    def bootstrap(self, **params):
+        return self.client.get(reverse("bootstrap"), params)
+
+    def test_returns_user_list_presence_and_active_page(self):
+        self.make_messages(5)
+        self.cache.set(online_key(self.bob.id), True)
+        data = self.bootstrap(conversation=self.conv.id, limit=2).json()
+        self.assertEqual(data["user"]["username"], "alice")
+        self.assertEqual([c["id"] for c in data["conversations"]], [self.conv.id])
+        self.assertEqual(data["presence"], {str(self.bob.id): True})
+        self.assertEqual(data["active"]["conversation_id"], self.conv.id)
+        self.assertEqual([m["content"] for m in data["active"]["messages"]], ["msg 3", "msg 4"])
+        self.assertTrue(data["active"]["has_more"])
+
+    def test_active_room_must_be_in_the_list(self):
+        other = Conversation.objects.create(slug="elsewhere", type=Conversation.TYPE_PRIVATE)
+        self.assertIsNone(self.bootstrap(conversation=other.id).json()["active"])
+
+    def test_query_and_cache_budget_is_constant(self):
+        self.make_rooms(2)
+        with CaptureQueriesContext(connection) as small:
+            self.bootstrap(conversation=self.conv.id)
+        self.make_rooms(20)
+        self.cache.round_trips = 0
+        with self.assertNumQueries(len(small)):
+            self.bootstrap(conversation=self.conv.id)
+        self.assertEqual(len(small), 4)
+        self.assertEqual(self.cache.round_trips, 1)
+
+
+class ConversationSyncTests(ChatTestCase):
+    def sync(self, since, **params):
+        return self.client.get(
+            reverse("conversation-sync", args=[self.conv.id]), {"since": since, **params}
+        )
+
+    def test_returns_messages_and_deletions_after_seq(self):
+        first, second = [create_message(self.conv, self.bob, f"m{i}") for i in range(2)]
+        self.assertEqual(delete_for_me(first, self.alice), True)
+        self.assertEqual(delete_for_me(first, self.alice), False)
+        third = create_message(self.conv, self.bob, "m2")
+
+        # the deletion took no seq: messages stay numbered without gaps
+        self.assertEqual(third.seq, 3)
+        data = self.sync(second.seq).json()
+        self.assertEqual([m["id"] for m in data["messages"]], [third.id])
+        self.assertEqual(data["deleted"], [first.id])
+        self.assertEqual((data["last_seq"], data["has_more"]), (3, False))
+        # nothing new after the returned seq
+        data = self.sync(data["last_seq"]).json()
+        self.assertEqual((data["messages"], data["deleted"]), ([], []))
+
+    def test_deletion_at_the_clients_seq_is_returned(self):
+        first, second = [create_message(self.conv, self.bob, f"m{i}") for i in range(2)]
+        # the client has seen seq 2, then deletes from another device
+        delete_for_me(first, self.alice)
+        data = self.sync(second.seq).json()
+        self.assertEqual((data["messages"], data["deleted"]), ([], [first.id]))
+
+    def test_concurrent_delete_for_me_is_not_an_error(self):
+        message = create_message(self.conv, self.bob, "m")
+        delete_for_me(message, self.alice)
+        get = QuerySet.get
+        missed = []
+
+        # the other request inserts between this one's lookup and insert
+        def racing_get(qs, *args, **kwargs):
+            if qs.model is MessageDeletion and not missed:
+                missed.append(True)
+                raise MessageDeletion.DoesNotExist
+            return get(qs, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, "get", racing_get):
+            self.assertEqual(delete_for_me(message, self.alice), False)
+        self.assertEqual(MessageDeletion.objects.filter(message=message).count(), 1)
+
+    def test_has_more_continues_from_last_seq(self):
+        for i in range(5):
+            create_message(self.conv, self.bob, f"m{i}")
+        data = self.sync(0, limit=3).json()
+        self.assertEqual([m["seq"] for m in data["messages"]], [1, 2, 3])
+        self.assertEqual((data["last_seq"], data["has_more"]), (3, True))
+        data = self.sync(3, limit=3).json()
+        self.assertEqual([m["seq"] for m in data["messages"]], [4, 5])
+
+    def test_query_count_does_not_depend_on_history(self):
+        self.make_messages(300)
+        create_message(self.conv, self.bob, "new")
+        with self.assertNumQueries(4):
+            self.assertEqual(self.sync(0).status_code, 200)
+
+    def test_rejects_bad_since_and_outsiders(self):
+        self.assertEqual(self.sync("x").status_code, 400)
+        self.assertEqual(self.sync(0, limit="abc").status_code, 400)
+        self.assertEqual(self.sync(0, limit=0).status_code, 400)
+        self.login(User.objects.create_user("eve", "eve@example.com", "pw"))
+        self.assertEqual(self.sync(0).status_code, 403)
+
+
+class ConversationListTests(ChatTestCase):
+    def add_private_conversation(self, i):
+        other = User.objects.create_user(f"user{i}", f"user{i}@example.com", "pass1234")
+        conv = Conversation.objects.create(slug=f"prv_test_{i}", type=Conversation.TYPE_PRIVATE)
+        ConversationParticipant.objects.create(conversation=conv, user=self.alice, unread_count=i)
+        ConversationParticipant.objects.create(conversation=conv, user=other)
+        self.make_messages(2, conv=conv, sender=other)
+        return conv
+
+    def test_list_includes_last_message_and_unread_count(self):
+        conv = self.add_private_conversation(3)
+        res = self.client.get(reverse("conversations"))
+        self.assertEqual(res.status_code, 200)
+        row = next(c for c in res.data if c["id"] == conv.id)
+        self.assertEqual(row["unread_count"], 3)
+        self.assertEqual(row["last_message"]["content"], "msg 1")
+        self.assertEqual(len(row["participants"]), 2)
+        empty = next(c for c in res.data if c["id"] == self.conv.id)
+        self.assertIsNone(empty["last_message"])
+
+    def test_query_count_is_constant(self):
+        for i in range(3):
+            self.add_private_conversation(i)
+        # the first request also loads the bearer token's user
+        with self.assertNumQueries(4):
+            self.client.get(reverse("conversations"))
+        for i in range(3, 20):
+            self.add_private_conversation(i)
+        # fixtures bypass the views, so drop the cached list by hand
+        bump_list_versions([self.alice.id])
+        with self.assertNumQueries(3):
+            res = self.client.get(reverse("conversations"))
+        self.assertEqual(len(res.data), 21)
+
+    def test_cached_list_is_invalidated_by_events(self):
+        url = reverse("conversations")
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(cached.status_code, 304)
+
+        bob = APIClient()
+        self.login(self.bob, bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            bob.post(reverse("conversation-messages", args=[self.conv.id]), {"content": "hi"})
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data[0]["unread_count"], 1)
+        self.assertEqual(res.data[0]["last_message"]["content"], "hi")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("conversation-mark-read", args=[self.conv.id]))
+        self.assertEqual(self.client.get(url).data[0]["unread_count"], 0)
+
+    def test_presence_is_fresh_and_part_of_the_etag(self):
+        url = reverse("conversations")
+        first = self.client.get(url)
+        self.client.get(url)
+        self.cache.set(online_key(self.bob.id), True)
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(res.status_code, 200)
+        bob = next(p for p in res.data[0]["participants"] if p["id"] == self.bob.id)
+        self.assertTrue(bob["is_online"])
+        self.assertNotEqual(res["ETag"], first["ETag"])
+
+
+class PresenceBatchingTests(ChatTestCase):
+    def test_message_page_uses_one_cache_round_trip(self):
+        carol = User.objects.create_user("carol", "carol@example.com", "pass1234")
+        self.make_messages(5, sender=self.bob)
+        self.make_messages(5, sender=carol)
+        self.cache.set(online_key(self.bob.id), True)
+        self.cache.round_trips = 0
+        res = self.client.get(reverse("conversation-messages", args=[self.conv.id]))
+        # presence, plus the bearer token's revocation check
+        self.assertEqual(self.cache.round_trips, 2)
+        online = {m["sender"]["id"]: m["sender"]["is_online"] for m in res.data["messages"]}
+        self.assertEqual(online, {self.bob.id: True, carol.id: False})
+
+    def test_conversation_list_uses_one_cache_round_trip(self):
+        for i in range(5):
+            other = User.objects.create_user(f"user{i}", f"user{i}@example.com", "pass1234")
+            conv = Conversation.objects.create(slug=f"prv_test_{i}", type=Conversation.TYPE_PRIVATE)
+            ConversationParticipant.objects.create(conversation=conv, user=self.alice)
+            ConversationParticipant.objects.create(conversation=conv, user=other)
+            self.make_messages(1, conv=conv, sender=other)
+        # every request also reads the bearer token's revocation
+        # cold list: version read and create, presence, store
+        self.client.get(reverse("conversations"))
+        self.assertEqual(self.cache.round_trips, 5)
+        # cached list: version and list in one get_many, then presence
+        self.cache.round_trips = 0
+        self.client.get(reverse("conversations"))
+        self.assertEqual(self.cache.round_trips, 3)
+
+    def test_conversation_detail_uses_one_cache_round_trip(self):
+        self.client.post(reverse("conversations"), {"username": "bob"})
+        # presence, plus the bearer token's revocation check
+        self.assertEqual(self.cache.round_trips, 2)
+
+    def test_single_message_serializer_still_reports_status(self):
+        msg = self.make_messages(1)[0]
+        self.cache.set(online_key(self.bob.id), True)
+        self.assertTrue(MessageSerializer(msg).data["sender"]["is_online"])
+
+
+class PresenceTrackerTests(ChatTestCase):
+    async def test_heartbeats_are_coalesced_per_ttl_window(self):
+        tracker = PresenceTracker()
+        await tracker.connect(self.alice.id)
+        self.assertEqual(self.cache.round_trips, 2)
+        self.cache.round_trips = 0
+        for _ in range(20):
+            await tracker.heartbeat(self.alice.id)
+        self.assertEqual(self.cache.round_trips, 0)
+        self.assertTrue(self.cache.get(online_key(self.alice.id)))
+
+    async def test_closing_one_of_two_sockets_keeps_user_online(self):
+        tracker = PresenceTracker()
+        await tracker.connect(self.alice.id)
+        await tracker.connect(self.alice.id)
+        self.assertFalse(await tracker.disconnect(self.alice.id))
+        self.assertTrue(self.cache.get(online_key(self.alice.id)))
+        self.assertTrue(await tracker.disconnect(self.alice.id))
+        self.assertIsNone(self.cache.get(online_key(self.alice.id)))
+
+    async def test_sockets_on_other_workers_are_counted(self):
+        worker_a, worker_b = PresenceTracker(), PresenceTracker()
+        await worker_a.connect(self.alice.id)
+        await worker_b.connect(self.alice.id)
+        self.assertFalse(await worker_a.disconnect(self.alice.id))
+        self.assertTrue(self.cache.get(online_key(self.alice.id)))
+
+
+@override_settings(CHAT_PRESENCE_DEBOUNCE=0)
+class PresenceAnnouncementTests(ChatTestCase):
+    async def listen(self, user):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(f"user_{user.id}", channel)
+        return layer, channel
+
+    async def test_online_is_announced_once_to_contacts(self):
+        layer, channel = await self.listen(self.bob)
+        tracker = PresenceTracker()
+        self.assertTrue(await tracker.announce(layer, self.alice.id, True))
+        self.assertFalse(await tracker.announce(layer, self.alice.id, True))
+        event = await layer.receive(channel)
+        self.assertEqual(
+            json.loads(event["text"]),
+            {"type": "presence_changed", "user_id": self.alice.id, "is_online": True},
+        )
+
+    async def test_reconnect_within_debounce_cancels_offline(self):
+        layer, channel = await self.listen(self.bob)
+        tracker = PresenceTracker()
+        await tracker.connect(self.alice.id)
+        await tracker.announce(layer, self.alice.id, True)
+        await layer.receive(channel)
+        self.assertTrue(await tracker.disconnect(self.alice.id))
+        task = tracker.announce_offline_later(layer, self.alice.id)
+        await tracker.connect(self.alice.id)
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertTrue(task.cancelled() or task.done())
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.05)
+
+    async def test_offline_is_announced_after_debounce(self):
+        layer, channel = await self.listen(self.bob)
+        tracker = PresenceTracker()
+        await tracker.connect(self.alice.id)
+        await tracker.announce(layer, self.alice.id, True)
+        await layer.receive(channel)
+        await tracker.disconnect(self.alice.id)
+        await tracker.announce_offline_later(layer, self.alice.id)
+        event = await layer.receive(channel)
+        self.assertFalse(json.loads(event["text"])["is_online"])
+
+
+class MessageBroadcastTests(ChatTestCase):
+    def test_post_broadcasts_full_message_with_sequence(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f"chat_{self.conv.id}", channel)
+        url = reverse("conversation-messages", args=[self.conv.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.client.post(url, {"content": "hello"})
+            second = self.client.post(url, {"content": "again"})
+        self.assertEqual((first.data["seq"], second.data["seq"]), (1, 2))
+
+        event = async_to_sync(layer.receive)(channel)
+        self.assertEqual(event["type"], "chat_message_broadcast")
+        frame = json.loads(event["text"])
+        self.assertEqual(frame["seq"], 1)
+        self.assertEqual(frame["message"]["content"], "hello")
+        self.assertEqual(frame["message"]["sender"]["id"], self.alice.id)
+        self.assertEqual(json.loads(async_to_sync(layer.receive)(channel)["text"])["seq"], 2)
+        self.conv.refresh_from_db()
+        self.assertEqual(self.conv.last_seq, 2)
+
+
+class ConsumerTestMixin:
+    """Helpers to open ChatConsumer sockets without the JWT middleware."""
+
+    # room=None opens a multiplexed socket (ws/chat/)
+    async def open_socket(self, user, room=None):
+        path = "/ws/chat/" if room is None else f"/ws/chat/{room}/"
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), path)
+        communicator.scope["user"] = user
+        kwargs = {} if room is None else {"conversation_id": str(room)}
+        communicator.scope["url_route"] = {"kwargs": kwargs}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    # Read frames until one of the given type arrives
+    async def receive_type(self, communicator, frame_type, timeout=1):
+        while True:
+            frame = await communicator.receive_json_from(timeout)
+            if frame["type"] == frame_type:
+                return frame
+
+    # Read every frame that is already queued or arrives shortly
+    async def drain(self, communicator, timeout=0.1):
+        frames = []
+        while not await communicator.receive_nothing(timeout):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+
+class ConsumerMessageTests(ConsumerTestMixin, ChatTestCase):
+    async def test_chat_message_is_delivered_to_room_members(self):
+        alice = await self.open_socket(self.alice, self.conv.id)
+        bob = await self.open_socket(self.bob, self.conv.id)
+        await alice.send_json_to({"type": "chat_message", "content": "hi bob"})
+        frame = await self.receive_type(bob, "new_message")
+        self.assertEqual(frame["seq"], 1)
+        self.assertEqual(frame["message"]["content"], "hi bob")
+        await alice.disconnect()
+        await bob.disconnect()
+
+    def test_message_in_global_room_updates_members_lists(self):
+        room = Conversation.objects.create(slug="global", type=Conversation.TYPE_GLOBAL)
+        ConversationParticipant.objects.create(conversation=room, user=self.bob)
+        bump_list_versions([self.bob.id])
+        before = self.cache.get(list_version_key(self.bob.id))
+
+        async def scenario():
+            alice = await self.open_socket(self.alice, room.id)
+            await alice.send_json_to({"type": "chat_message", "content": "hi"})
+            await self.receive_type(alice, "new_message")
+            await alice.disconnect()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            async_to_sync(scenario)()
+        self.assertNotEqual(self.cache.get(list_version_key(self.bob.id)), before)
+
+    async def test_failed_unread_update_rolls_back_the_message(self):
+        alice = await self.open_socket(self.alice, self.conv.id)
+        with mock.patch("chatapp.consumers.increment_unread", side_effect=DatabaseError), \
+                self.assertLogs("chatapp.consumers", "ERROR"):
+            await alice.send_json_to({"type": "chat_message", "content": "hi bob"})
+            await self.receive_type(alice, "connection_established")
+            self.assertTrue(await alice.receive_nothing(0.2))
+        await database_sync_to_async(self.conv.refresh_from_db)()
+        self.assertEqual(self.conv.last_seq, 0)
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 0)
+        await alice.disconnect()
+
+
+class MultiplexedSocketTests(ConsumerTestMixin, ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = Conversation.objects.create(
+            slug="private_other", type=Conversation.TYPE_PRIVATE
+        )
+        carol = User.objects.create_user(username="carol", password="pw")
+        ConversationParticipant.objects.create(conversation=self.other, user=self.bob)
+        ConversationParticipant.objects.create(conversation=self.other, user=carol)
+
+    async def test_subscribe_send_and_unsubscribe(self):
+        alice = await self.open_socket(self.alice)
+        bob = await self.open_socket(self.bob)
+        for comm in (alice, bob):
+            await comm.send_json_to({"type": "subscribe", "conversation_id": self.conv.id})
+            frame = await self.receive_type(comm, "subscribed")
+            self.assertEqual(frame["conversation_id"], self.conv.id)
+
+        await alice.send_json_to(
+            {"type": "chat_message", "conversation_id": self.conv.id, "content": "hi"}
+        )
+        frame = await self.receive_type(bob, "new_message")
+        self.assertEqual(frame["message"]["content"], "hi")
+
+        await bob.send_json_to({"type": "unsubscribe", "conversation_id": self.conv.id})
+        await self.receive_type(bob, "unsubscribed")
+        await alice.send_json_to(
+            {"type": "chat_message", "conversation_id": self.conv.id, "content": "again"}
+        )
+        self.assertNotIn("new_message", [f["type"] for f in await self.drain(bob)])
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_membership_checked_per_subscription(self):
+        alice = await self.open_socket(self.alice)
+        await alice.send_json_to({"type": "subscribe", "conversation_id": self.other.id})
+        frame = await self.receive_type(alice, "error")
+        self.assertEqual(frame["conversation_id"], self.other.id)
+
+        # frames for rooms the socket is not subscribed to are refused
+        await alice.send_json_to(
+            {"type": "chat_message", "conversation_id": self.other.id, "content": "hi"}
+        )
+        await self.receive_type(alice, "error")
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 0)
+        await alice.disconnect()
+
+
+class TypingFanoutTests(ConsumerTestMixin, ChatTestCase):
+    async def test_typing_reaches_others_but_not_the_typist(self):
+        alice = await self.open_socket(self.alice, self.conv.id)
+        bob = await self.open_socket(self.bob, self.conv.id)
+        await alice.send_json_to({"type": "typing", "is_typing": True})
+        frame = await self.receive_type(bob, "typing_indicator")
+        self.assertEqual((frame["user_id"], frame["is_typing"]), (self.alice.id, True))
+        self.assertNotIn("typing_indicator", [f["type"] for f in await self.drain(alice)])
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class RateLimitTests(ConsumerTestMixin, ChatTestCase):
+    def test_token_bucket_refills(self):
+        bucket = TokenBucket(rate=2, burst=2)
+        now = bucket.updated
+        self.assertEqual([bucket.take(now), bucket.take(now)], [0, 0])
+        self.assertAlmostEqual(bucket.take(now), 0.5)
+        self.assertEqual(bucket.take(now + 0.5), 0)
+
+    async def send_messages(self, comm, n):
+        for i in range(n):
+            await comm.send_json_to({"type": "chat_message", "content": f"m{i}"})
+
+    @override_settings(CHAT_CONNECTION_MESSAGE_BURST=2, CHAT_CONNECTION_MESSAGE_RATE=0.1)
+    async def test_connection_limit_sends_error_frame(self):
+        alice = await self.open_socket(self.alice, self.conv.id)
+        await self.send_messages(alice, 3)
+        frame = await self.receive_type(alice, "error")
+        self.assertEqual(frame["code"], "rate_limited")
+        self.assertGreater(frame["retry_after"], 0)
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 2)
+        await alice.disconnect()
+
+    @override_settings(CHAT_USER_MESSAGE_BURST=3, CHAT_USER_MESSAGE_RATE=0.1)
+    async def test_user_limit_is_shared_by_sockets(self):
+        first = await self.open_socket(self.alice, self.conv.id)
+        second = await self.open_socket(self.alice, self.conv.id)
+        await self.send_messages(first, 2)
+        # let the first socket's messages through before the second one sends
+        for _ in range(2):
+            await self.receive_type(first, "new_message")
+        await self.send_messages(second, 2)
+        frame = await self.receive_type(second, "error")
+        self.assertEqual(frame["code"], "rate_limited")
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 3)
+        await first.disconnect()
+        await second.disconnect()
+
+    @override_settings(CHAT_RATE_LIMIT_GLOBAL=True, CHAT_USER_MESSAGE_BURST=2, CHAT_USER_MESSAGE_RATE=0.1)
+    def test_global_mode_counts_in_cache(self):
+        take = async_to_sync(user_rate_limiter.take)
+        self.assertEqual([take(self.alice.id), take(self.alice.id)], [0, 0])
+        self.assertGreater(take(self.alice.id), 0)
+        # the local buckets were not used
+        user_rate_limiter.clear()
+        self.assertGreater(take(self.alice.id), 0)
+
+    @override_settings(CHAT_USER_CONTROL_BURST=2, CHAT_USER_CONTROL_RATE=0.1)
+    async def test_control_frames_are_limited(self):
+        alice = await self.open_socket(self.alice)
+        await alice.send_json_to({"type": "subscribe", "conversation_id": self.conv.id})
+        await alice.send_json_to({"type": "typing", "conversation_id": self.conv.id})
+        await alice.send_json_to({"type": "subscribe", "conversation_id": 10**6})
+        frame = await self.receive_type(alice, "error")
+        self.assertEqual(frame["code"], "rate_limited")
+        self.assertGreater(frame["retry_after"], 0)
+        await alice.disconnect()
+
+    @override_settings(CHAT_TYPING_INTERVAL_MS=100)
+    async def test_typing_is_coalesced(self):
+        alice = await self.open_socket(self.alice, self.conv.id)
+        bob = await self.open_socket(self.bob, self.conv.id)
+        for is_typing in (True, False, True, False):
+            await alice.send_json_to({"type": "typing", "is_typing": is_typing})
+        await asyncio.sleep(0.2)
+        frames = [f for f in await self.drain(bob) if f["type"] == "typing_indicator"]
+        # first event right away, the rest merged into the latest state
+        self.assertEqual([f["is_typing"] for f in frames], [True, False])
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class DatabaseExecutorTests(ConsumerTestMixin, ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        db_executor.reset_stats()
+
+    def test_conversation_lookups_are_cached(self):
+        with self.assertNumQueries(2):  # conversation, membership
+            for _ in range(3):
+                conv = async_to_sync(aget_conversation)(self.conv.id)
+                self.assertTrue(async_to_sync(ais_member)(conv.id, self.alice.id))
+        self.assertEqual(conv.type, Conversation.TYPE_PRIVATE)
+        self.assertIsNone(async_to_sync(aget_conversation)("no_such_room"))
+
+    def test_missing_conversations_are_cached_until_created(self):
+        next_id = Conversation.objects.order_by("-id").first().id + 1
+        lookup = async_to_sync(aget_conversation)
+        with self.assertNumQueries(1):
+            for _ in range(3):
+                self.assertIsNone(lookup(next_id))
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(
+                reverse("conversation-group-create"), {"name": "g", "usernames": ["bob"]}, format="json"
+            )
+        self.assertEqual(res.data["id"], next_id)
+        self.assertEqual(lookup(next_id).type, Conversation.TYPE_GROUP)
+
+    async def test_consumer_writes_are_counted(self):
+        alice = await self.open_socket(self.alice, self.conv.id)
+        await alice.send_json_to({"type": "chat_message", "content": "hi"})
+        await self.receive_type(alice, "new_message")
+        stats = db_executor.stats()
+        self.assertGreaterEqual(stats["calls"], 1)
+        self.assertEqual(stats["errors"], 0)
+        self.assertEqual(stats["in_flight"], 0)
+        await alice.disconnect()
+
+    @override_settings(CHAT_DB_THREADS=2)
+    def test_dedicated_threads(self):
+        name = async_to_sync(db_executor.run)(lambda: threading.current_thread().name)
+        self.assertTrue(name.startswith("chat-db"))
+        self.assertEqual(db_executor.stats()["threads"], 2)
+
+
+@override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_TYPES=["global"])
+class WriteBehindTests(ConsumerTestMixin, ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.room = Conversation.objects.create(slug="global", type=Conversation.TYPE_GLOBAL)
+
+    async def test_message_is_broadcast_before_it_is_written(self):
+        alice = await self.open_socket(self.alice, self.room.id)
+        bob = await self.open_socket(self.bob, self.room.id)
+        await alice.send_json_to({"type": "chat_message", "content": "hi", "client_id": "c1"})
+        ack = await self.receive_type(alice, "message_ack")
+        self.assertEqual((ack["seq"], ack["client_id"]), (1, "c1"))
+        frame = await self.receive_type(bob, "new_message")
+        self.assertEqual((frame["seq"], frame["message"]["content"]), (1, "hi"))
+        self.assertIsNone(frame["message"]["id"])
+        self.assertEqual(frame["message"]["uuid"], ack["uuid"])
+
+        await write_behind.drain()
+        message = await database_sync_to_async(Message.objects.get)(conversation=self.room)
+        self.assertEqual(message.seq, 1)
+        # the flush tells the room the id of each queued message
+        saved = await self.receive_type(bob, "messages_saved")
+        self.assertEqual(saved["messages"], [{"uuid": ack["uuid"], "id": message.id, "seq": 1}])
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_delete_for_me_is_stamped_with_queued_seq(self):
+        first = await database_sync_to_async(create_message)(self.room, self.bob, "a")
+        alice = await self.open_socket(self.alice, self.room.id)
+        await alice.send_json_to({"type": "chat_message", "content": "b"})
+        self.assertEqual((await self.receive_type(alice, "message_ack"))["seq"], 2)
+        # not flushed yet: last_seq is still 1, the client has seen 2
+        await database_sync_to_async(delete_for_me)(first, self.alice)
+        deletion = await database_sync_to_async(MessageDeletion.objects.get)(message=first)
+        self.assertEqual(deletion.seq, 2)
+        await write_behind.drain()
+        await alice.disconnect()
+
+    async def test_lost_counter_does_not_reuse_queued_seqs(self):
+        alice = await self.open_socket(self.alice, self.room.id)
+        await alice.send_json_to({"type": "chat_message", "content": "a"})
+        self.assertEqual((await self.receive_type(alice, "message_ack"))["seq"], 1)
+        # evicted before the flush raised last_seq
+        await acache("delete", seq_key(self.room.id))
+        await alice.send_json_to({"type": "chat_message", "content": "b"})
+        self.assertEqual((await self.receive_type(alice, "message_ack"))["seq"], 2)
+        await write_behind.drain()
+        await alice.disconnect()
+
+    async def test_reused_seq_is_renumbered_not_dropped(self):
+        alice = await self.open_socket(self.alice, self.room.id)
+        await alice.send_json_to({"type": "chat_message", "content": "a"})
+        await self.receive_type(alice, "message_ack")
+        # another worker wrote seq 1 after the counter was lost
+        await database_sync_to_async(Message.objects.create)(
+            conversation=self.room, sender=self.bob, content="other", seq=1
+        )
+        with self.assertLogs("chatapp.writebehind", "ERROR"):
+            await write_behind.drain()
+        saved = await self.receive_type(alice, "messages_saved")
+        [row] = saved["messages"]
+        message = await database_sync_to_async(Message.objects.get)(uuid=row["uuid"])
+        self.assertEqual((message.content, message.seq), ("a", 2))
+        self.assertEqual((row["id"], row["seq"]), (message.id, 2))
+        await alice.disconnect()
+
+    def test_flush_is_one_insert_and_one_update_per_conversation(self):
+        batch = [
+            Message(conversation=self.conv, sender=sender, content="x", seq=seq)
+            for seq, sender in enumerate([self.alice, self.alice, self.bob], start=1)
+        ]
+        batch.append(Message(conversation=self.room, sender=self.bob, content="y", seq=7))
+        # a global room with a member: listed for them like any other room
+        ConversationParticipant.objects.create(conversation=self.room, user=self.alice)
+        versions = [self.cache.get(list_version_key(self.alice.id))]
+        # bulk insert + (unread, last_seq) per room + members of both rooms
+        # (conversation list invalidation)
+        with self.captureOnCommitCallbacks(execute=True), \
+                self.assertNumQueries(6 + 2):  # + savepoint and release
+            write_messages(batch)
+        versions.append(self.cache.get(list_version_key(self.alice.id)))
+        self.assertNotEqual(*versions)
+        unread = dict(
+            ConversationParticipant.objects.filter(conversation=self.conv)
+            .values_list("user_id", "unread_count")
+        )
+        self.assertEqual(unread, {self.alice.id: 1, self.bob.id: 2})
+        self.assertEqual(self.room.participants.get(user=self.alice).unread_count, 1)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 7)
+
+    def test_http_post_shares_the_sequence_counter(self):
+        self.client.post(reverse("conversation-messages", args=[self.room.id]), {"content": "a"})
+        self.client.post(reverse("conversation-messages", args=[self.room.id]), {"content": "b"})
+        seqs = list(Message.objects.filter(conversation=self.room).values_list("seq", flat=True))
+        self.assertEqual(sorted(seqs), [1, 2])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 2)
+
+
+class MessagePostFanoutTests(ChatTestCase):
+    def make_room(self, members):
+        conv = Conversation.objects.create(slug=f"room_{members}", type=Conversation.TYPE_GLOBAL)
+        ConversationParticipant.objects.create(conversation=conv, user=self.alice)
+        users = [
+            User(username=f"m{members}_{i}", email=f"m{members}_{i}@example.com")
+            for i in range(members)
+        ]
+        User.objects.bulk_create(users)
+        ConversationParticipant.objects.bulk_create([
+            ConversationParticipant(conversation=conv, user=u, unread_count=2) for u in users
+        ])
+        return conv, users
+
+    def post(self, conv):
+        return self.client.post(
+            reverse("conversation-messages", args=[conv.id]), {"content": "hi all"}
+        )
+
+    def test_unread_counts_and_list_updates(self):
+        conv, users = self.make_room(3)
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f"user_{users[0].id}", channel)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.post(conv).status_code, 201)
+        counts = set(
+            ConversationParticipant.objects.filter(conversation=conv)
+            .exclude(user=self.alice).values_list("unread_count", flat=True)
+        )
+        self.assertEqual(counts, {3})
+        frame = json.loads(async_to_sync(layer.receive)(channel)["text"])
+        self.assertEqual(frame, {"type": "chat_list_update", "conversation_id": conv.id, "unread_count": 3})
+
+    def test_query_count_does_not_grow_with_members(self):
+        small, _ = self.make_room(2)
+        large, _ = self.make_room(40)
+        self.post(small)  # warm up
+        self.post(large)
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as few:
+            self.post(small)
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as many:
+            self.post(large)
+        self.assertEqual(len(few), len(many))
+
+
+class GroupConversationTests(ChatTestCase):
+    def make_group(self, members):
+        users = [
+            User(username=f"g{i}", email=f"g{i}@example.com") for i in range(members)
+        ]
+        User.objects.bulk_create(users)
+        res = self.client.post(
+            reverse("conversation-group-create"),
+            {"name": "team", "usernames": [u.username for u in users]},
+            format="json",
+        )
+        self.assertEqual(res.status_code, 201)
+        return Conversation.objects.get(pk=res.data["id"]), list(User.objects.filter(username__startswith="g"))
+
+    def test_create_group_returns_list_item(self):
+        res = self.client.post(
+            reverse("conversation-group-create"),
+            {"name": "team", "usernames": ["bob"]},
+            format="json",
+        )
+        self.assertEqual(res.data["type"], Conversation.TYPE_GROUP)
+        self.assertEqual(res.data["name"], "team")
+        self.assertEqual(res.data["participant_count"], 2)
+
+    def test_outsider_cannot_post_or_read(self):
+        conv, _ = self.make_group(2)
+        outsider = User.objects.create_user("eve", "eve@example.com", "pass1234")
+        self.login(outsider)
+        url = reverse("conversation-messages", args=[conv.id])
+        self.assertEqual(self.client.post(url, {"content": "hi"}).status_code, 403)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_added_member_gets_access_despite_cached_denial(self):
+        conv, _ = self.make_group(1)
+        url = reverse("conversation-messages", args=[conv.id])
+        self.login(self.bob)
+        self.assertEqual(self.client.post(url, {"content": "hi"}).status_code, 403)
+        self.login(self.alice)
+        self.client.post(reverse("conversation-members", args=[conv.id]), {"usernames": ["bob"]}, format="json")
+        self.login(self.bob)
+        self.assertEqual(self.client.post(url, {"content": "hi"}).status_code, 201)
+
+    def test_member_list_is_paginated(self):
+        conv, _ = self.make_group(5)
+        url = reverse("conversation-members", args=[conv.id])
+        first = self.client.get(url, {"limit": 4})
+        self.assertEqual(len(first.data["members"]), 4)
+        self.assertTrue(first.data["has_more"])
+        rest = self.client.get(url, {"limit": 4, "after": first.data["after_cursor"]})
+        self.assertEqual(len(rest.data["members"]), 2)
+        self.assertFalse(rest.data["has_more"])
+
+
+class GroupLoadTests(ChatTestCase):
+    """500-member rooms: sends, listing and membership checks stay flat."""
+
+    MEMBERS = 500
+
+    def setUp(self):
+        super().setUp()
+        users = [
+            User(username=f"load{i}", email=f"load{i}@example.com")
+            for i in range(self.MEMBERS - 1)
+        ]
+        User.objects.bulk_create(users)
+        self.group = Conversation.objects.create(
+            slug="grp_load", type=Conversation.TYPE_GROUP, name="load"
+        )
+        ConversationParticipant.objects.bulk_create([
+            ConversationParticipant(conversation=self.group, user=u)
+            for u in [self.alice, *User.objects.filter(username__startswith="load")]
+        ])
+
+    def test_send_in_500_member_room(self):
+        url = reverse("conversation-messages", args=[self.group.id])
+        small_url = reverse("conversation-messages", args=[self.conv.id])
+        self.client.post(url, {"content": "warm up"})
+        self.client.post(small_url, {"content": "warm up"})
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as large:
+            start = time.perf_counter()
+            res = self.client.post(url, {"content": "hello 500"})
+            elapsed = time.perf_counter() - start
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as small:
+            self.client.post(small_url, {"content": "hi"})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(large), len(small))
+        self.assertLess(elapsed, 2.0)
+        self.assertEqual(
+            ConversationParticipant.objects.filter(conversation=self.group, unread_count=2).count(),
+            self.MEMBERS - 1,
+        )
+
+    def test_list_shows_preview_of_500_member_room(self):
+        res = self.client.get(reverse("conversations"))
+        row = next(c for c in res.data if c["id"] == self.group.id)
+        self.assertEqual(row["participant_count"], self.MEMBERS)
+        self.assertEqual(len(row["participants"]), 10)
+
+    def test_membership_check_is_cached(self):
+        url = reverse("conversation-messages", args=[self.group.id])
+        self.client.post(url, {"content": "first"})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url, {"content": "second"})
+        self.assertFalse(any("chatapp_conversationparticipant" in q["sql"] and "LIMIT 1" in q["sql"] for q in queries))
+
+
+class AsyncViewTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("conversation-messages", args=[self.conv.id])
+
+    def test_bearer_token_skips_user_query_when_cached(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.alice)}")
+        client.post(self.url, {"content": "warm up"})
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            res = client.post(self.url, {"content": "hi"}, format="json")
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.json()["content"], "hi")
+        self.assertFalse(any('FROM "chatapp_user"' in q["sql"] for q in queries))
+
+    def test_missing_or_invalid_token_is_401(self):
+        client = APIClient()
+        self.assertEqual(client.get(self.url).status_code, 401)
+        client.credentials(HTTP_AUTHORIZATION="Bearer not-a-token")
+        self.assertEqual(client.post(self.url, {"content": "hi"}).status_code, 401)
+
+    def test_errors_are_json(self):
+        res = self.client.post(self.url, "{", content_type="application/json")
+        self.assertEqual(res.status_code, 400)
+        missing = reverse("conversation-messages", args=[10**6])
+        self.assertEqual(self.client.post(missing, {"content": "hi"}).json(), {"detail": "Not found."})
+
+    def test_mark_read(self):
+        self.make_messages(2)
+        ConversationParticipant.objects.filter(user=self.alice).update(unread_count=2)
+        url = reverse("conversation-mark-read", args=[self.conv.id])
+        self.assertEqual(self.client.post(url).json(), {"ok": True})
+        self.assertEqual(ConversationParticipant.objects.get(user=self.alice).unread_count, 0)
+        self.login(User.objects.create_user("eve", "eve@example.com", "x"))
+        self.assertEqual(self.client.post(url).status_code, 403)
+        missing = reverse("conversation-mark-read", args=[10**6])
+        self.assertEqual(self.client.post(missing).status_code, 404)
+
+    def test_message_broadcast_reaches_room(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f"chat_{self.conv.id}", channel)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.url, {"content": "hello"})
+        frame = json.loads(async_to_sync(layer.receive)(channel)["text"])
+        self.assertEqual(frame["message"]["content"], "hello")
+
+
+class JWTAuthCacheTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.token = str(AccessToken.for_user(self.alice))
+
+    async def handshake(self, token):
+        scopes = []
+
+        async def app(scope, receive, send):
+            scopes.append(scope)
+
+        await JWTAuthMiddleware(app)({"query_string": f"token={token}".encode()}, None, None)
+        return scopes[0]["user"]
+
+    def test_repeat_handshake_skips_database(self):
+        async_to_sync(self.handshake)(self.token)
+        with CaptureQueriesContext(connection) as queries:
+            user = async_to_sync(self.handshake)(self.token)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual((user.id, user.username), (self.alice.id, "alice"))
+        self.assertTrue(user.is_authenticated)
+
+    def test_cached_user_keeps_permission_flags(self):
+        User.objects.filter(pk=self.alice.pk).update(is_staff=True)
+        async_to_sync(self.handshake)(self.token)
+        user = async_to_sync(self.handshake)(self.token)
+        self.assertEqual((user.is_staff, user.is_superuser), (True, False))
+
+    async def test_invalid_token_is_anonymous(self):
+        user = await self.handshake("not-a-token")
+        self.assertTrue(user.is_anonymous)
+
+    def test_logout_or_password_change_revokes_token(self):
+        async_to_sync(self.handshake)(self.token)
+        revoke_user_tokens(self.alice.id)
+        self.assertTrue(async_to_sync(self.handshake)(self.token).is_anonymous)
+        # not cached any more: the database path refuses it too
+        token_user_cache.clear()
+        self.assertTrue(async_to_sync(self.handshake)(self.token).is_anonymous)
+
+    def test_change_password_revokes_tokens(self):
+        async_to_sync(self.handshake)(self.token)
+        self.client.post(
+            reverse("change-password"),
+            {"old_password": "pass1234", "new_password": "A-much-better-pass-99"},
+        )
+        self.assertEqual(len(token_user_cache), 0)
+        self.assertTrue(async_to_sync(self.handshake)(self.token).is_anonymous)
+
+    def test_logout_revokes_socket_access(self):
+        async_to_sync(self.handshake)(self.token)
+        refresh = RefreshToken.for_user(self.alice)
+        response = self.client.post(reverse("logout"), {"refresh": str(refresh)})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(async_to_sync(self.handshake)(self.token).is_anonymous)
+
+    def test_drf_views_refuse_token_after_logout(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        self.assertEqual(client.get(reverse("current-user")).status_code, 200)
+        refresh = str(RefreshToken.for_user(self.alice))
+        self.assertEqual(client.post(reverse("logout"), {"refresh": refresh}).status_code, 200)
+        self.assertEqual(client.get(reverse("current-user")).status_code, 401)
+        self.assertEqual(client.get(reverse("bootstrap")).status_code, 401)
+        # tokens issued after the revocation are accepted
+        self.cache.set(revoked_key(self.alice.id), time.time() - 60)
+        self.assertEqual(client.get(reverse("current-user")).status_code, 200)
+
+    def test_revocation_from_another_worker_is_seen(self):
+        async_to_sync(self.handshake)(self.token)
+        self.cache.set(revoked_key(self.alice.id), time.time() + 1)
+        with CaptureQueriesContext(connection) as queries:
+            user = async_to_sync(self.handshake)(self.token)
+        self.assertEqual(len(queries), 0)
+        self.assertTrue(user.is_anonymous)
+
+    def test_token_issued_after_revocation_is_accepted(self):
+        self.cache.set(revoked_key(self.alice.id), time.time() - 60)
+        user = async_to_sync(self.handshake)(self.token)
+        self.assertEqual(user.id, self.alice.id)
+        self.assertEqual(async_to_sync(self.handshake)(self.token).id, self.alice.id)
+
+
+class PerformanceBudgetTests(ConsumerTestMixin, ChatTestCase):
+    """
+    Query, cache round-trip and wall-time budgets for every endpoint in
+    chatapp/urls.py and every ChatConsumer frame type, on seeded volumes:
+    60 conversations per user, a 2000-message history with 500 of them
+    deleted, 40-member groups. Repeatable requests and frames are measured
+    warm (a similar one first); budgets are maximums, raise one only
+    together with the change that needs it.
+    """
+
+    CONTACTS = 50
+    GROUPS = 10
+    GROUP_MEMBERS = 40
+    HISTORY = 2000
+    DELETED = 500
+
+    # Upper bound on the wall time of any request or frame (catches
+    # blowups, not noise)
+    MAX_SECONDS = 0.5
+
+    # name -> (max queries, max cache round trips); the async views
+    # (conversations, messages, mark read) read the bearer token's
+    # revocation in one more cache round trip
+    BUDGETS = {
+        # REST reads
+        "conversations": (0, 3),
+        "conversations (rebuilt)": (3, 4),
+        "messages": (3, 2),
+        "messages (older page)": (3, 2),
+        "messages (not modified)": (2, 1),
+        "bootstrap": (4, 1),
+        "sync": (4, 0),
+        "members": (2, 2),
+        "user search": (0, 1),
+        "user search (uncached)": (2, 2),
+        "message search": (2, 1),
+        "current user": (0, 1),
+        "user detail": (1, 1),
+        # REST writes
+        "send message": (8, 5),
+        "mark read": (1, 2),
+        "create private conversation": (6, 3),
+        "create group": (7, 3),
+        "add members": (5, 3),
+        "delete message for me": (7, 1),
+        "delete messages for me": (8, 1),
+        "hide conversation": (2, 1),
+        "change password": (1, 2),
+        "logout": (8, 2),
+        "register": (4, 0),
+        "send reset password": (1, 0),
+        "reset password": (2, 2),
+        # ChatConsumer frames
+        "ws connect room": (0, 4),
+        "ws connect list": (0, 3),
+        "ws subscribe": (0, 2),
+        "ws unsubscribe": (0, 0),
+        "ws chat_message": (6, 1),
+        "ws delete_message": (7, 1),
+        "ws typing": (0, 0),
+        "ws ping": (0, 0),
+        "ws unknown type": (0, 0),
+        "ws invalid json": (0, 0),
+        "ws disconnect": (0, 2),
+    }
+
+    def setUp(self):
+        super().setUp()
+        contacts = [
+            User(username=f"contact{i}", email=f"contact{i}@example.com")
+            for i in range(self.CONTACTS)
+        ]
+        User.objects.bulk_create(contacts)
+        self.contacts = list(User.objects.filter(username__startswith="contact").order_by("id"))
+        Conversation.objects.bulk_create([
+            Conversation(slug=f"prv_{self.alice.id}_{c.id}", type=Conversation.TYPE_PRIVATE)
+            for c in self.contacts
+        ] + [
+            Conversation(slug=f"grp_budget{i}", type=Conversation.TYPE_GROUP, name=f"group {i}")
+            for i in range(self.GROUPS)
+        ])
+        privates = Conversation.objects.filter(slug__startswith=f"prv_{self.alice.id}_").exclude(pk=self.conv.pk)
+        self.groups = list(Conversation.objects.filter(slug__startswith="grp_budget").order_by("id"))
+        members = [self.alice, self.bob, *self.contacts][:self.GROUP_MEMBERS]
+        ConversationParticipant.objects.bulk_create([
+            ConversationParticipant(conversation=conv, user=user, unread_count=3)
+            for conv, other in zip(privates.order_by("id"), self.contacts)
+            for user in (self.alice, other)
+        ] + [
+            ConversationParticipant(conversation=group, user=user, unread_count=3)
+            for group in self.groups
+            for user in members
+        ])
+        for conv, sender in [*zip(privates, self.contacts), *((g, self.bob) for g in self.groups)]:
+            self.make_messages(20, conv=conv, sender=sender)
+        history = self.make_messages(self.HISTORY)
+        MessageDeletion.objects.bulk_create([
+            MessageDeletion(message=m, user=self.alice) for m in history[::self.HISTORY // self.DELETED]
+        ])
+        self.history = history
+
+    # Run send() and return its result, query count, cache round trips and seconds
+    def measure(self, send):
+        self.cache.round_trips = 0
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            result = send()
+            elapsed = time.perf_counter() - start
+        return result, queries, self.cache.round_trips, elapsed
+
+    def assertWithinBudget(self, name, queries, round_trips, elapsed):
+        max_queries, max_round_trips = self.BUDGETS[name]
+        sql = "\n".join(q["sql"] for q in queries)
+        self.assertLessEqual(len(queries), max_queries, f"{name}: queries over budget\n{sql}")
+        self.assertLessEqual(round_trips, max_round_trips, f"{name}: cache round trips over budget")
+        if elapsed is not None:
+            self.assertLess(elapsed, self.MAX_SECONDS, f"{name}: too slow")
+
+    # Measure a request; warm=True sends it once before measuring
+    def check_request(self, name, send, status=200, warm=False):
+        with self.subTest(name):
+            if warm:
+                send()
+            response, queries, round_trips, elapsed = self.measure(send)
+            self.assertEqual(response.status_code, status, name)
+            self.assertWithinBudget(name, queries, round_trips, elapsed)
+            return response
+
+    def test_read_endpoints(self):
+        get = self.client.get
+        conv_url = reverse("conversation-messages", args=[self.conv.id])
+        group = self.groups[0]
+        self.check_request("conversations", lambda: get(reverse("conversations")), warm=True)
+        bump_list_versions([self.alice.id])
+        res = self.check_request("conversations (rebuilt)", lambda: get(reverse("conversations")))
+        self.assertEqual(len(res.data), self.CONTACTS + self.GROUPS + 1)
+        page = self.check_request("messages", lambda: get(conv_url), warm=True)
+        self.check_request(
+            "messages (older page)",
+            lambda: get(conv_url, {"before": page.data["before_cursor"]}), warm=True,
+        )
+        self.check_request(
+            "messages (not modified)",
+            lambda: get(conv_url, HTTP_IF_NONE_MATCH=page["ETag"]), status=304,
+        )
+        self.check_request(
+            "bootstrap", lambda: get(reverse("bootstrap"), {"conversation": self.conv.id}), warm=True
+        )
+        self.check_request(
+            "sync", lambda: get(reverse("conversation-sync", args=[self.conv.id]), {"since": 0}),
+            warm=True,
+        )
+        self.check_request(
+            "members", lambda: get(reverse("conversation-members", args=[group.id])), warm=True
+        )
+        user_search = reverse("user-search")
+        self.check_request("user search", lambda: get(user_search, {"query": "contact1"}), warm=True)
+        self.check_request("user search (uncached)", lambda: get(user_search, {"query": "con"}))
+        self.check_request(
+            "message search", lambda: get(reverse("message-search"), {"query": "msg"}), warm=True
+        )
+        self.check_request("current user", lambda: get(reverse("current-user")), warm=True)
+        self.check_request("user detail", lambda: get(reverse("user-detail", args=[self.bob.id])), warm=True)
+
+    def test_write_endpoints(self):
+        post = self.client.post
+        conv_url = reverse("conversation-messages", args=[self.conv.id])
+        group = self.groups[0]
+        self.check_request(
+            "send message", lambda: post(conv_url, {"content": "hi"}), status=201, warm=True
+        )
+        self.check_request(
+            "mark read", lambda: post(reverse("conversation-mark-read", args=[self.conv.id])), warm=True
+        )
+        self.check_request(
+            "create private conversation",
+            lambda: post(reverse("conversations"), {"username": "contact1"}), warm=True,
+        )
+        self.check_request(
+            "create group",
+            lambda: post(
+                reverse("conversation-group-create"),
+                {"name": "new", "usernames": [c.username for c in self.contacts[:20]]},
+                format="json",
+            ),
+            status=201,
+        )
+        newcomers = iter(self.contacts[-10:])
+        self.check_request(
+            "add members",
+            lambda: post(
+                reverse("conversation-members", args=[group.id]),
+                {"usernames": [next(newcomers).username]}, format="json",
+            ),
+            warm=True,
+        )
+        own = iter(self.make_messages(2, sender=self.alice))
+        self.check_request(
+            "delete message for me",
+            lambda: post(reverse("message-delete-for-me", args=[next(own).id])), warm=True,
+        )
+        batches = iter([self.history[1:51], self.history[51:101]])
+        self.check_request(
+            "delete messages for me",
+            lambda: post(
+                reverse("conversation-delete-for-me", args=[self.conv.id]),
+                {"message_ids": [m.id for m in next(batches)]}, format="json",
+            ),
+            warm=True,
+        )
+        self.check_request(
+            "hide conversation",
+            lambda: post(reverse("conversation-hide-for-me", args=[group.id])), warm=True,
+        )
+        self.check_request(
+            "change password",
+            lambda: post(
+                reverse("change-password"),
+                {"old_password": "pass1234", "new_password": "A-much-better-pass-99"},
+            ),
+        )
+        self.check_request(
+            "logout",
+            lambda: post(reverse("logout"), {"refresh": str(RefreshToken.for_user(self.alice))}),
+        )
+        anonymous = APIClient()
+        self.check_request(
+            "register",
+            lambda: anonymous.post(
+                reverse("register"),
+                {"username": "carol", "email": "carol@example.com", "password": "pass1234"},
+            ),
+            status=201,
+        )
+        self.check_request(
+            "send reset password",
+            lambda: anonymous.post(reverse("reset-password"), {"email": "bob@example.com"}),
+        )
+        self.check_request(
+            "reset password",
+            lambda: anonymous.post(reverse("reset-password-confirm"), {
+                "uid": urlsafe_base64_encode(force_bytes(self.bob.pk)),
+                "token": default_token_generator.make_token(self.bob),
+                "new_password": "Another-good-pass-42",
+            }),
+        )
+
+    def test_consumer_frames(self):
+        group = self.groups[0]
+
+        async def scenario():
+            count = database_sync_to_async(lambda: len(connection.queries))
+            since = database_sync_to_async(lambda start: connection.queries[start:])
+
+            # Measure one step: its queries, cache round trips and seconds
+            async def step(name, action, timed=True):
+                before, self.cache.round_trips = await count(), 0
+                start = time.perf_counter()
+                await action()
+                elapsed = time.perf_counter() - start if timed else None
+                self.assertWithinBudget(name, await since(before), self.cache.round_trips, elapsed)
+
+            async def exchange(socket, frame, reply, on=None):
+                await socket.send_json_to(frame)
+                await self.receive_type(on or socket, reply)
+
+            warm = await self.open_socket(self.alice, self.conv.id)
+            await warm.disconnect()
+            sockets = {}
+
+            async def connect_room():
+                sockets["room"] = await self.open_socket(self.alice, self.conv.id)
+                await self.receive_type(sockets["room"], "connection_established")
+
+            async def connect_list():
+                sockets["list"] = await self.open_socket(self.alice)
+
+            await step("ws connect room", connect_room)
+            await step("ws connect list", connect_list)
+            room, multiplexed = sockets["room"], sockets["list"]
+            bob = await self.open_socket(self.bob, self.conv.id)
+
+            subscribe = {"type": "subscribe", "conversation_id": group.id}
+            unsubscribe = {"type": "unsubscribe", "conversation_id": group.id}
+            await exchange(multiplexed, subscribe, "subscribed")
+            await exchange(multiplexed, unsubscribe, "unsubscribed")
+            await step("ws subscribe", lambda: exchange(multiplexed, subscribe, "subscribed"))
+            await step("ws unsubscribe", lambda: exchange(multiplexed, unsubscribe, "unsubscribed"))
+
+            chat = {"type": "chat_message", "content": "hi"}
+            await exchange(room, chat, "new_message")
+            await step("ws chat_message", lambda: exchange(room, chat, "new_message"))
+            own = await database_sync_to_async(
+                lambda: list(self.make_messages(2, sender=self.alice))
+            )()
+            await exchange(room, {"type": "delete_message", "message_id": own[0].id}, "message_deleted")
+            await step(
+                "ws delete_message",
+                lambda: exchange(room, {"type": "delete_message", "message_id": own[1].id}, "message_deleted"),
+            )
+            await step(
+                "ws typing",
+                lambda: exchange(room, {"type": "typing", "is_typing": True}, "typing_indicator", on=bob),
+            )
+
+            async def ping():
+                await room.send_json_to({"type": "ping"})
+                self.assertTrue(await room.receive_nothing(0.05))
+
+            await step("ws ping", ping, timed=False)
+            await step("ws unknown type", lambda: exchange(room, {"type": "nope"}, "error"))
+
+            async def invalid_json():
+                await room.send_to(text_data="{")
+                await self.receive_type(room, "error")
+
+            await step("ws invalid json", invalid_json)
+            await bob.disconnect()
+            await multiplexed.disconnect()
+            await step("ws disconnect", room.disconnect)
+
+        with CaptureQueriesContext(connection):
+            async_to_sync(scenario)()
+
+
+class MetricsTests(ConsumerTestMixin, ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def scrape(self):
+        admin = User.objects.create_user("root", "root@example.com", "pass1234", is_staff=True)
+        self.login(admin)
+        res = self.client.get(reverse("metrics"))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res["Content-Type"].startswith("text/plain; version=0.0.4"))
+        return res.content.decode()
+
+    def test_endpoint_is_admin_only(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+
+    def test_http_views_are_counted(self):
+        self.client.post(reverse("conversation-messages", args=[self.conv.id]), {"content": "hi"})
+        text = self.scrape()
+        worker = metrics.current_worker()
+        self.assertIn(
+            f'chat_http_requests_total{{view="ConversationMessageView",method="POST",status="201",worker="{worker}"}} 1.0',
+            text,
+        )
+        self.assertIn(f'chat_message_save_seconds_count{{source="http",worker="{worker}"}} 1', text)
+        self.assertIn("# TYPE chat_http_request_seconds histogram", text)
+
+    def test_consumer_is_counted(self):
+        async def scenario():
+            alice = await self.open_socket(self.alice, self.conv.id)
+            await alice.send_json_to({"type": "chat_message", "content": "hi"})
+            await self.receive_type(alice, "new_message")
+            await alice.send_json_to({"type": "no_such_type"})
+            await self.receive_type(alice, "error")
+            self.assertEqual(metrics.ws_connections.values[()], 1)
+            await alice.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(metrics.ws_connections.values[()], 0)
+        self.assertEqual(metrics.ws_connects.values[("accepted",)], 1)
+        self.assertEqual(metrics.ws_frames.values[("chat_message",)], 1)
+        self.assertEqual(metrics.ws_frames.values[("unknown",)], 1)
+        # histogram values: [count per bucket..., +Inf count, sum]
+        self.assertEqual(sum(metrics.message_save_seconds.values[("ws",)][:-1]), 1)
+        self.assertGreaterEqual(sum(metrics.group_send_seconds.values[()][:-1]), 1)
+        self.assertGreaterEqual(sum(metrics.db_wait_seconds.values[()][:-1]), 1)
+
+    def test_snapshots_of_other_workers_are_rendered(self):
+        metrics.auth_results.inc("cached")
+        async_to_sync(metrics.publisher.publish)()
+        other = [("chat_auth_total", "counter", "Bearer token lookups by result",
+                  [("chat_auth_total", {"result": "database"}, 2.0)])]
+        self.cache.set(metrics.worker_key("otherhost:1"), other)
+        self.cache.set(metrics.WORKERS_KEY, [metrics.current_worker(), "otherhost:1"])
+        text = self.scrape()
+        self.assertIn('chat_auth_total{result="database",worker="otherhost:1"} 2.0', text)
+        self.assertIn(f'chat_auth_total{{result="cached",worker="{metrics.current_worker()}"}} 1.0', text)
+        self.assertEqual(text.count("# TYPE chat_auth_total counter"), 1)
+
+    def test_only_database_errors_are_counted(self):
+        def raise_(exc):
+            raise exc
+
+        for exc in (Http404(), DatabaseError()):
+            with self.assertRaises(type(exc)):
+                async_to_sync(db_executor.run)(raise_, exc)
+        self.assertEqual(metrics.db_errors.values[()], 1)
+
+    @override_settings(CHAT_METRICS=False)
+    def test_disabled(self):
+        self.client.post(reverse("conversation-messages", args=[self.conv.id]), {"content": "hi"})
+        self.assertEqual(metrics.snapshot(), [(m.name, m.type, m.documentation, []) for m in metrics.registry])
@@ -0,0 +1,255 @@
+"""
+This file contains rate limiting and backpressure for ChatConsumer.
+- TokenBucket: per-connection limit on chat_message frames
+- UserRateLimiter: per-user limit shared by all sockets of the user, kept
+  in process memory or, in global mode, in the cache (Redis) for all workers
+- UserControlRateLimiter: the same for subscribe, delete_message and typing
+  frames, which also reach the cache or the database executor
+- TypingCoalescer: at most one typing event per interval per user per room
+- WriteGate: caps message writes in flight per worker, so one client cannot
+  fill the database executor (dbexecutor) used by every socket
+"""
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from .presence import acache
+
+logger = logging.getLogger(__name__)
+
+# Default chat_message limits: tokens refilled per second and bucket size
+DEFAULT_CONNECTION_MESSAGE_RATE = 5
+DEFAULT_CONNECTION_MESSAGE_BURST = 10
+DEFAULT_USER_MESSAGE_RATE = 10
+DEFAULT_USER_MESSAGE_BURST = 20
+
+# Default subscribe/delete_message/typing limits per user
+DEFAULT_USER_CONTROL_RATE = 20
+DEFAULT_USER_CONTROL_BURST = 40
+
+# Default minimum milliseconds between typing events of a user in a room
+DEFAULT_TYPING_INTERVAL_MS = 1000
+
+# Default message writes in flight per worker
+DEFAULT_MAX_PENDING_WRITES = 32
+
+# Local entries kept before idle ones are pruned
+PRUNE_THRESHOLD = 10000
+
+
+def setting(name, default):
+    return getattr(settings, name, default)
+
+
+# Cache key counting a user's frames of one kind in one global rate-limit window
+def rate_key(user_id, window, kind="msg"):
+    return f"ratelimit:{kind}:{user_id}:{window}"
+
+
+class TokenBucket:
+    """
+    Classic token bucket: holds up to `burst` tokens, refilled at `rate`
+    tokens per second. take() spends one token if available.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Returns 0 when allowed, otherwise seconds until a token is available
+    def take(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    # Whether the bucket would be full again by now (safe to forget)
+    def idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class UserRateLimiter:
+    """
+    chat_message limit per user across all of the user's sockets.
+    Local mode keeps one TokenBucket per user in this worker. Global mode
+    (CHAT_RATE_LIMIT_GLOBAL) counts messages in the cache with one atomic
+    incr per message over fixed windows of burst/rate seconds, so the
+    limit holds across workers.
+    """
+
+    kind = "msg"
+
+    def __init__(self):
+        self._buckets = {}  # user_id -> TokenBucket
+
+    @property
+    def rate(self):
+        return setting("CHAT_USER_MESSAGE_RATE", DEFAULT_USER_MESSAGE_RATE)
+
+    @property
+    def burst(self):
+        return setting("CHAT_USER_MESSAGE_BURST", DEFAULT_USER_MESSAGE_BURST)
+
+    async def take(self, user_id):
+        """Returns 0 when allowed, otherwise seconds to wait before retrying."""
+        if setting("CHAT_RATE_LIMIT_GLOBAL", False):
+            return await self._take_global(user_id)
+        return self._take_local(user_id)
+
+    def _take_local(self, user_id):
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= PRUNE_THRESHOLD:
+                self._prune(now)
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket.take(now)
+
+    async def _take_global(self, user_id):
+        period = self.burst / self.rate
+        now = time.time()
+        window = int(now // period)
+        key = rate_key(user_id, window, self.kind)
+        try:
+            if await acache("add", key, 1, timeout=int(period) + 1):
+                count = 1
+            else:
+                count = await acache("incr", key)
+        except Exception:
+            # cache unavailable: fall back to this worker's bucket
+            logger.exception("Global rate limit failed")
+            return self._take_local(user_id)
+        if count <= self.burst:
+            return 0
+        return (window + 1) * period - now
+
+    def _prune(self, now):
+        for user_id in [u for u, b in self._buckets.items() if b.idle(now)]:
+            del self._buckets[user_id]
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class UserControlRateLimiter(UserRateLimiter):
+    """
+    Per-user limit on subscribe, delete_message and typing frames: cheaper
+    than a message each, but a flood of them (e.g. subscribes to unknown
+    ids) would still keep the database executor busy.
+    """
+
+    kind = "control"
+
+    @property
+    def rate(self):
+        return setting("CHAT_USER_CONTROL_RATE", DEFAULT_USER_CONTROL_RATE)
+
+    @property
+    def burst(self):
+        return setting("CHAT_USER_CONTROL_BURST", DEFAULT_USER_CONTROL_BURST)
+
+
+class TypingCoalescer:
+    """
+    Forwards at most one typing event per interval for each (user, room).
+    Frames arriving inside the interval are merged: only the latest state
+    is sent when the interval ends, so a "stopped typing" is never lost.
+    """
+
+    def __init__(self):
+        self._last_sent = {}  # (user_id, conversation_id) -> monotonic time
+        self._pending = {}  # (user_id, conversation_id) -> latest is_typing
+
+    @property
+    def interval(self):
+        return setting("CHAT_TYPING_INTERVAL_MS", DEFAULT_TYPING_INTERVAL_MS) / 1000
+
+    async def submit(self, key, is_typing, send):
+        """
+        Send is_typing through the coroutine function `send` now, later
+        (merged with newer frames) or not at all. Returns True if sent now.
+        """
+        if key in self._pending:
+            self._pending[key] = is_typing
+            return False
+        now = time.monotonic()
+        last = self._last_sent.get(key)
+        if last is None or now - last >= self.interval:
+            if len(self._last_sent) >= PRUNE_THRESHOLD:
+                self._prune(now)
+            self._last_sent[key] = now
+            await send(is_typing)
+            return True
+        self._pending[key] = is_typing
+        asyncio.get_running_loop().create_task(
+            self._send_later(key, last + self.interval - now, send)
+        )
+        return False
+
+    async def _send_later(self, key, delay, send):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            is_typing = self._pending.pop(key, None)
+        self._last_sent[key] = time.monotonic()
+        try:
+            await send(is_typing)
+        except Exception:
+            logger.exception("Coalesced typing event failed")
+
+    def _prune(self, now):
+        for key in [k for k, t in self._last_sent.items() if now - t >= self.interval]:
+            del self._last_sent[key]
+
+    def clear(self):
+        self._last_sent.clear()
+        self._pending.clear()
+
+
+class WriteGate:
+    """
+    Counts message writes in flight in this worker. When the limit is
+    reached new writes are refused at once (the client gets an error
+    frame) instead of queueing behind everyone else's database work.
+    """
+
+    def __init__(self):
+        self.pending = 0
+
+    @property
+    def limit(self):
+        return setting("CHAT_MAX_PENDING_WRITES", DEFAULT_MAX_PENDING_WRITES)
+
+    def acquire(self):
+        if self.pending >= self.limit:
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+
+# Connection-level bucket for a new socket
+def connection_bucket():
+    return TokenBucket(
+        setting("CHAT_CONNECTION_MESSAGE_RATE", DEFAULT_CONNECTION_MESSAGE_RATE),
+        setting("CHAT_CONNECTION_MESSAGE_BURST", DEFAULT_CONNECTION_MESSAGE_BURST),
+    )
+
+
+# Shared limiters for all consumers in this worker
+user_rate_limiter = UserRateLimiter()
+user_control_limiter = UserControlRateLimiter()
+typing_coalescer = TypingCoalescer()
+write_gate = WriteGate()
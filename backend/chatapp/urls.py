@@ -4,15 +4,22 @@ from . import views
 urlpatterns = [
     path('register/', views.RegisterView.as_view(), name='register'),
     path('users/me/', views.CurrentUserView.as_view(), name='current-user'),
+    path('bootstrap/', views.BootstrapView.as_view(), name='bootstrap'),
     path("users/<int:pk>/", views.UserDetailView.as_view(), name="user-detail"), # new user detail endpoint
     path('update/password/', views.ChangePasswordView.as_view(), name='change-password'),
     path('logout/', views.LogoutView.as_view(), name='logout'),
     path('conversations/', views.ConversationListCreateView.as_view(), name='conversations'),
+    path('conversations/groups/', views.GroupCreateView.as_view(), name='conversation-group-create'),
+    path('conversations/<int:pk>/members/', views.ConversationMembersView.as_view(), name='conversation-members'),
     path('conversations/<int:pk>/messages/', views.ConversationMessageView.as_view(), name='conversation-messages'),
+    path('conversations/<int:pk>/sync/', views.ConversationSyncView.as_view(), name='conversation-sync'),
     path('conversations/<int:pk>/mark_read/', views.MarkReadView.as_view(), name='conversation-mark-read'),
     path("users/search/",views.UserSearchView.as_view(),name="user-search"),
+    path("messages/search/",views.MessageSearchView.as_view(),name="message-search"),
     path("message/<int:pk>/delete-for-me/",views.MessageDeleteForMeView.as_view(),name="message-delete-for-me"),
+    path("conversations/<int:pk>/delete-for-me/",views.ConversationDeleteForMeView.as_view(),name="conversation-delete-for-me"),
     path("conversation/<int:pk>/hide-for-me/",views.ConversationHideView.as_view(),name="conversation-hide-for-me"),
     path("reset-password/", views.SendResetPasswordView.as_view(), name="reset-password"),
     path("reset-password/confirm/", views.ResetPasswordView.as_view(), name="reset-password-confirm"),
+    path("metrics/", views.MetricsView.as_view(), name="metrics"),
 ]
@@ -4,23 +4,68 @@ It includes API endpoints for user registration, conversation management,
 message handling, message deletion and conversation hiding.
 
 """ 
-from chatproject import settings
-from django.shortcuts import render, get_object_or_404
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+import hashlib
+import time
+import uuid
+from django.conf import settings
+from django.shortcuts import get_object_or_404
+from django.http import Http404, HttpResponse
 from django.contrib.auth import get_user_model
 from django.db import transaction
 from rest_framework import status, permissions, generics
-from rest_framework.decorators import api_view, permission_classes
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import method_decorator
+from django.utils.http import urlencode
+from django.views.decorators.gzip import gzip_page
 from django.contrib.auth.tokens import default_token_generator
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny
 from .models import Conversation, ConversationParticipant, Message, MessageDeletion
+from . import metrics
+from .asyncapi import AsyncAPIView, JSONResponse
+from .dbexecutor import db_executor
+from .listcache import (
+    abump_list_versions,
+    aget_cached_list,
+    arefresh_presence,
+    astore_list,
+    bump_list_versions_on_commit,
+    bump_lists_for_new_messages,
+    list_etag,
+)
+from .membership import (
+    aget_conversation,
+    ais_member,
+    forget_conversation,
+    forget_membership,
+    is_member,
+)
+from .middleware import revoke_user_tokens
+from .messaging import (
+    asend_group_events,
+    chat_list_event,
+    create_message,
+    delete_for_me,
+    delete_many_for_me,
+    increment_unread,
+    message_event,
+)
+from .pagination import InvalidCursor, encode_cursor, get_page_size, paginate_messages
+from .presence import PresenceProvider
+from .search import (
+    SEARCH_MAX_PAGE_SIZE,
+    SEARCH_PAGE_SIZE,
+    USER_SEARCH_MAX_PAGE_SIZE,
+    USER_SEARCH_MAX_PAGES,
+    USER_SEARCH_PAGE_SIZE,
+    search_messages,
+    search_users,
+)
 from django.utils import timezone
-from django.db.models import Q
+from django.db.models import Count, Exists, OuterRef, Prefetch, Subquery, prefetch_related_objects
 from .serializers import (
     ChangePasswordSerializer,
     ConversationListSerializer,
@@ -32,16 +77,140 @@ from .serializers import (
     RegisterSerializer,
     SendResetPasswordSerializer,
     ResetPasswordSerializer,
+    GroupCreateSerializer,
+    GroupMembersSerializer,
+    MessageIdsSerializer,
 )
 
 # Get the default User model
 User = get_user_model()
 
+# Default number of participants shown per conversation in the list
+PARTICIPANTS_PREVIEW = 10
+
+# Default maximum number of members in a group conversation
+GROUP_MAX_MEMBERS = 1000
+
+# Default maximum number of messages deleted for me in one request
+DELETE_MANY_MAX = 500
+
+# Messages of a conversation a user may see: not deleted for them, and
+# newer than the moment they hid the conversation (hidden_at).
+# Deletions are checked per returned row (NOT EXISTS on the unique
+# (message, user) index), so the cost does not grow with the number of
+# messages the user deleted elsewhere.
+def visible_messages(conv, user_id, hidden_at=None):
+    msgs_qs = conv.messages.select_related("sender").filter(
+        ~Exists(
+            MessageDeletion.objects.filter(message=OuterRef("pk"), user_id=user_id)
+        )
+    )
+    if hidden_at:
+        msgs_qs = msgs_qs.filter(timestamp__gt=hidden_at)
+    return msgs_qs
+
+
+def message_page_validators(conv, user_id, hidden_at, params):
+    """
+    ETag of a message page, from data the view has already loaded: the conversation's last_seq (moved by new messages) and
+    updated_at (also set by hard deletes and "delete for me"), plus the
+    user's hide time and the query.
+    Sender online status is left out; sockets push it. There is no
+    Last-Modified: HTTP dates have whole seconds, so a change later in the
+    same second would still get a 304.
+    """
+    query = urlencode(sorted(params.items()))
+    raw = f"{conv.id}:{user_id}:{conv.last_seq}:{conv.updated_at}:{hidden_at}:{query}"
+    return '"%s"' % hashlib.md5(raw.encode()).hexdigest()
+
+
+# Headers of responses clients should revalidate every time (cheap 304s)
+def set_validators(response, etag):
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 # Helper function to create a unique slug for private conversations
 def make_private_slug(a_id, b_id):
     low, high = sorted([int(a_id), int(b_id)])
     return f"prv_{low}_{high}"
 
+# Helper function to create a unique slug for group conversations
+def make_group_slug():
+    return f"grp_{uuid.uuid4().hex}"
+
+# Helper function to check if user may read/post in a conversation
+# (global rooms are open; private and group rooms need membership)
+def can_access(conv, user):
+    if conv.type == Conversation.TYPE_GLOBAL:
+        return True
+    return is_member(conv.id, user.id)
+
+
+# can_access for async views (cached membership, no query when known)
+async def acan_access(conv, user):
+    if conv.type == Conversation.TYPE_GLOBAL:
+        return True
+    return await ais_member(conv.id, user.id)
+
+
+# Helper function to load a user's conversation list with a fixed number of queries
+def get_conversation_list(user, conversation_ids=None):
+    """
+    Returns the user's conversations ready for ConversationListSerializer:
+    - unread_count (and hidden time) for this user annotated by subqueries
+    - a preview of the participants (with their users) prefetched in one query,
+      plus the total participant_count, so big groups stay cheap
+    - last message (with sender) attached from one bulk query
+    """
+    my_row = ConversationParticipant.objects.filter(
+        conversation=OuterRef("pk"), user=user
+    )
+    latest = Message.objects.filter(conversation=OuterRef("pk")).order_by(
+        "-timestamp", "-id"
+    )
+    members = (
+        ConversationParticipant.objects.filter(conversation=OuterRef("pk"))
+        .order_by()
+        .values("conversation")
+        .annotate(n=Count("id"))
+        .values("n")
+    )
+    preview = getattr(settings, "CHAT_PARTICIPANTS_PREVIEW", PARTICIPANTS_PREVIEW)
+    qs = Conversation.objects.filter(participants__user=user)
+    if conversation_ids is not None:
+        qs = qs.filter(id__in=conversation_ids)
+    convs = list(
+        qs.annotate(
+            my_unread_count=Subquery(my_row.values("unread_count")[:1]),
+            my_deleted_at=Subquery(my_row.values("deleted_at")[:1]),
+            last_message_id=Subquery(latest.values("id")[:1]),
+            participant_count=Subquery(members),
+        )
+        .prefetch_related(
+            Prefetch(
+                "participants",
+                queryset=ConversationParticipant.objects.select_related(
+                    "user"
+                ).order_by("id")[:preview],
+                to_attr="participant_preview",
+            )
+        )
+    )
+    # fetch all last messages at once instead of one query per conversation
+    last_ids = [c.last_message_id for c in convs if c.last_message_id]
+    messages = Message.objects.select_related("sender").in_bulk(last_ids)
+    for c in convs:
+        c.last_message = messages.get(c.last_message_id)
+    return convs
+
+
+# Helper function to serialize one conversation the way the list endpoint does
+def get_conversation_list_item(conversation_id, request):
+    conv = get_conversation_list(request.user, [conversation_id])[0]
+    return ConversationListSerializer(conv, context={"request": request}).data
+
 
 # Create your views here.
 
@@ -92,6 +261,8 @@ class ChangePasswordView(APIView):
 
         user.set_password(new_password)
         user.save()
+        # refuse access tokens issued before the change, sockets included
+        revoke_user_tokens(user.id)
 
         return Response(
             {"detail": "Password updated successfully"},
@@ -99,23 +270,42 @@ class ChangePasswordView(APIView):
         )
 
 # Conversation list and creation view
-class ConversationListCreateView(APIView):
+@method_decorator(gzip_page, name="dispatch")
+class ConversationListCreateView(AsyncAPIView):
     """
-    GET: list conversations for current user
+    GET: list conversations for current user (cached per user, see
+         listcache; If-None-Match with the last ETag returns 304)
     POST: create (or return) a private conversation with another user by username
     """
 
-    permission_classes = (permissions.IsAuthenticated,) # Only authenticated users can access
     # List conversations for current user
-    def get(self, request):
-        qs = Conversation.objects.filter(participants__user=request.user).distinct() # User's conversations
+    async def get(self, request):
+        user_id = request.user.id
+        version, data = await aget_cached_list(user_id)
+        if data is None:
+            # only a stale or missing list touches the database
+            data = await db_executor.run(self.build_list, request)
+            await astore_list(user_id, version, data)
+        else:
+            # the cached list only goes stale on presence
+            await arefresh_presence(data)
+
+        etag = list_etag(version, data)
+        response = get_conditional_response(request, etag=etag) or JSONResponse(data)
+        return set_validators(response, etag)
+
+    def build_list(self, request):
+        convs = get_conversation_list(request.user) # User's conversations
         serializer = ConversationListSerializer(
-            qs, many=True, context={"request": request} # pass request context
+            convs, many=True, context={"request": request} # pass request context
         )
-        return Response(serializer.data)
-    
+        return serializer.data
+
+    async def post(self, request):
+        return await db_executor.run(self.create_private, request)
+
 # Create or return private conversation with another user
-    def post(self, request):
+    def create_private(self, request):
         serializer = ConversationCreateSerializer(data=request.data) # Deserialize incoming data
         serializer.is_valid(raise_exception=True)
         username = serializer.validated_data["username"] # target username
@@ -123,13 +313,13 @@ class ConversationListCreateView(APIView):
         try:
             other = User.objects.get(username=username) # find user
         except User.DoesNotExist:
-            return Response(
+            return JSONResponse(
                 {"detail": "User not found"}, status=status.HTTP_400_NOT_FOUND
             )
 
 # Prevent creating conversation with self
         if other.id == request.user.id:
-            return Response(
+            return JSONResponse(
                 {"detail": "Cannot create conversation with self"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
@@ -139,126 +329,376 @@ class ConversationListCreateView(APIView):
         conv, created = Conversation.objects.get_or_create(
             slug=slug, defaults={"type": Conversation.TYPE_PRIVATE}
         )
+        if created:
+            transaction.on_commit(lambda: forget_conversation(conv))
         # ensure participants exist
         ConversationParticipant.objects.get_or_create(
             conversation=conv, user=request.user
         )
         # ensure other participant exists
         ConversationParticipant.objects.get_or_create(conversation=conv, user=other)
+        bump_list_versions_on_commit([request.user.id, other.id])
+        # Load participants and messages with their users once for serialization
+        prefetch_related_objects(
+            [conv],
+            Prefetch(
+                "participants",
+                queryset=ConversationParticipant.objects.select_related("user"),
+            ),
+            Prefetch("messages", queryset=Message.objects.select_related("sender")),
+        )
         # Serialize and return the conversation data
         data = ConversationDetailSerializer(conv, context={"request": request}).data
-        return Response(
+        return JSONResponse(
             data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
         )
 
 
-# View for handling messages in a conversation
-class ConversationMessageView(APIView):
+# Group conversation creation view
+class GroupCreateView(APIView):
+    """
+    POST: create a group conversation with the current user and the given usernames
+    """
+
     permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request):
+        serializer = GroupCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        usernames = set(serializer.validated_data["usernames"])
+        max_members = getattr(settings, "CHAT_GROUP_MAX_MEMBERS", GROUP_MAX_MEMBERS)
+        if len(usernames) + 1 > max_members:
+            return Response(
+                {"detail": f"A group can have at most {max_members} members"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        members = list(User.objects.filter(username__in=usernames).exclude(id=request.user.id))
+
+        with transaction.atomic():
+            conv = Conversation.objects.create(
+                slug=make_group_slug(),
+                type=Conversation.TYPE_GROUP,
+                name=serializer.validated_data["name"],
+            )
+            # add all members with one insert
+            ConversationParticipant.objects.bulk_create([
+                ConversationParticipant(conversation=conv, user=u)
+                for u in [request.user, *members]
+            ])
+            bump_list_versions_on_commit([request.user.id, *(u.id for u in members)])
+            transaction.on_commit(lambda: forget_conversation(conv))
+
+        data = get_conversation_list_item(conv.id, request)
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+# Paginated member list of a conversation, and adding members to a group
+class ConversationMembersView(APIView):
+    """
+    GET: members ordered by join order (?after=<member id>&limit=<n>)
+    POST: add members to a group conversation by username
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, pk):
+        conv = get_object_or_404(Conversation, pk=pk)
+        if not is_member(conv.id, request.user.id):
+            return Response({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            size = get_page_size(request.query_params)
+            after = int(request.query_params.get("after") or 0)
+        except (InvalidCursor, ValueError):
+            return Response({"detail": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # keyset on the participant row id: cost does not depend on the page number
+        rows = list(
+            conv.participants.select_related("user")
+            .filter(id__gt=after)
+            .order_by("id")[: size + 1]
+        )
+        page = rows[:size]
+        return Response({
+            "members": UserSerializer(
+                [p.user for p in page], many=True, context={"request": request}
+            ).data,
+            "has_more": len(rows) > size,
+            "after_cursor": page[-1].id if page else None,
+        })
+
+    def post(self, request, pk):
+        conv = get_object_or_404(Conversation, pk=pk)
+        if not is_member(conv.id, request.user.id):
+            return Response({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
+        if conv.type != Conversation.TYPE_GROUP:
+            return Response(
+                {"detail": "Members can only be added to group conversations"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        serializer = GroupMembersSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        new_ids = list(
+            User.objects.filter(username__in=serializer.validated_data["usernames"])
+            .exclude(conversations__conversation=conv)
+            .values_list("id", flat=True)
+        )
+        max_members = getattr(settings, "CHAT_GROUP_MAX_MEMBERS", GROUP_MAX_MEMBERS)
+        if conv.participants.count() + len(new_ids) > max_members:
+            return Response(
+                {"detail": f"A group can have at most {max_members} members"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        ConversationParticipant.objects.bulk_create(
+            [ConversationParticipant(conversation=conv, user_id=uid) for uid in new_ids],
+            ignore_conflicts=True,
+        )
+        # cached "not a member" answers are stale now
+        forget_membership(conv.id, new_ids)
+        # everyone's list shows the member count
+        bump_list_versions_on_commit(conv.participants.values_list("user_id", flat=True))
+        return Response({"ok": True, "added": len(new_ids)})
+
+
+# View for handling messages in a conversation
+@method_decorator(gzip_page, name="dispatch")
+class ConversationMessageView(AsyncAPIView):
 # Retrieve the conversation object or return 404
     def get_conversation(self, pk):
         return get_object_or_404(Conversation, pk=pk)
+
+    async def get(self, request, pk):
+        return await db_executor.run(self.get_page, request, pk)
+
 # Handle GET request to list messages
-    def get(self, request, pk):
+    def get_page(self, request, pk):
         conv = self.get_conversation(pk)
-        # check membership for private conversations
-        if (
-            conv.type == Conversation.TYPE_PRIVATE
-            and not conv.participants.filter(user=request.user).exists()
-        ):
-            return Response({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
-
-        # Ensure user is a participant row (we rely on participant.deleted_at)
+        # Ensure user is a participant row (we rely on participant.deleted_at);
+        # this is also the membership check for private and group conversations
         try:
             participant = conv.participants.get(user=request.user)
         except ConversationParticipant.DoesNotExist:
-            return Response({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
+            return JSONResponse({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
 
-        # Base queryset: chronological order, with sender prefetched for fewer queries
-        msgs_qs = conv.messages.select_related("sender").order_by("timestamp")
+        # unchanged since the client's copy: answer 304 before loading messages
+        etag = message_page_validators(
+            conv, request.user.id, participant.deleted_at, request.query_params
+        )
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return set_validators(not_modified, etag)
 
-        # Exclude messages explicitly deleted by this user (MessageDeletion)
-        msgs_qs = msgs_qs.exclude(deletions__user=request.user)
+        msgs_qs = visible_messages(conv, request.user.id, participant.deleted_at)
 
-        # If this user hid the conversation previously, hide older messages
-        if participant.deleted_at:
-            msgs_qs = msgs_qs.filter(timestamp__gt=participant.deleted_at)
-        
-        # Serialize and return messages
-        serializer = MessageSerializer(msgs_qs, many=True, context={"request": request})
-        return Response({"ok": True, "messages": serializer.data})
+        # Load one page of messages by cursor (?before=, ?after=, ?limit=)
+        try:
+            page, has_more = paginate_messages(conv, msgs_qs, request.query_params)
+        except InvalidCursor as e:
+            return JSONResponse({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Serialize and return messages with cursors for the neighbouring pages
+        serializer = MessageSerializer(page, many=True, context={"request": request})
+        response = JSONResponse({
+            "ok": True,
+            "messages": serializer.data,
+            "has_more": has_more,
+            "before_cursor": encode_cursor(page[0]) if page else None,
+            "after_cursor": encode_cursor(page[-1]) if page else None,
+        })
+        return set_validators(response, etag)
 
 # Handle POST request to send a new message
-    def post(self, request, pk):
-        conv = self.get_conversation(pk) # get conversation
-        # check membership for private conversations
-        if (
-            conv.type == Conversation.TYPE_PRIVATE
-            and not conv.participants.filter(user=request.user).exists() 
-        ):
-            return Response({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
+    async def post(self, request, pk):
+        # cached conversation snapshot and membership: no query when known
+        conv = await aget_conversation(pk)
+        if conv is None:
+            raise Http404
+        if not await acan_access(conv, request.user):
+            return JSONResponse({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
         # Validate message content
         content = request.data.get("content", "").strip()
         if not content:
-            return Response(
+            return JSONResponse(
                 {"detail": "Empty Message"}, status=status.HTTP_400_BAD_REQUEST
             )
         if len(content) > 5000:
-            return Response(
+            return JSONResponse(
                 {"detail": "Message too long"}, status=status.HTTP_400_BAD_REQUEST
             )
+        start = time.perf_counter()
+        data, unread = await db_executor.run(self.save_message, conv, request.user, content)
+        metrics.message_save_seconds.observe(time.perf_counter() - start, "http")
+
+        # Notify via WebSocket once committed, in one batch: the full message
+        # to the room (clients append it without refetching) and the new
+        # unread count to each other participant
+        events = [(f"chat_{conv.id}", message_event(data))]
+        events += [
+            (f"user_{user_id}", chat_list_event(conv.id, count))
+            for user_id, count in unread
+        ]
+        await asend_group_events(events)
+        return JSONResponse(data, status=status.HTTP_201_CREATED)
+
+    def save_message(self, conv, user, content):
         # Create message inside transaction(means do with unread count increment)
         with transaction.atomic():
-            msg = Message.objects.create(
-                conversation=conv, sender=request.user, content=content
-            )
-            # Update unread counts
-            channel_layer = get_channel_layer()
-            # increment unread for other participants
-            for p in conv.participants.exclude(user=request.user):
-                p.unread_count +=  1
-                p.save(update_fields=["unread_count"])
-                # Notify via WebSocket
-                async_to_sync(channel_layer.group_send)(
-                    f"user_{p.user.id}",
-                    {
-                        "type": "chat_list_update",
-                        "conversation_id": conv.id,
-                        "unread_count": p.unread_count,
-                    },
-                )
+            msg = create_message(conv, user, content)
+            # increment unread for other participants (one UPDATE, new counts returned)
+            unread = increment_unread(conv.id, user.id)
+            # new last message and unread counts in every member's list
+            bump_lists_for_new_messages([conv.id], [user.id, *(uid for uid, _ in unread)])
+        # Serialize once: used for both the broadcast and the response
+        return MessageSerializer(msg).data, unread
+
+# View returning everything the client needs on startup in one request
+@method_decorator(gzip_page, name="dispatch")
+class BootstrapView(APIView):
+    """
+    GET /bootstrap/?conversation=<id>&limit=<n>
 
-            # Broadcast to WebSocket
-            channel_layer = get_channel_layer()
-            group_name = f"chat_{conv.id}"
-            try:
-                async_to_sync(channel_layer.group_send)(
-                    group_name,
-                    {
-                        "type": "conversation_updated",
-                        "conversation_id": conv.id,
-                    },
-                )
-            except Exception as e:
-                print(f"Error broadcasting message to group {group_name}: {e}")
-            return Response(MessageSerializer(msg).data, status=status.HTTP_201_CREATED)
+    The current user, the conversation list, online status of the users
+    shown in it and, when given, the first page of the open conversation.
+    Query budget: 3 queries for the list, 1 for the page of messages, and
+    a single cache round trip for all presence.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
 
-# View for marking a conversation as read
-class MarkReadView(APIView):
+    def get(self, request):
+        user = request.user
+        convs = get_conversation_list(user)
+
+        active = None
+        active_id = request.query_params.get("conversation")
+        if active_id:
+            conv = next((c for c in convs if str(c.id) == active_id), None)
+            if conv is not None:
+                msgs_qs = visible_messages(conv, user.id, conv.my_deleted_at)
+                try:
+                    page, has_more = paginate_messages(conv, msgs_qs, request.query_params)
+                except InvalidCursor as e:
+                    return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                active = {"conversation": conv, "page": page, "has_more": has_more}
+
+        # online status of everyone rendered below, with one get_many
+        contact_ids = {
+            p.user_id
+            for c in convs
+            for p in c.participant_preview
+            if p.user_id != user.id
+        }
+        sender_ids = {c.last_message.sender_id for c in convs if c.last_message}
+        if active:
+            sender_ids.update(m.sender_id for m in active["page"])
+        presence = PresenceProvider()
+        presence.prime(contact_ids | sender_ids | {user.id})
+        context = {"request": request, "presence": presence}
+
+        active_data = None
+        if active:
+            page = active["page"]
+            active_data = {
+                "conversation_id": active["conversation"].id,
+                "messages": MessageSerializer(page, many=True, context=context).data,
+                "has_more": active["has_more"],
+                "before_cursor": encode_cursor(page[0]) if page else None,
+                "after_cursor": encode_cursor(page[-1]) if page else None,
+            }
+
+        return Response({
+            "ok": True,
+            "user": UserSerializer(user, context=context).data,
+            "conversations": ConversationListSerializer(
+                convs, many=True, context=context
+            ).data,
+            "presence": {
+                str(uid): presence.is_online(uid) for uid in sorted(contact_ids)
+            },
+            "active": active_data,
+        })
+
+# View returning what changed in a conversation after a sequence number
+@method_decorator(gzip_page, name="dispatch")
+class ConversationSyncView(APIView):
+    """
+    GET /conversations/<pk>/sync/?since=<seq>&limit=<n>
+
+    Messages with seq > since (oldest first) and the ids of messages this
+    user deleted for themselves since then (a deletion is stamped with the
+    seq current at the time and takes none, so ids may repeat across
+    calls). Clients continue from "last_seq"; when "has_more" is true they
+    call again from there.
+    """
     permission_classes = (permissions.IsAuthenticated,)
-# Handle POST request to mark conversation as read
-    def post(self, request, pk):
-        conv = get_object_or_404(Conversation, pk=pk) # get conversation
-        # Ensure user is a participant
+
+    def get(self, request, pk):
+        conv = get_object_or_404(Conversation, pk=pk)
         try:
-            p = conv.participants.get(user=request.user) # get participant row
+            participant = conv.participants.get(user=request.user)
         except ConversationParticipant.DoesNotExist:
             return Response({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
-        # Mark as read
-        p.unread_count = 0
-        p.last_read = timezone.now()
-        p.save()
-        return Response({"ok": True})
+
+        try:
+            since = int(request.query_params.get("since", 0))
+        except (TypeError, ValueError):
+            since = -1
+        if since < 0:
+            return Response(
+                {"detail": "since must be a sequence number"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            limit = get_page_size(request.query_params)
+        except InvalidCursor:
+            return Response({"detail": "Invalid limit"}, status=status.HTTP_400_BAD_REQUEST)
+
+        rows = list(
+            visible_messages(conv, request.user.id, participant.deleted_at)
+            .filter(seq__gt=since)
+            .order_by("seq")[: limit + 1]
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        # changes are reported up to the last message returned, or up to the
+        # conversation's last seq (read before the messages) when complete
+        last_seq = conv.last_seq
+        if rows:
+            last_seq = rows[-1].seq if has_more else max(last_seq, rows[-1].seq)
+        # a deletion stamped with the client's own last seq may be newer than
+        # what it saw, so since is included
+        deleted = MessageDeletion.objects.filter(
+            user=request.user, conversation=conv, seq__gte=since
+        )
+        if has_more:
+            deleted = deleted.filter(seq__lte=last_seq)
+        deleted = deleted.values_list("message_id", flat=True)
+
+        serializer = MessageSerializer(rows, many=True, context={"request": request})
+        return Response({
+            "ok": True,
+            "messages": serializer.data,
+            "deleted": list(deleted),
+            "last_seq": max(last_seq, since),
+            "has_more": has_more,
+        })
+
+# View for marking a conversation as read
+class MarkReadView(AsyncAPIView):
+# Handle POST request to mark conversation as read
+    async def post(self, request, pk):
+        # Mark as read: one UPDATE of the user's participant row
+        updated = await ConversationParticipant.objects.filter(
+            conversation_id=pk, user_id=request.user.id
+        ).aupdate(unread_count=0, last_read=timezone.now())
+        if not updated:
+            # no participant row: a missing conversation or not a participant
+            if not await Conversation.objects.filter(pk=pk).aexists():
+                raise Http404
+            return JSONResponse({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
+        await abump_list_versions([request.user.id])
+        return JSONResponse({"ok": True})
 
 
 # GET /api/users/me/  -> returns current authenticated user
@@ -287,6 +727,7 @@ class LogoutView(APIView):
 
             token = RefreshToken(refresh_token) # create token instance
             token.blacklist() # blacklist the token
+            revoke_user_tokens(request.user.id) # refuse the user's access tokens too
             return Response({"detail": "token blacklisted"}, status=status.HTTP_200_OK)
         except Exception:
             # generic error — don't leak internal details
@@ -296,18 +737,81 @@ class LogoutView(APIView):
             )
 
 # View for searching users by username
-class UserSearchView(generics.ListAPIView):
+class UserSearchView(APIView):
+    """
+    GET /users/search/?query=<text>&page=<n>&limit=<n>
+
+    Returns a list of {id, username}, best matches first (see
+    search.search_users); the X-Has-More header tells whether another
+    page exists. Pages past USER_SEARCH_MAX_PAGES return the last one.
+    """
     permission_classes = (permissions.IsAuthenticated,)
-    serializer_class = UserSearchSerializer # use UserSearchSerializer
-# Define the queryset based on search query
-    def get_queryset(self):
-        query = self.request.query_params.get("query", "").strip() # get search query
+
+    def get(self, request):
+        params = request.query_params
+        query = params.get("query", "").strip() # get search query
         if not query:
-            return User.objects.none()
-        # Search users by username, excluding self
-        return User.objects.filter(Q(username__icontains=query)).exclude(
-            id=self.request.user.id
+            return Response([])
+        try:
+            page = min(max(int(params.get("page", 1)), 1), USER_SEARCH_MAX_PAGES)
+            limit = min(
+                max(int(params.get("limit", USER_SEARCH_PAGE_SIZE)), 1),
+                USER_SEARCH_MAX_PAGE_SIZE,
+            )
+        except ValueError:
+            return Response(
+                {"detail": "page and limit must be numbers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        users, has_more = search_users(request.user, query, (page - 1) * limit, limit)
+        # the last page allowed has no next one
+        has_more = has_more and page < USER_SEARCH_MAX_PAGES
+        return Response(
+            UserSearchSerializer(users, many=True).data,
+            headers={"X-Has-More": "true" if has_more else "false"},
+        )
+
+# View for full-text search over the caller's messages
+class MessageSearchView(APIView):
+    """
+    GET /messages/search/?query=<text>&conversation=<id>&page=<n>&limit=<n>
+
+    Ranked matches from the caller's conversations (optionally one),
+    without messages deleted for them or hidden with the conversation.
+    Each result carries an HTML-escaped snippet with <mark> highlights.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request):
+        params = request.query_params
+        query = params.get("query", "").strip()
+        if not query:
+            return Response({"ok": True, "results": [], "page": 1, "has_more": False})
+        try:
+            page = max(int(params.get("page", 1)), 1)
+            limit = min(max(int(params.get("limit", SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+            conversation_id = int(params["conversation"]) if params.get("conversation") else None
+        except ValueError:
+            return Response(
+                {"detail": "page, limit and conversation must be numbers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        rows, has_more = search_messages(
+            request.user, query, conversation_id, offset=(page - 1) * limit, limit=limit
         )
+        messages = MessageSerializer(
+            [m for m, _ in rows], many=True, context={"request": request}
+        ).data
+        return Response({
+            "ok": True,
+            "results": [
+                {"message": data, "snippet": snippet}
+                for data, (_, snippet) in zip(messages, rows)
+            ],
+            "page": page,
+            "has_more": has_more,
+        })
 
 # View for deleting a message for the current user
 class MessageDeleteForMeView(APIView):
@@ -321,14 +825,38 @@ class MessageDeleteForMeView(APIView):
             return Response({"detail": "Message not found"}, status=404)
         
         # Ensure user is participant in the conversation
-        if not ConversationParticipant.objects.filter(
-            conversation=msg.conversation, user=request.user
-        ).exists():
+        if not is_member(msg.conversation_id, request.user.id):
             return Response({"detail": "Forbidden"}, status=403) 
 
-        MessageDeletion.objects.get_or_create(message=msg, user=request.user) # create deletion record
+        delete_for_me(msg, request.user) # create deletion record (with a sync seq)
         return Response({"ok": True})
 
+# View for deleting many messages of a conversation for the current user
+class ConversationDeleteForMeView(APIView):
+    """
+    POST /conversations/<pk>/delete-for-me/  {"message_ids": [1, 2, 3]}
+    Hides the messages for the current user with a fixed number of queries.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, pk):
+        conv = get_object_or_404(Conversation, pk=pk)
+        if not is_member(conv.id, request.user.id):
+            return Response({"detail": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = MessageIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        message_ids = serializer.validated_data["message_ids"]
+        max_ids = getattr(settings, "CHAT_DELETE_MANY_MAX", DELETE_MANY_MAX)
+        if len(message_ids) > max_ids:
+            return Response(
+                {"detail": f"At most {max_ids} messages can be deleted at once"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        deleted = delete_many_for_me(conv, request.user, message_ids)
+        return Response({"ok": True, "deleted": deleted})
+
 # View for hiding a conversation for the current user
 class ConversationHideView(APIView):
     permission_classes = (permissions.IsAuthenticated,)
@@ -343,6 +871,7 @@ class ConversationHideView(APIView):
 
         participant.deleted_at = timezone.now()
         participant.save(update_fields=["deleted_at"])
+        bump_list_versions_on_commit([request.user.id])
         return Response({"ok": True})
 
 
@@ -407,5 +936,17 @@ class ResetPasswordView(APIView):
         # Set new password
         user.set_password(new_password)
         user.save()
+        revoke_user_tokens(user.id) # refuse the user's old access tokens too
         return Response({"detail": "Password has been reset successfully."}, status=status.HTTP_200_OK)
     
+
+
+# Prometheus metrics of every live worker (see metrics), for admin users
+class MetricsView(APIView):
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        return HttpResponse(
+            metrics.render(metrics.collect()),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
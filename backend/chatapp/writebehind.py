@@ -0,0 +1,308 @@
+"""
+This file contains the optional write-behind queue for chat messages.
+With CHAT_WRITE_BEHIND on, ChatConsumer does not write messages of the
+conversation types in CHAT_WRITE_BEHIND_TYPES itself: it takes the next
+sequence number from a cache counter, acknowledges and broadcasts right
+away, and queues the row. A per-worker flusher writes the queue every
+CHAT_WRITE_BEHIND_INTERVAL seconds with one bulk_create plus one unread
+UPDATE per conversation.
+
+Queued messages are broadcast without an id but with a uuid; after each
+flush the room gets a "messages_saved" frame mapping uuid -> id and seq,
+so clients can fill in the id (needed to delete the message).
+
+Messages not yet flushed are lost if the worker is killed, so durability
+is bounded by the flush interval; the queue is drained on shutdown (ASGI
+lifespan, and atexit for servers without it). The sequence counter must
+live in a shared, persistent cache (Redis) for every worker to agree.
+"""
+import asyncio
+import atexit
+import logging
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .dbexecutor import db_executor
+from .listcache import bump_lists_for_new_messages
+from .messaging import asend_group_events, group_event, increment_unread_many
+from .models import Conversation, Message
+from .presence import acache
+
+logger = logging.getLogger(__name__)
+
+# Defaults: seconds between flushes, rows per bulk_create, queued rows
+# before the consumer refuses new messages
+DEFAULT_FLUSH_INTERVAL = 0.1
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_MAX_PENDING = 20000
+
+# Failed flushes of a batch before its rows are written one by one
+MAX_FLUSH_ATTEMPTS = 3
+
+
+# Cache key holding the last sequence number handed out for a conversation
+def seq_key(conversation_id):
+    return f"conv_seq:{conversation_id}"
+
+
+# Whether messages of this conversation are numbered and written by the queue
+def uses_write_behind(conversation):
+    if not getattr(settings, "CHAT_WRITE_BEHIND", False):
+        return False
+    return conversation.type in getattr(
+        settings, "CHAT_WRITE_BEHIND_TYPES", [Conversation.TYPE_GLOBAL]
+    )
+
+
+def load_last_seq(conversation_id):
+    return (
+        Conversation.objects.filter(pk=conversation_id)
+        .values_list("last_seq", flat=True)
+        .get()
+    )
+
+
+# Value to seed a missing (e.g. evicted) counter with: last_seq only moves
+# on flush, so numbers already handed to rows still queued here come on top
+def seq_floor(conversation_id, last_seq):
+    return max(last_seq, write_behind.last_queued_seq(conversation_id))
+
+
+def reserve_seq(conversation_id, count=1):
+    """
+    Next sequence number from the cache counter (seeded from last_seq);
+    with count > 1, the last of a block of numbers.
+    """
+    key = seq_key(conversation_id)
+    try:
+        return cache.incr(key, count)
+    except ValueError:
+        cache.add(key, seq_floor(conversation_id, load_last_seq(conversation_id)), timeout=None)
+        return cache.incr(key, count)
+
+
+# Last number the counter handed out, without taking one (0 if unset)
+def peek_seq(conversation_id):
+    return cache.get(seq_key(conversation_id)) or 0
+
+
+# reserve_seq for async code: one cache round trip, no database hop
+async def areserve_seq(conversation_id):
+    key = seq_key(conversation_id)
+    try:
+        return await acache("incr", key)
+    except ValueError:
+        last_seq = await db_executor.run(load_last_seq, conversation_id)
+        await acache("add", key, seq_floor(conversation_id, last_seq), timeout=None)
+        return await acache("incr", key)
+
+
+def write_messages(messages):
+    """
+    Insert queued messages: one bulk_create, then per conversation one
+    unread UPDATE and one last_seq UPDATE. Conversation lists of the
+    members are invalidated with one more query.
+    Returns the messages, with their ids set.
+    """
+    senders = defaultdict(Counter)  # conversation id -> {sender id: messages}
+    last_seq = {}
+    for message in messages:
+        cid = message.conversation_id
+        senders[cid][message.sender_id] += 1
+        last_seq[cid] = max(last_seq.get(cid, 0), message.seq or 0)
+
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            for cid, counts in senders.items():
+                increment_unread_many(cid, counts)
+                Conversation.objects.filter(pk=cid).update(
+                    last_seq=Greatest(F("last_seq"), last_seq[cid]),
+                    updated_at=timezone.now(),
+                )
+            bump_lists_for_new_messages(list(senders))
+    except Exception:
+        # ids set by a rolled back insert do not exist
+        for message in messages:
+            message.pk = None
+        raise
+    return messages
+
+
+# Whether another row already holds the message's seq in its conversation
+def seq_taken(message):
+    return Message.objects.filter(
+        conversation_id=message.conversation_id, seq=message.seq
+    ).exists()
+
+
+def write_messages_one_by_one(messages):
+    """
+    Last resort for a batch that failed: keep every row that can be saved.
+    A message whose seq was handed out twice (by another worker after the
+    counter was lost) gets a new one instead of being dropped; clients
+    learn it from the messages_saved frame. Returns the messages written.
+    """
+    written = []
+    for message in messages:
+        try:
+            try:
+                write_messages([message])
+            except IntegrityError:
+                if not seq_taken(message):
+                    raise
+                message.seq = reserve_seq(message.conversation_id)
+                write_messages([message])
+            written.append(message)
+        except Exception:
+            logger.exception(
+                "Dropping queued message seq=%s of conversation %s",
+                message.seq, message.conversation_id,
+            )
+    return written
+
+
+def saved_events(messages):
+    """
+    One messages_saved event per conversation for the chat_<id> group:
+    the id and final seq of every written message, by uuid.
+    """
+    saved = defaultdict(list)
+    for message in messages:
+        if message.uuid is None:
+            continue
+        saved[message.conversation_id].append(
+            {"uuid": str(message.uuid), "id": message.pk, "seq": message.seq}
+        )
+    return [
+        (
+            f"chat_{cid}",
+            group_event(
+                "messages_saved",
+                {"type": "messages_saved", "conversation_id": cid, "messages": rows},
+            ),
+        )
+        for cid, rows in saved.items()
+    ]
+
+
+class WriteBehindQueue:
+    """
+    Per-worker queue of unsaved Message rows.
+    The flusher task runs only while rows are pending and is started by
+    put(); flush() writes at most one batch.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._task = None
+        self._failures = 0
+
+    @property
+    def interval(self):
+        return getattr(settings, "CHAT_WRITE_BEHIND_INTERVAL", DEFAULT_FLUSH_INTERVAL)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, "CHAT_WRITE_BEHIND_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+
+    @property
+    def max_pending(self):
+        return getattr(settings, "CHAT_WRITE_BEHIND_MAX_PENDING", DEFAULT_MAX_PENDING)
+
+    def __len__(self):
+        return len(self._pending)
+
+    # Highest seq among the rows still queued for a conversation (0 if none)
+    def last_queued_seq(self, conversation_id):
+        return max(
+            (m.seq for m in self._pending if m.conversation_id == conversation_id),
+            default=0,
+        )
+
+    # Whether new messages must be refused until the flusher catches up
+    def full(self):
+        return len(self._pending) >= self.max_pending
+
+    def put(self, message):
+        self._pending.append(message)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    # Take the next batch off the queue (no await in between, so concurrent
+    # flushes never write the same rows)
+    def _take_batch(self):
+        batch = self._pending[: self.batch_size]
+        del self._pending[: len(batch)]
+        return batch
+
+    async def flush(self):
+        """Write one batch. Returns the number of rows written."""
+        batch = self._take_batch()
+        if not batch:
+            return 0
+        try:
+            written = await db_executor.run(write_messages, batch)
+        except IntegrityError:
+            # a reused seq: retrying the batch cannot succeed
+            logger.exception("Write-behind flush hit a constraint, writing rows one by one")
+            written = await db_executor.run(write_messages_one_by_one, batch)
+        except Exception:
+            self._failures += 1
+            logger.exception("Write-behind flush failed (attempt %s)", self._failures)
+            if self._failures < MAX_FLUSH_ATTEMPTS:
+                # retry on the next tick, keeping the original order
+                self._pending[:0] = batch
+                return 0
+            written = await db_executor.run(write_messages_one_by_one, batch)
+        self._failures = 0
+        await asend_group_events(saved_events(written))
+        return len(batch)
+
+    async def drain(self):
+        """Write everything still queued (on shutdown)."""
+        written = 0
+        while self._pending:
+            written += await self.flush()
+        return written
+
+    # drain() for interpreter exit, when no event loop is left
+    def drain_sync(self):
+        while self._pending:
+            batch = self._take_batch()
+            try:
+                write_messages(batch)
+            except Exception:
+                logger.exception("Write-behind drain failed")
+                write_messages_one_by_one(batch)
+
+
+# Shared queue for all consumers in this worker
+write_behind = WriteBehindQueue()
+atexit.register(write_behind.drain_sync)
+
+
+async def lifespan_app(scope, receive, send):
+    """ASGI lifespan handler: drains the write-behind queue on shutdown."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            try:
+                await write_behind.drain()
+            except Exception:
+                logger.exception("Write-behind drain failed")
+            await send({"type": "lifespan.shutdown.complete"})
+            return
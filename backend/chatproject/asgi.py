@@ -15,6 +15,7 @@ django_asgi_app = get_asgi_application()
 
 from chatapp.routing import websocket_urlpatterns
 from chatapp.middleware import JWTAuthMiddleware
+from chatapp.writebehind import lifespan_app
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
@@ -22,5 +23,8 @@ application = ProtocolTypeRouter({
     "websocket": JWTAuthMiddleware(
         URLRouter(websocket_urlpatterns)
     ),
+
+    # drains queued messages on shutdown (CHAT_WRITE_BEHIND)
+    "lifespan": lifespan_app,
 })
 
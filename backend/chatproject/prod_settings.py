@@ -122,7 +122,7 @@ AUTH_USER_MODEL = "chatapp.User"
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chatapp.authentication.RevocableJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -182,6 +182,80 @@ LOGGING = {
     }
 }
 
+# Message history page size (cursor pagination)
+CHAT_MESSAGES_PAGE_SIZE = int(os.getenv("CHAT_MESSAGES_PAGE_SIZE", 50))
+CHAT_MESSAGES_MAX_PAGE_SIZE = int(os.getenv("CHAT_MESSAGES_MAX_PAGE_SIZE", 200))
+
+# Seconds a user stays online after their last presence refresh
+# (sockets refresh at most once per half of this window)
+CHAT_PRESENCE_TTL = int(os.getenv("CHAT_PRESENCE_TTL", 60))
+
+# Seconds to wait before telling contacts a user went offline
+# (a reconnect within this window sends nothing)
+CHAT_PRESENCE_DEBOUNCE = float(os.getenv("CHAT_PRESENCE_DEBOUNCE", 5))
+
+# Group conversations: member limit, participants shown per conversation
+# in the list, and seconds a membership check is cached
+CHAT_GROUP_MAX_MEMBERS = int(os.getenv("CHAT_GROUP_MAX_MEMBERS", 1000))
+CHAT_PARTICIPANTS_PREVIEW = int(os.getenv("CHAT_PARTICIPANTS_PREVIEW", 10))
+CHAT_MEMBERSHIP_TTL = int(os.getenv("CHAT_MEMBERSHIP_TTL", 60))
+
+# Messages that can be deleted for me in one request
+CHAT_DELETE_MANY_MAX = int(os.getenv("CHAT_DELETE_MANY_MAX", 500))
+
+# Validated WebSocket tokens cached per worker (skips JWT decode and user query)
+CHAT_WS_AUTH_CACHE_SIZE = int(os.getenv("CHAT_WS_AUTH_CACHE_SIZE", 10000))
+
+# Conversations one multiplexed WebSocket may subscribe to
+CHAT_MAX_SUBSCRIPTIONS = int(os.getenv("CHAT_MAX_SUBSCRIPTIONS", 100))
+
+# WebSocket rate limits: chat_message tokens refilled per second and bucket
+# size, per connection and per user (all sockets of the user). With
+# CHAT_RATE_LIMIT_GLOBAL the per-user limit is counted in the cache and
+# shared by every worker.
+CHAT_CONNECTION_MESSAGE_RATE = float(os.getenv("CHAT_CONNECTION_MESSAGE_RATE", 5))
+CHAT_CONNECTION_MESSAGE_BURST = int(os.getenv("CHAT_CONNECTION_MESSAGE_BURST", 10))
+CHAT_USER_MESSAGE_RATE = float(os.getenv("CHAT_USER_MESSAGE_RATE", 10))
+CHAT_USER_MESSAGE_BURST = int(os.getenv("CHAT_USER_MESSAGE_BURST", 20))
+CHAT_RATE_LIMIT_GLOBAL = os.getenv("CHAT_RATE_LIMIT_GLOBAL", "False").lower() == "true"
+# subscribe, delete_message and typing frames per user, limited the same way
+CHAT_USER_CONTROL_RATE = float(os.getenv("CHAT_USER_CONTROL_RATE", 20))
+CHAT_USER_CONTROL_BURST = int(os.getenv("CHAT_USER_CONTROL_BURST", 40))
+
+# Minimum milliseconds between typing events of a user in a room
+CHAT_TYPING_INTERVAL_MS = int(os.getenv("CHAT_TYPING_INTERVAL_MS", 1000))
+
+# Message writes in flight per worker before new ones are refused
+CHAT_MAX_PENDING_WRITES = int(os.getenv("CHAT_MAX_PENDING_WRITES", 32))
+
+# Write-behind for busy rooms: messages of these conversation types are
+# acknowledged and broadcast at once and written in batches every
+# CHAT_WRITE_BEHIND_INTERVAL seconds (messages not yet flushed are lost if
+# the worker is killed). New messages are refused while
+# CHAT_WRITE_BEHIND_MAX_PENDING rows wait.
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "False").lower() == "true"
+CHAT_WRITE_BEHIND_TYPES = os.getenv("CHAT_WRITE_BEHIND_TYPES", "global").split(",")
+CHAT_WRITE_BEHIND_INTERVAL = float(os.getenv("CHAT_WRITE_BEHIND_INTERVAL", 0.1))
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", 1000))
+CHAT_WRITE_BEHIND_MAX_PENDING = int(os.getenv("CHAT_WRITE_BEHIND_MAX_PENDING", 20000))
+
+# Seconds user search matches (shared) and conversation partners (per caller) stay cached
+CHAT_USER_SEARCH_CACHE_TIMEOUT = int(os.getenv("CHAT_USER_SEARCH_CACHE_TIMEOUT", 30))
+
+# Seconds a user's cached conversation list is kept (it is invalidated on
+# every change, this only bounds memory)
+CHAT_LIST_CACHE_TIMEOUT = int(os.getenv("CHAT_LIST_CACHE_TIMEOUT", 3600))
+
+# Database threads per worker for WebSocket code: 0 runs queries on the one
+# shared sync thread (database_sync_to_async); N uses a pool of N threads,
+# each holding its own database connection
+CHAT_DB_THREADS = int(os.getenv("CHAT_DB_THREADS", 0))
+
+# Realtime metrics (Prometheus text at /api/metrics/, admin users only);
+# each worker publishes its snapshot to the cache this often (seconds)
+CHAT_METRICS = os.getenv("CHAT_METRICS", "True").lower() == "true"
+CHAT_METRICS_PUBLISH_INTERVAL = int(os.getenv("CHAT_METRICS_PUBLISH_INTERVAL", 15))
+
 PASSWORD_RESET_LINK_URL = os.getenv("PASSWORD_RESET_LINK_URL")
 
 # Email settings
@@ -1,6 +1,13 @@
 import apiClient from "./apiClient";
 
 class ChatService {
+  // startup state in one request: { user, conversations, presence, active }
+  async bootstrap(conversationId) {
+    const params = conversationId ? { conversation: conversationId } : {};
+    const res = await apiClient.get("/bootstrap/", { params });
+    return res.data;
+  }
+
   async getConversations() {
     const res = await apiClient.get("/conversations/");
     return res.data;
@@ -11,13 +18,23 @@ class ChatService {
     return res.data;
   }
 
-  async getMessages(conversationId) {
+  // params: { before, after, limit } cursors returned by the previous page
+  async getMessages(conversationId, params = {}) {
     const res = await apiClient.get(
-      `/conversations/${conversationId}/messages/`
+      `/conversations/${conversationId}/messages/`,
+      { params }
     );
     return res.data;
   }
 
+  // changes after a sequence number: { messages, deleted, last_seq, has_more }
+  async syncMessages(conversationId, since) {
+    const res = await apiClient.get(`/conversations/${conversationId}/sync/`, {
+      params: { since },
+    });
+    return res.data;
+  }
+
   async sendMessage(conversationId, text) {
     const res = await apiClient.post(
       `/conversations/${conversationId}/messages/`,
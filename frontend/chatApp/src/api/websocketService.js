@@ -10,32 +10,31 @@ class WebSocketService {
     this.reconnectTimer = null;
 
     this.token = null;
-    this.currentRoom = null;
+    // conversations streamed on this socket (re-sent after every reconnect)
+    this.subscriptions = new Set();
   }
 
-  connect(token, conversationId) {
-    if (!token || !conversationId) return;
+  // One multiplexed socket per client; rooms are added with subscribe()
+  connect(token) {
+    if (!token) return;
     this.shouldReconnect = true;
 
-    // ✅ GUARD: already connected to same room
+    // ✅ GUARD: already connected (or connecting) with the same token
     if (
       this.socket &&
-      this.socket.readyState === WebSocket.OPEN &&
-      this.currentRoom === conversationId
+      this.socket.readyState <= WebSocket.OPEN &&
+      this.token === token
     ) {
       return;
     }
 
     this.token = token;
-    this.currentRoom = conversationId;
 
     if (this.socket) {
       this.disconnect();
     }
 
-
-
-    let wsUrl = `${config.wsUrl}/ws/chat/${conversationId}/?token=${token}`;
+    let wsUrl = `${config.wsUrl}/ws/chat/?token=${token}`;
 
     // Auto-upgrade to WSS if on HTTPS
     if (window.location.protocol === 'https:' && wsUrl.startsWith('ws://')) {
@@ -45,6 +44,10 @@ class WebSocketService {
     this.socket = new WebSocket(wsUrl);
 
     this.socket.onopen = () => {
+      // restore room subscriptions after a reconnect
+      this.subscriptions.forEach((conversationId) =>
+        this.sendMessage({ type: "subscribe", conversation_id: conversationId })
+      );
       this.trigger("open")
       // Start heartbeat
       this.startHeartBeat();
@@ -63,8 +66,8 @@ class WebSocketService {
 
         this.reconnectTimer = setTimeout(() => {
           this.reconnectTimer = null;
-          if (this.token && this.currentRoom) {
-            this.connect(this.token, this.currentRoom);
+          if (this.token) {
+            this.connect(this.token);
           }
         }, this.reconnectInterval);
       }
@@ -98,9 +101,23 @@ this.socket.send(JSON.stringify({ type: "ping" }));   }
   }
   // ==========================
 
+  // Start receiving a conversation on the shared socket
+  subscribe(conversationId) {
+    if (!conversationId || this.subscriptions.has(conversationId)) return;
+    this.subscriptions.add(conversationId);
+    this.sendMessage({ type: "subscribe", conversation_id: conversationId });
+  }
+
+  // Stop receiving a conversation (the socket stays open)
+  unsubscribe(conversationId) {
+    if (!this.subscriptions.delete(conversationId)) return;
+    this.sendMessage({ type: "unsubscribe", conversation_id: conversationId });
+  }
+
   disconnect({ permanent = false } = {}) {
     if (permanent) {
       this.shouldReconnect = false;
+      this.subscriptions.clear();
     }
     this.stopHeartBeat(); // stop heartbeat
     
@@ -9,6 +9,7 @@
 import { createSlice, createAsyncThunk } from "@reduxjs/toolkit";
 import authService from "../../api/authService";
 import { saveTokens, loadTokens, clearTokens } from "../../api/tokenUtils";
+import { bootstrap } from "../chat/chatSlice";
 
 /*
   THUNK: login
@@ -265,6 +266,16 @@ const authSlice = createSlice({
         state.error = action.payload || action.error?.message;
       });
 
+    //   fresh user data also arrives with the chat bootstrap
+    builder.addCase(bootstrap.fulfilled, (state, action) => {
+      state.user = action.payload.user;
+      saveTokens({
+        access: state.accessToken,
+        refresh: state.refreshToken,
+        user: state.user,
+      });
+    });
+
     //   getCurrentUser
     builder
       .addCase(getCurrentUser.pending, (state) => {
@@ -25,6 +25,18 @@ export const fetchConversations = createAsyncThunk(
   }
 );
 
+// Load user, conversation list, presence and the open room at once
+export const bootstrap = createAsyncThunk(
+  "chat/bootstrap",
+  async (conversationId, { rejectWithValue }) => {
+    try {
+      return await chatService.bootstrap(conversationId);
+    } catch (error) {
+      return rejectWithValue(normalizeError(error));
+    }
+  }
+);
+
 export const fetchMessages = createAsyncThunk(
   "chat/fetchMessages",
   async (conversationId, { rejectWithValue }) => {
@@ -39,6 +51,50 @@ export const fetchMessages = createAsyncThunk(
   }
 );
 
+// Fetch the page before the oldest loaded message of a conversation
+export const fetchOlderMessages = createAsyncThunk(
+  "chat/fetchOlderMessages",
+  async (conversationId, { getState, rejectWithValue }) => {
+    const { beforeCursor } = getState().chat.history[String(conversationId)];
+    try {
+      return {
+        conversationId,
+        page: await chatService.getMessages(conversationId, { before: beforeCursor }),
+      };
+    } catch (error) {
+      return rejectWithValue(normalizeError(error));
+    }
+  },
+  {
+    // nothing older, or a page already on its way
+    condition: (conversationId, { getState }) => {
+      const page = getState().chat.history[String(conversationId)];
+      return Boolean(page?.hasMore && page.beforeCursor && !page.loading);
+    },
+  }
+);
+
+// Fetch only what changed after the last seen seq (reconnects, missed frames)
+export const syncMessages = createAsyncThunk(
+  "chat/syncMessages",
+  async ({ conversationId, since }, { rejectWithValue }) => {
+    try {
+      const messages = [];
+      const deleted = [];
+      let data;
+      do {
+        data = await chatService.syncMessages(conversationId, since);
+        messages.push(...data.messages);
+        deleted.push(...data.deleted);
+        since = data.last_seq;
+      } while (data.has_more);
+      return { conversationId, messages, deleted };
+    } catch (error) {
+      return rejectWithValue(normalizeError(error));
+    }
+  }
+);
+
 export const sendMessages = createAsyncThunk(
   "chat/sendmessages",
   async ({ conversationId, text }, { rejectWithValue }) => {
@@ -134,6 +190,8 @@ const chatSlice = createSlice({
     searchStatus: "idle",
     searchError: null,
     messages: {},
+    // per conversation: { beforeCursor, hasMore, loading } of older pages
+    history: {},
     status: "idle",
     error: null,
     activeUser: null, // for online status
@@ -151,6 +209,10 @@ const chatSlice = createSlice({
 
       const id = String(conversationId);
 
+      // keep the conversation list preview in sync
+      const conv = state.conversations.find((c) => String(c.id) === id);
+      if (conv) conv.last_message = message;
+
       if (!state.messages[id]) {
         state.messages[id] = [message];
         return;
@@ -158,9 +220,13 @@ const chatSlice = createSlice({
 
       const current = state.messages[id];
 
-      // Helper to check for duplicates
+      // Helper to check for duplicates (queued messages have no id yet, only uuid)
       const isDuplicate = (list) =>
-        list.some((m) => String(m.id) === String(message.id));
+        list.some((m) =>
+          message.id != null
+            ? String(m.id) === String(message.id)
+            : message.uuid != null && m.uuid === message.uuid
+        );
 
       // Handle array structure
       if (Array.isArray(current)) {
@@ -180,6 +246,21 @@ const chatSlice = createSlice({
       }
     },
 
+    // Ids (and final seqs) of queued messages, sent once they are written
+    messagesSaved: (state, action) => {
+      const { conversation_id, messages } = action.payload;
+      const current = state.messages[String(conversation_id)];
+      if (!Array.isArray(current)) return;
+      const saved = new Map(messages.map((m) => [m.uuid, m]));
+      current.forEach((m) => {
+        const row = m.uuid != null && saved.get(m.uuid);
+        if (row) {
+          m.id = row.id;
+          m.seq = row.seq;
+        }
+      });
+    },
+
     // Chat list updates can be handled here as needed
     chatListUpdated: (state, action) => {
       const { conversation_id, unread_count } = action.payload;
@@ -199,6 +280,19 @@ const chatSlice = createSlice({
         });
       }
     },
+
+    // Online/offline change of a contact pushed over the socket
+    presenceChanged: (state, action) => {
+      const { user_id, is_online } = action.payload;
+      if (state.activeUser && String(state.activeUser.id) === String(user_id)) {
+        state.activeUser.is_online = is_online;
+      }
+      state.conversations.forEach((c) => {
+        (c.participants || []).forEach((p) => {
+          if (String(p.id) === String(user_id)) p.is_online = is_online;
+        });
+      });
+    },
   },
   extraReducers: (builder) => {
     builder
@@ -216,6 +310,29 @@ const chatSlice = createSlice({
         state.error = action.payload || action.error?.message;
       })
 
+      // bootstrap
+      .addCase(bootstrap.pending, (state) => {
+        state.status = "loading";
+        state.error = null;
+      })
+      .addCase(bootstrap.fulfilled, (state, action) => {
+        state.status = "succeeded";
+        const { conversations, active } = action.payload;
+        state.conversations = conversations;
+        if (active) {
+          state.messages[String(active.conversation_id)] = active.messages;
+          state.history[String(active.conversation_id)] = {
+            beforeCursor: active.before_cursor,
+            hasMore: active.has_more,
+            loading: false,
+          };
+        }
+      })
+      .addCase(bootstrap.rejected, (state, action) => {
+        state.status = "failed";
+        state.error = action.payload || action.error?.message;
+      })
+
       // fetchMessages
       .addCase(fetchMessages.pending, (state) => {
         state.status = "loading";
@@ -234,12 +351,54 @@ const chatSlice = createSlice({
 
         // replace with fresh server messages (no merge to avoid duplicates)
         state.messages[id] = incoming;
+        state.history[id] = {
+          beforeCursor: messages?.before_cursor ?? null,
+          hasMore: Boolean(messages?.has_more),
+          loading: false,
+        };
       })
       .addCase(fetchMessages.rejected, (state, action) => {
         state.status = "failed";
         state.error = action.payload || action.error?.message;
       })
 
+      // fetchOlderMessages: prepend the older page
+      .addCase(fetchOlderMessages.pending, (state, action) => {
+        state.history[String(action.meta.arg)].loading = true;
+      })
+      .addCase(fetchOlderMessages.fulfilled, (state, action) => {
+        const { conversationId, page } = action.payload;
+        const id = String(conversationId);
+        const current = Array.isArray(state.messages[id]) ? state.messages[id] : [];
+        const known = new Set(current.map((m) => String(m.id)));
+        state.messages[id] = page.messages
+          .filter((m) => !known.has(String(m.id)))
+          .concat(current);
+        state.history[id] = {
+          beforeCursor: page.before_cursor,
+          hasMore: page.has_more,
+          loading: false,
+        };
+      })
+      .addCase(fetchOlderMessages.rejected, (state, action) => {
+        const page = state.history[String(action.meta.arg)];
+        if (page) page.loading = false;
+        state.error = action.payload || action.error?.message;
+      })
+
+      // syncMessages: merge new messages, drop messages deleted for me
+      .addCase(syncMessages.fulfilled, (state, action) => {
+        const { conversationId, messages, deleted } = action.payload;
+        const id = String(conversationId);
+        const current = Array.isArray(state.messages[id]) ? state.messages[id] : [];
+        const removed = new Set(deleted.map(String));
+        const known = new Set(current.map((m) => m.seq));
+        state.messages[id] = current
+          .filter((m) => !removed.has(String(m.id)))
+          .concat(messages.filter((m) => !known.has(m.seq)))
+          .sort((a, b) => (a.seq ?? 0) - (b.seq ?? 0));
+      })
+
       // sendMessages
       .addCase(sendMessages.pending, (state) => {
         state.status = "loading";
@@ -375,6 +534,7 @@ const chatSlice = createSlice({
         );
         // optionally: clear its messages from state
         delete state.messages[String(conversationId)];
+        delete state.history[String(conversationId)];
       })
       .addCase(hideConversation.rejected, (state, action) => {
         state.error = action.payload || action.error?.message;
@@ -397,5 +557,6 @@ const chatSlice = createSlice({
   },
 });
 
-export const { addMessage, chatListUpdated } = chatSlice.actions;
+export const { addMessage, messagesSaved, chatListUpdated, presenceChanged } =
+  chatSlice.actions;
 export default chatSlice.reducer;
@@ -4,9 +4,14 @@ import {
   fetchConversations,
   fetchMarkRead,
   fetchMessages,
+  fetchOlderMessages,
+  bootstrap,
+  chatListUpdated,
+  syncMessages,
   sendMessages,
   startConversation,
   addMessage,
+  messagesSaved,
   fetchChatUser, // for online status
 } from "../chatSlice";
 import webSocketService from "../../../api/websocketService";
@@ -15,6 +20,7 @@ export default function useChatData({ routeConversationId, navigate }) {
   const dispatch = useDispatch();
   const conversations = useSelector((s) => s.chat.conversations) || [];
   const messagesMap = useSelector((s) => s.chat.messages) || {};
+  const historyMap = useSelector((s) => s.chat.history) || {};
   const chatStatus = useSelector((s) => s.chat.status);
   const user = useSelector((s) => s.auth.user) || {};
   const activeUser = useSelector((s) => s.chat.activeUser) || {}; // for online status
@@ -23,9 +29,20 @@ export default function useChatData({ routeConversationId, navigate }) {
   const [headerTitleOverride, setHeaderTitleOverride] = useState(null);
 
   const scrollRef = useRef(null);
+  // distance from the bottom to keep while an older page is prepended
+  const keepScrollRef = useRef(null);
+  // conversation whose first page came with the bootstrap request
+  const bootstrappedRef = useRef(null);
 
+  // one request for user, conversation list, presence and the open room
   useEffect(() => {
-    dispatch(fetchConversations());
+    bootstrappedRef.current = routeConversationId || null;
+    dispatch(bootstrap(routeConversationId)).then((res) => {
+      // room not part of the bootstrap (e.g. not in the list yet): load it
+      if (routeConversationId && !res.payload?.active) {
+        dispatch(fetchMessages(routeConversationId));
+      }
+    });
   }, [dispatch]);
 
   useEffect(() => {
@@ -35,7 +52,18 @@ export default function useChatData({ routeConversationId, navigate }) {
   // Load messages when active conversation changes
   useEffect(() => {
     if (!activeConversation) return;
+    const bootstrapped =
+      String(bootstrappedRef.current) === String(activeConversation);
+    bootstrappedRef.current = null;
     (async () => {
+      if (bootstrapped) {
+        // messages already loaded by bootstrap: only mark read
+        await dispatch(fetchMarkRead(activeConversation));
+        dispatch(
+          chatListUpdated({ conversation_id: activeConversation, unread_count: 0 })
+        );
+        return;
+      }
       // load messages
       await dispatch(fetchMessages(activeConversation));
       // mark read
@@ -52,15 +80,33 @@ export default function useChatData({ routeConversationId, navigate }) {
     messagesMap[activeConversation] ||
     [];
 
+  const activeHistory = historyMap[String(activeConversation)] || {};
+
   useEffect(() => {
     if (!scrollRef.current) return;
     const raf = requestAnimationFrame(() => {
       const el = scrollRef.current;
-      if (el) el.scrollTop = el.scrollHeight;
+      if (!el) return;
+      if (keepScrollRef.current != null) {
+        // older page above: stay on the messages being read
+        el.scrollTop = el.scrollHeight - keepScrollRef.current;
+        keepScrollRef.current = null;
+        return;
+      }
+      el.scrollTop = el.scrollHeight;
     });
     return () => cancelAnimationFrame(raf);
   }, [activeConversation, activeMessages]);
 
+  async function handleLoadOlder() {
+    if (!activeConversation) return;
+    const el = scrollRef.current;
+    keepScrollRef.current = el ? el.scrollHeight - el.scrollTop : null;
+    const res = await dispatch(fetchOlderMessages(activeConversation));
+    // nothing prepended: let new messages scroll to the bottom again
+    if (!res.payload?.page?.messages?.length) keepScrollRef.current = null;
+  }
+
   async function handleStartConversation(userObj) {
     try {
       const result = await dispatch(
@@ -171,10 +217,28 @@ export default function useChatData({ routeConversationId, navigate }) {
   const accessToken = useSelector((s) => s.auth.accessToken);
   const convId = currentConv?.id;
 
+  // latest messages for gap detection without resubscribing the socket
+  const messagesRef = useRef(messagesMap);
+  messagesRef.current = messagesMap;
+
   useEffect(() => {
     if (!accessToken || !convId) return;
 
-    webSocketService.connect(accessToken, convId);
+    webSocketService.connect(accessToken);
+    webSocketService.subscribe(convId);
+
+    // highest seq loaded for a conversation
+    const lastSeqOf = (conversationId) =>
+      (messagesRef.current[String(conversationId)] || []).reduce(
+        (max, m) => Math.max(max, m.seq || 0),
+        0
+      );
+
+    // after a reconnect, load only what was missed while offline
+    const handleOpen = () => {
+      const since = lastSeqOf(convId);
+      if (since) dispatch(syncMessages({ conversationId: convId, since }));
+    };
 
     // Handle incoming messages
     const handleMessage = (data) => {
@@ -184,16 +248,31 @@ export default function useChatData({ routeConversationId, navigate }) {
         dispatch(fetchConversations()); // ✅ Also refresh conversation list
       }
       if (data.type === "new_message") {
-        dispatch(addMessage(data.message));
+        // append locally; sync the missed changes when a seq was skipped
+        // (only messages take sequence numbers, so a gap is a missed message)
+        const lastSeq = lastSeqOf(data.conversation_id);
+        if (lastSeq && data.seq > lastSeq + 1) {
+          dispatch(
+            syncMessages({ conversationId: data.conversation_id, since: lastSeq })
+          );
+        } else {
+          dispatch(addMessage(data.message));
+        }
+      }
+      if (data.type === "messages_saved") {
+        // queued messages got their ids: match them by uuid
+        dispatch(messagesSaved(data));
       }
     };
     // Subscribe to messages
     webSocketService.on("message", handleMessage);
+    webSocketService.on("open", handleOpen);
 
     return () => {
       webSocketService.off("message", handleMessage);
-      // normal cleanup, allows reconnect later
-      webSocketService.disconnect();
+      webSocketService.off("open", handleOpen);
+      // leave the room only; the shared socket stays open
+      webSocketService.unsubscribe(convId);
     };
   }, [accessToken, convId, dispatch]);
 
@@ -202,7 +281,7 @@ export default function useChatData({ routeConversationId, navigate }) {
     const handleMessage = (data)=>{
       if(!data?.type) return;
 
-      if(data.type === "conversation_updated" && String(data.conversation_id) === String(activeConversation)){
+      if((data.type === "conversation_updated" || data.type === "new_message") && String(data.conversation_id) === String(activeConversation)){
         dispatch(fetchMarkRead(activeConversation))
     }
   }
@@ -225,6 +304,9 @@ export default function useChatData({ routeConversationId, navigate }) {
     handleStartConversation,
     handleSendMessage,
     activeMessages,
+    hasOlderMessages: Boolean(activeHistory.hasMore),
+    loadingOlderMessages: Boolean(activeHistory.loading),
+    handleLoadOlder,
     scrollRef,
     activeUser, // for online status
   };
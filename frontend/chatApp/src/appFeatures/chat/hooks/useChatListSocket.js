@@ -1,6 +1,9 @@
 import { useEffect } from "react";
 import { useSelector, useDispatch } from "react-redux";
-import { fetchConversations } from "../../../appFeatures/chat/chatSlice";
+import {
+  fetchConversations,
+  presenceChanged,
+} from "../../../appFeatures/chat/chatSlice";
 import webSocketService from "../../../api/websocketService";
 
 export default function useChatListSocket() {
@@ -11,14 +14,17 @@ export default function useChatListSocket() {
     if (!accessToken) return;
 
     // ✅ Connect once for user-level updates (unread, new chats)
-    // "list" is just a dummy room; backend routes by user group
-    webSocketService.connect(accessToken, "list");
+    // the same socket carries every conversation subscribed by useChatData
+    webSocketService.connect(accessToken);
 
     const handleMessage = (data) => {
       if (!data?.type) return;
         if (data.type === "chat_list_update" || data.type === "conversation_updated" ) {
           dispatch(fetchConversations());
         }
+        if (data.type === "presence_changed") {
+          dispatch(presenceChanged(data));
+        }
     };
     webSocketService.on("message", handleMessage);
     return () => {
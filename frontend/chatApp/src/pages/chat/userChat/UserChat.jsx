@@ -30,6 +30,9 @@ export default function UserChat() {
     handleStartConversation,
     handleSendMessage,
     activeMessages,
+    hasOlderMessages,
+    loadingOlderMessages,
+    handleLoadOlder,
     scrollRef,
     activeUser, // for online status
   } = useChatData({ routeConversationId, navigate });
@@ -98,7 +101,15 @@ export default function UserChat() {
         }
         messages={
           activeConversation ? (
-            <ChatPane scrollRef={scrollRef} messages={activeMessages} currentUserId={user.id} conversationId={activeConversation} />
+            <ChatPane
+              scrollRef={scrollRef}
+              messages={activeMessages}
+              currentUserId={user.id}
+              conversationId={activeConversation}
+              hasOlder={hasOlderMessages}
+              loadingOlder={loadingOlderMessages}
+              onLoadOlder={handleLoadOlder}
+            />
           ) : (
             <EmptyState />
           )
@@ -1,9 +1,16 @@
 import { MessageList } from "../../../../components";
 
-export default function ChatPane({ scrollRef, messages, currentUserId, conversationId }) {
+export default function ChatPane({ scrollRef, messages, currentUserId, conversationId, hasOlder, loadingOlder, onLoadOlder }) {
 
   return (
     <div ref={scrollRef} style={{ height: "100%", overflow: "auto", background: "var(--bs-tertiary-bg)", color: "var(--bs-body-color)" }} aria-live="polite">
+      {hasOlder && (
+        <div className="text-center pt-3">
+          <button className="btn btn-sm btn-outline-secondary" onClick={onLoadOlder} disabled={loadingOlder}>
+            {loadingOlder ? "Loading..." : "Load older messages"}
+          </button>
+        </div>
+      )}
       <MessageList conversationId={conversationId} messages={messages} currentUserId={currentUserId} />
     </div>
   );